@@ -6,8 +6,22 @@
 ###########################################
 import pygame
 import random
-import copy
 import sys
+import os
+import argparse
+import collections
+import csv
+import gc
+import itertools
+import json
+import mmap
+import multiprocessing
+import multiprocessing.pool
+import platform
+import struct
+import threading
+import time
+import timeit
 
 MAP_WIDTH = 600
 MAP_HEIGHT = 360
@@ -19,79 +33,186 @@ WINDOW_HEIGHT = MAP_HEIGHT + SIDEBAR_HEIGHT
 
 class Background(pygame.sprite.Sprite):
     def __init__(self, imageList):
-        self.imageList = []
-        for image in imageList:
-            self.imageList.append(pygame.image.load("images/" + image).convert())
-        self.image = self.imageList[0]
-        self.rect = self.image.get_rect()
-        self.rect.top = 0
-        self.rect.left = 0
+        self.store = BackgroundStore(imageList)
+        self.changeBackground(0)
 
     def changeBackground(self, imageNum):
-        self.image = self.imageList[imageNum]
+        self.image = self.store.get(imageNum)
         self.rect = self.image.get_rect()
 
-    def draw(self):
-        screen.blit(self.image, self.rect)
+    def draw(self, surface):
+        surface.blit(self.image, self.rect)
 
 class Sidebar():
     def __init__(self):
-        global SPELL_STATS
         self.font = pygame.font.Font(None, 22)
         self.numGemsCache = numGems
         self.gemsText = self.font.render(str(numGems) + " gems", 1, LIGHT_GRAY)
         self.spells = pygame.sprite.Group()
 
-        #               image filename,      x,   y,               cost, function,    hotkey
-        SPELL_STATS = (('fireballIcon.bmp',  100, MAP_HEIGHT + 30, 5,  castFireBall,  '1'),
-                       ('whirlwindIcon.bmp', 170, MAP_HEIGHT + 30, 8,  castWhirlWind, '2'),
-                       ('ghostIcon.bmp',     240, MAP_HEIGHT + 30, 10, castGhost,     '3'))
-
         for spell in SPELL_STATS:
-            spell = SpellIcon(pygame.image.load('images/' + spell[0]), *spell[1:])
+            spell = SpellIcon(loadImage(spell[0]), *spell[1:])
             self.spells.add(spell)
 
-        self.logo = Logo(pygame.image.load("images/logo.bmp"), 360, 370)
+        self.logo = Logo(loadImage("logo.bmp"), 360, 370)
 
-    def draw(self):
-        if self.numGemsCache != numGems:
-            # update the "X gems" text Surface object
-            self.gemsText = self.font.render(str(numGems) + " gems", 1, LIGHT_GRAY)
+    def updateGemsText(self):
+        """Updates the "X gems" text Surface object if numGems changed, and returns True if it did."""
+        if self.numGemsCache == numGems:
+            return False
+        self.gemsText = self.font.render(str(numGems) + " gems", 1, LIGHT_GRAY)
+        self.numGemsCache = numGems
+        return True
 
-        pygame.draw.rect(screen, BLACK, [0, 360, WINDOW_WIDTH, WINDOW_HEIGHT - 360])
-        screen.blit(self.gemsText, [10, 360 + 20])
+    def drawStatic(self, surface):
+        """Draws everything on the sidebar except for the "X gems" text."""
+        pygame.draw.rect(surface, BLACK, [0, 360, WINDOW_WIDTH, WINDOW_HEIGHT - 360])
 
         for spell in self.spells:
-            spell.draw()
+            spell.draw(surface)
+
+        self.logo.draw(surface)
+
+    def draw(self, surface):
+        self.updateGemsText()
+        self.drawStatic(surface)
+        surface.blit(self.gemsText, self.gemsTextPos)
+
+    gemsTextPos = (10, 360 + 20)
+
+
+class SpriteSheet(object):
+    """A sprite sheet image that has been loaded, converted, colorkeyed, and
+    sliced into its animation frames."""
+    def __init__(self, image, width, height, columns):
+        self.image = image
+        self.frame_width = width
+        self.frame_height = height
+        self.columns = columns
+
+        # the sheet is cut into frames once here instead of in every update()
+        sheet_rect = image.get_rect()
+        num_frames = (sheet_rect.width // width) * (sheet_rect.height // height)
+        self.frames = tuple(image.subsurface(((i % columns) * width, (i // columns) * height, width, height))
+                            for i in range(num_frames))
+
+
+class SpriteSheetCache(object):
+    """Loads every sprite sheet image file once and shares it among all of the
+    AnimatedSprite objects that use it."""
+    def __init__(self):
+        self.images = {} # keys are filenames, values are converted Surface objects
+        self.sheets = {} # keys are (filename, width, height, columns), values are SpriteSheet objects
+        self.hits = 0
+        self.misses = 0
+        self.decodes = 0 # number of times an image file was actually loaded
+        self.lock = threading.Lock()
+
+    def get(self, filename, width, height, columns):
+        """Returns the SpriteSheet for filename cut into width x height frames."""
+        key = (filename, width, height, columns)
+        with self.lock: # waves can be built on a background thread
+            if key in self.sheets:
+                self.hits += 1
+                return self.sheets[key]
+
+            self.misses += 1
+            if filename not in self.images:
+                image = loadImage(filename)
+                image.set_colorkey(WHITE, pygame.RLEACCEL)
+                self.images[filename] = image
+                self.decodes += 1
+            self.sheets[key] = SpriteSheet(self.images[filename], width, height, columns)
+            return self.sheets[key]
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'decodes': self.decodes,
+                'files': len(self.images)}
+
+spriteSheets = SpriteSheetCache()
+
+
+class SpritePool(object):
+    """Keeps the sprites that have left the game in free lists and hands them out again instead
+    of creating new ones, so spells, gems and monsters that come and go all game long reuse the
+    same objects. A kind of sprite is its class and the arguments it was created with after
+    the target surface, and each kind has its own free list."""
+    def __init__(self):
+        self.free = {} # keys are (class, arguments...), values are lists of sprites ready to be reused
+        self.created = 0
+        self.reused = 0
+        self.inUse = 0
+        self.highWater = 0 # the most sprites that were in use at once
+        self.lock = threading.Lock()
+
+    def get(self, cls, *args):
+        """Returns a sprite made with cls(screen, *args), reusing a free one if there is one."""
+        key = (cls,) + args
+        with self.lock: # waves can be built on a background thread
+            free = self.free.get(key)
+            sprite = free.pop() if POOL_SPRITES and free else None
+            if sprite is None:
+                self.created += 1
+            else:
+                self.reused += 1
+            self.inUse += 1
+            self.highWater = max(self.highWater, self.inUse)
+        if sprite is None:
+            sprite = cls(screen, *args)
+            sprite.poolKey = key
+        else:
+            sprite.reset()
+        return sprite
 
-        self.logo.draw()
+    def release(self, sprite):
+        """Puts a sprite that is no longer in any of the game's groups on its free list."""
+        with self.lock:
+            self.inUse -= 1
+            if POOL_SPRITES:
+                self.free.setdefault(sprite.poolKey, []).append(sprite)
 
+    def stats(self):
+        return {'created': self.created,
+                'reused': self.reused,
+                'in use': self.inUse,
+                'high water': self.highWater,
+                'free': sum(len(free) for free in self.free.values())}
 
-class AnimatedSprite(pygame.sprite.Sprite):
+spritePool = SpritePool()
+
+
+class AnimatedSprite(pygame.sprite.DirtySprite):
     def __init__(self, target, filename, width, height, columns):
-        pygame.sprite.Sprite.__init__(self) #extend the base Sprite class
+        pygame.sprite.DirtySprite.__init__(self) #extend the base Sprite class
+        self.dirty = 2 # animated sprites change every frame, so DirtyRenderer always redraws them
         self.target_surface = target
         self.image = None # the current animation frame to be displayed
 
-        # the single image file that contains all the sprites of this animation
-        self.master_image = pygame.image.load('images/' + filename)
-        self.master_image.set_colorkey(WHITE, pygame.RLEACCEL)
+        # the single image file that contains all the sprites of this animation, shared with every other sprite using it
+        self.sheet = spriteSheets.get(filename, width, height, columns)
+        self.master_image = self.sheet.image
+
+        self.frames = self.sheet.frames # every animation frame, shared by all sprites of this kind
 
         self.rect = 0, 0, width, height
         self.topleft = 0, 0
         self.frame = 0 # the current frame number to be displayed
-        self.old_frame = -1 # the previously shown frame
         self.frame_width = width
         self.frame_height = height
-
-        #try to auto - calculate total frames
-        frame_rect = self.master_image.get_rect()
-        self.last_frame = (frame_rect.width // width) * (frame_rect.height // height) - 1
+        self.last_frame = len(self.frames) - 1
 
         self.columns = columns
         self.last_time = 0
         self.update(1, False)
 
+    def reset(self):
+        """Starts the animation over, for a sprite reused by the SpritePool."""
+        self.frame = 0
+        self.last_time = 0
+        self.update(1, False)
+
     def update(self, current_time, rate=30):
         #update animation frame number
         if current_time > self.last_time + rate:
@@ -99,18 +220,13 @@ class AnimatedSprite(pygame.sprite.Sprite):
             if self.frame > self.last_frame:
                 self.frame = 0
             self.last_time = current_time
-        #build current frame only if it changed
-        if self.frame != self.old_frame:
-            frame_x = (self.frame % self.columns) * self.frame_width
-            frame_y = (self.frame // self.columns) * self.frame_height
-            frame_rect = ( frame_x, frame_y, self.frame_width, self.frame_height )
-            self.image = self.master_image.subsurface(frame_rect)
-            self.old_frame = self.frame
+        self.image = self.frames[self.frame]
 
     def set_rect(self, x, y):
         self.rect = self.image.get_rect()
         self.rect.top = y
         self.rect.left = x
+        self.prevTopleft = self.rect.topleft # nothing to interpolate from before its first tick
 
     def __str__(self):
         return str({'frame': self.frame,
@@ -130,34 +246,111 @@ class Monster(AnimatedSprite):
         AnimatedSprite.update(self, current_time)
         if move:
             self.rect.left += self.speed
-            screen.blit(self.image, self.rect)
-            pygame.draw.rect(screen, BLACK, [self.rect.left, self.rect.top - 20, self.whole_life * 10, 14])
-            pygame.draw.rect(screen, RED, [self.rect.left, self.rect.top - 20, self.life * 10, 14])
             if self.rect.left >= WINDOW_WIDTH:
                 gameover = True
+    def draw(self, surface):
+        surface.blit(self.image, self.rect)
+        pygame.draw.rect(surface, BLACK, [self.rect.left, self.rect.top - 20, self.whole_life * 10, 14])
+        pygame.draw.rect(surface, RED, [self.rect.left, self.rect.top - 20, self.life * 10, 14])
     def kill(self):
         if self.life == 1 and self in monsters:
             monsters.remove(self)
             gemChance = ((self.speed * 2) + self.whole_life) * 3
             if random.randint(1, 100)<gemChance:
-                gem = copy.copy(gemTemplate)
-                gem.update(1, False)
-                gem.set_rect(random.randint(self.rect.left - 10, self.rect.left + 10), random.randint(self.rect.top - 10, self.rect.top + 10))
-                gems.add(copy.copy(gem))
-        else:
+                spawnGem(random.randint(self.rect.left - 10, self.rect.left + 10), random.randint(self.rect.top - 10, self.rect.top + 10))
+            spritePool.release(self)
+        elif self in monsters: # a fireball hits three times, but a monster that's dead may be reused already
             self.life -= 1
 
+class MonsterGroup(pygame.sprite.Group):
+    """A sprite group of monsters that also files each monster into a bucket by the column of
+    the window its left edge is in, BUCKET_WIDTH pixels wide. Monsters only move sideways, so
+    this is all it takes to find the monsters at a point or touching a spell without looking at
+    the rest. Call moved() after changing a monster's rect outside of update()."""
+    def __init__(self, *sprites):
+        self.buckets = {} # keys are column numbers, values are dicts of the monsters in that column
+        self.columns = {} # keys are monsters, values are the column they are filed under
+        self.widest = 0 # a monster this far left of a column can still reach into it
+        pygame.sprite.Group.__init__(self, *sprites)
+
+    def file(self, sprite, column):
+        self.columns[sprite] = column
+        self.buckets.setdefault(column, {})[sprite] = None
+
+    def add_internal(self, sprite, *args):
+        pygame.sprite.Group.add_internal(self, sprite, *args)
+        self.file(sprite, sprite.rect.left // BUCKET_WIDTH)
+        self.widest = max(self.widest, sprite.rect.width)
+
+    def remove_internal(self, sprite):
+        del self.buckets[self.columns.pop(sprite)][sprite]
+        pygame.sprite.Group.remove_internal(self, sprite)
+
+    def moved(self, sprite):
+        """Files a monster under the column it is in now, if it changed."""
+        column = sprite.rect.left // BUCKET_WIDTH
+        if column != self.columns[sprite]:
+            del self.buckets[self.columns[sprite]][sprite]
+            self.file(sprite, column)
+
+    def update(self, current_time):
+        columns = self.columns
+        for monster in self.sprites():
+            monster.update(current_time)
+            column = monster.rect.left // BUCKET_WIDTH
+            if column != columns[monster]:
+                del self.buckets[columns[monster]][monster]
+                self.file(monster, column)
+
+    def near(self, left, right):
+        """Yields the monsters that could overlap the columns from x position left up to right."""
+        for column in range((left - self.widest) // BUCKET_WIDTH, (right - 1) // BUCKET_WIDTH + 1):
+            for monster in self.buckets.get(column, ()):
+                yield monster
+
+    def at(self, pos):
+        """Returns a list of the monsters whose rect contains the point pos."""
+        return [monster for monster in self.near(pos[0], pos[0] + 1) if monster.rect.collidepoint(pos)]
+
+    def colliding(self, sprite):
+        """Returns a list of the monsters whose rect overlaps sprite's, like
+        pygame.sprite.spritecollide(sprite, group, False) but without testing every monster."""
+        rect = sprite.rect
+        return [monster for monster in self.near(rect.left, rect.right) if monster.rect.colliderect(rect)]
+
+class HealthBar(pygame.sprite.DirtySprite):
+    """The life bar above a monster, as a separate sprite for DirtyRenderer."""
+    def __init__(self, monster):
+        pygame.sprite.DirtySprite.__init__(self)
+        self.dirty = 2 # it moves along with the monster every frame
+        self.monster = monster
+        self.image = pygame.Surface((monster.whole_life * 10, 14))
+        self.life = None # the monster's life when the image was last drawn
+        self.update()
+
+    def update(self):
+        if self.image.get_width() != self.monster.whole_life * 10:
+            self.image = pygame.Surface((self.monster.whole_life * 10, 14)) # the monster was reused as a different one
+            self.life = None
+        if self.life != self.monster.life:
+            self.image.fill(BLACK)
+            self.image.fill(RED, [0, 0, self.monster.life * 10, 14])
+            self.life = self.monster.life
+        self.rect = self.image.get_rect(left=self.monster.rect.left, top=self.monster.rect.top - 20)
+
 class Gem(AnimatedSprite):
     def __init__(self, target):
         super(Gem, self).__init__(target, 'gems.bmp', 18, 32, 6)
 
     def update(self, current_time, move=True):
         AnimatedSprite.update(self, current_time)
-        if move:
-            screen.blit(self.image, self.rect)
+
+    def draw(self, surface):
+        surface.blit(self.image, self.rect)
 
     def remove(self):
-        gems.remove_internal(self)
+        gems.remove(self)
+        spritePool.release(self)
 
 
 class SpellIcon(pygame.sprite.Sprite):
@@ -173,10 +366,10 @@ class SpellIcon(pygame.sprite.Sprite):
         font = pygame.font.Font(None, 14)
         self.costText = font.render("Cost: " + str(self.cost) + " gems", 1, LIGHT_GRAY)
         self.hotKeyText = font.render("Hot Key: " + str(hotKey), 1, LIGHT_GRAY)
-    def draw(self):
-        screen.blit(self.image, self.rect)
-        screen.blit(self.costText, [self.rect.left, self.rect.bottom + 10])
-        screen.blit(self.hotKeyText, [self.rect.left, self.rect.bottom + 25])
+    def draw(self, surface):
+        surface.blit(self.image, self.rect)
+        surface.blit(self.costText, [self.rect.left, self.rect.bottom + 10])
+        surface.blit(self.hotKeyText, [self.rect.left, self.rect.bottom + 25])
 
 class Logo(pygame.sprite.Sprite):
     def __init__(self, image, x, y):
@@ -185,8 +378,8 @@ class Logo(pygame.sprite.Sprite):
         self.rect = image.get_rect()
         self.rect.left = x
         self.rect.top = y
-    def draw(self):
-        screen.blit(self.image, self.rect)
+    def draw(self, surface):
+        surface.blit(self.image, self.rect)
 
 class SpellEffect(AnimatedSprite):
     def set_speed(self, speed):
@@ -196,18 +389,24 @@ class SpellEffect(AnimatedSprite):
         if move:
             self.rect.left += self.speed[0]
             self.rect.top += self.speed[1]
-            screen.blit(self.image, self.rect)
+    def draw(self, surface):
+        surface.blit(self.image, self.rect)
+
+def spawnGem(x, y):
+    gem = spritePool.get(Gem)
+    gem.set_rect(x, y)
+    gems.add(gem)
 
 def castFireBall():
     for i in range(4):
-        effect = SpellEffect(screen, "fireballSpell.bmp", 16, 48, 6)
+        effect = spritePool.get(SpellEffect, "fireballSpell.bmp", 16, 48, 6)
         effect.set_rect(random.randint(30, WINDOW_WIDTH - 30), -10)
         effect.set_speed([0, 5])
         fireballs.add(effect)
     fireballSound.play()
 
 def castWhirlWind():
-    effect = SpellEffect(screen, "whirlwindSpell.bmp", 29, 32, 2)
+    effect = spritePool.get(SpellEffect, "whirlwindSpell.bmp", 29, 32, 2)
     effect.set_rect(WINDOW_WIDTH + 20, random.randint(30, WINDOW_HEIGHT - 30 - SIDEBAR_HEIGHT))
     effect.set_speed([ - 10, 0])
     whirlwinds.add(effect)
@@ -215,13 +414,465 @@ def castWhirlWind():
 
 def castGhost():
     for i in range(6):
-        effect = SpellEffect(screen, "ghostSpell.bmp", 32, 32, 2)
+        effect = spritePool.get(SpellEffect, "ghostSpell.bmp", 32, 32, 2)
         effect.set_rect( - 10, random.randint(30, WINDOW_HEIGHT - 30 - SIDEBAR_HEIGHT))
         effect.set_speed([12, 0])
         ghosts.add(effect)
     ghostSound.play()
 
 
+class FlipRenderer(object):
+    """Draws each frame from scratch and then updates the whole window."""
+    def draw(self):
+        """Draws the game and returns a list of the Rects of the window that were updated."""
+        profiler.begin('background')
+        screen.fill(WHITE)
+        background.draw(screen)
+        sidebar.draw(screen)
+        profiler.end()
+        for name, group in (('draw monsters', monsters), ('draw gems', gems), ('draw fireballs', fireballs),
+                            ('draw whirlwinds', whirlwinds), ('draw ghosts', ghosts)):
+            profiler.begin(name)
+            for sprite in group:
+                sprite.draw(screen)
+            profiler.end()
+        profiler.begin('display')
+        pygame.display.flip()
+        profiler.end()
+        return [screen.get_rect()]
+
+    def invalidate(self):
+        pass
+
+    def repaint(self, rect):
+        pass
+
+
+class DirtyRenderer(object):
+    """Draws the game with a LayeredDirty sprite group, so that only the parts of the window
+    where a monster, health bar, gem, spell effect, or the gem count changed get redrawn.
+    The background and the rest of the sidebar are drawn once onto a static layer."""
+
+    # the layers of the LayeredDirty group, from the bottom up
+    MONSTER_LAYER, HEALTH_BAR_LAYER, GEM_LAYER, FIREBALL_LAYER, WHIRLWIND_LAYER, GHOST_LAYER, SIDEBAR_LAYER = range(7)
+
+    def __init__(self):
+        self.sprites = pygame.sprite.LayeredDirty()
+        self.healthBars = {} # keys are Monster objects, values are their HealthBar objects
+        self.gemsText = pygame.sprite.DirtySprite()
+        self.gemsText.image = sidebar.gemsText
+        self.gemsText.rect = self.gemsText.image.get_rect(topleft=sidebar.gemsTextPos)
+        self.sprites.add(self.gemsText, layer=self.SIDEBAR_LAYER)
+        self.invalidate()
+
+    def invalidate(self):
+        """Redraws the static layer and makes the next frame redraw the whole window. This has
+        to be called after the background changes or something else draws on the screen."""
+        self.staticLayer = pygame.Surface((WINDOW_WIDTH, WINDOW_HEIGHT)).convert()
+        self.staticLayer.fill(WHITE)
+        background.draw(self.staticLayer)
+        sidebar.drawStatic(self.staticLayer)
+        self.sprites.clear(screen, self.staticLayer)
+        self.sprites.repaint_rect(screen.get_rect())
+
+    def repaint(self, rect):
+        """Makes the next frame redraw rect, after something else was drawn over it."""
+        self.sprites.repaint_rect(rect)
+
+    def sync(self):
+        """Adds the game's sprites to the LayeredDirty group and removes the ones that are gone."""
+        current = set([self.gemsText])
+        for name, group, layer in (('sync monsters', monsters, self.MONSTER_LAYER),
+                                   ('sync gems', gems, self.GEM_LAYER),
+                                   ('sync fireballs', fireballs, self.FIREBALL_LAYER),
+                                   ('sync whirlwinds', whirlwinds, self.WHIRLWIND_LAYER),
+                                   ('sync ghosts', ghosts, self.GHOST_LAYER)):
+            profiler.begin(name)
+            for sprite in group:
+                current.add(sprite)
+                if not self.sprites.has(sprite):
+                    self.sprites.add(sprite, layer=layer)
+            profiler.end()
+
+        profiler.begin('sync health bars')
+        for monster in monsters:
+            healthBar = self.healthBars.get(monster)
+            if healthBar is None:
+                healthBar = self.healthBars[monster] = HealthBar(monster)
+                self.sprites.add(healthBar, layer=self.HEALTH_BAR_LAYER)
+            healthBar.update()
+            current.add(healthBar)
+        profiler.end()
+
+        for sprite in self.sprites.sprites():
+            if sprite not in current:
+                self.sprites.remove(sprite)
+                if isinstance(sprite, HealthBar):
+                    del self.healthBars[sprite.monster]
+
+    def draw(self):
+        """Draws the game and returns a list of the Rects of the window that were updated."""
+        if sidebar.updateGemsText():
+            self.gemsText.image = sidebar.gemsText
+            self.gemsText.rect = self.gemsText.image.get_rect(topleft=sidebar.gemsTextPos)
+            self.gemsText.dirty = 1
+        # sync() is timed per sprite group, but every layer is drawn by one LayeredDirty.draw(),
+        # so drawing the groups can only be timed apart with the FlipRenderer
+        profiler.begin('sync')
+        self.sync()
+        profiler.end()
+        profiler.begin('sprites')
+        rects = self.sprites.draw(screen)
+        profiler.end()
+        profiler.begin('display')
+        pygame.display.update(rects)
+        profiler.end()
+        return rects
+
+
+class NullProfiler(object):
+    # used when the game isn't run with --profile, so every call below costs next to nothing
+    def startFrame(self): pass
+    def endFrame(self): pass
+    def begin(self, name): pass
+    def end(self): pass
+    def summaryLines(self): return []
+    def close(self): pass
+
+class FrameProfiler(NullProfiler):
+    """Keeps track of how long each section of the game loop takes.
+
+    Each frame is bracketed by startFrame()/endFrame(), and each section inside it by
+    begin(name)/end(). Sections may contain other sections. Every few frames the averages
+    over the recent frames are turned into the lines drawProfile() shows. With an output
+    filename, every section of every frame is kept, and close() saves them for chrome://tracing
+    (a .json filename) or a spreadsheet (any other filename)."""
+    def __init__(self, history=100, refresh=10, output=None):
+        self.recent = collections.deque(maxlen=history) # (frame seconds, section times) of the latest frames
+        self.refresh = refresh
+        self.output = output
+        self.sections = collections.OrderedDict() # section name -> nesting depth, in the order first seen
+        self.open = [] # [name, start time] of the sections begun and not yet ended
+        self.frameCount = 0
+        self.frameStart = None
+        self.sectionTimes = {}
+        self.frames = [] # (start time, frame seconds, section times) of every frame, kept for output
+        self.events = [] # (name, start time, seconds) of every section, kept for output
+        self.lines = []
+
+    def startFrame(self):
+        # also used to throw away the time spent so far in a frame, like waiting on a message
+        self.frameStart = timeit.default_timer()
+        self.sectionTimes = {}
+
+    def endFrame(self):
+        if self.frameStart is None:
+            return
+        frameSeconds = timeit.default_timer() - self.frameStart
+        self.recent.append((frameSeconds, self.sectionTimes))
+        if self.output:
+            self.frames.append((self.frameStart, frameSeconds, self.sectionTimes))
+        self.frameCount += 1
+        if self.frameCount % self.refresh == 0:
+            self.lines = self.summarize()
+
+    def begin(self, name):
+        self.sections.setdefault(name, len(self.open))
+        self.open.append([name, timeit.default_timer()])
+
+    def end(self):
+        name, started = self.open.pop()
+        seconds = timeit.default_timer() - started
+        self.sectionTimes[name] = self.sectionTimes.get(name, 0.0) + seconds
+        if self.output:
+            self.events.append((name, started, seconds))
+
+    def summarize(self):
+        if not self.recent:
+            return []
+        times = sorted(frameSeconds for frameSeconds, sectionTimes in self.recent)
+        summary = ['frame 50%% %.2f, 95%% %.2f, 99%% %.2f, max %.2f ms' % tuple(
+            1000 * value for value in (percentile(times, 0.5), percentile(times, 0.95), percentile(times, 0.99), times[-1]))]
+        for name in self.sections:
+            total = sum(sectionTimes.get(name, 0.0) for frameSeconds, sectionTimes in self.recent)
+            summary.append('    ' * self.sections[name] + '%s %.2f ms' % (name, total / len(self.recent) * 1000))
+        return summary
+
+    def summaryLines(self):
+        return self.lines
+
+    def close(self):
+        print('\n'.join(self.summarize()))
+        if self.output and self.frames:
+            if self.output.endswith('.json'):
+                self.writeTrace()
+            else:
+                self.writeCsv()
+            print('%d frames written to %s' % (len(self.frames), self.output))
+
+    def writeTrace(self):
+        # Chrome's trace event format, with times in microseconds from the first frame
+        zero = self.frames[0][0]
+        events = []
+        for i, (started, frameSeconds, sectionTimes) in enumerate(self.frames):
+            events.append({'name': 'frame %d' % i, 'ph': 'X', 'pid': 0, 'tid': 0,
+                           'ts': (started - zero) * 1e6, 'dur': frameSeconds * 1e6})
+        for name, started, seconds in self.events:
+            events.append({'name': name, 'ph': 'X', 'pid': 0, 'tid': 0,
+                           'ts': (started - zero) * 1e6, 'dur': seconds * 1e6})
+        with open(self.output, 'w') as traceFile:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, traceFile)
+
+    def writeCsv(self):
+        # a row per frame, a column per section, all in milliseconds
+        zero = self.frames[0][0]
+        with open(self.output, 'w') as csvFile:
+            writer = csv.writer(csvFile)
+            writer.writerow(['frame', 'start (ms)', 'frame (ms)'] + [name + ' (ms)' for name in self.sections])
+            for i, (started, frameSeconds, sectionTimes) in enumerate(self.frames):
+                writer.writerow([i, '%.3f' % ((started - zero) * 1000), '%.3f' % (frameSeconds * 1000)] +
+                                ['%.3f' % (sectionTimes.get(name, 0.0) * 1000) for name in self.sections])
+
+profiler = NullProfiler() # swapped for a FrameProfiler when the game is run with --profile
+profileFont = None        # the font drawProfile() uses, made when it's first needed
+profileText = (None, [])  # the summaryLines() drawProfile() last drew, and their text Surfaces
+
+
+class SilentSound(object):
+    """Stands in for a pygame.mixer.Sound when the game runs without sound."""
+    def play(self):
+        pass
+
+swordSound = fireballSound = whirlwindSound = ghostSound = getGemSound = SilentSound()
+
+
+def decodeAsset(filename):
+    """Loads a file from the images or sounds folder, without converting it for the display."""
+    if filename.endswith('.wav'):
+        return pygame.mixer.Sound('sounds/' + filename)
+    return pygame.image.load('images/' + filename)
+
+class AssetLoader(object):
+    """Decodes image and sound files on a pool of background threads, in the order they were
+    preloaded, so the game can show the intro while it loads. Images are converted to the
+    display's format when the game asks for them, by the thread that asks."""
+    def __init__(self, threads=None):
+        # leave a CPU for the main thread to keep the intro scrolling smoothly
+        self.pool = multiprocessing.pool.ThreadPool(threads or max(1, multiprocessing.cpu_count() - 1))
+        self.pending = {} # keys are filenames, values are AsyncResults of the decoded files
+        self.images = {} # keys are filenames, values are converted Surface objects
+        self.waited = 0.0 # seconds the game spent waiting for files that weren't decoded yet
+        self.lock = threading.Lock()
+
+    def preload(self, filenames):
+        """Queues the files to be decoded, after any that were queued before."""
+        with self.lock: # the wave prefetch thread can ask for images too
+            for filename in filenames:
+                if filename not in self.pending:
+                    self.pending[filename] = self.pool.apply_async(decodeAsset, (filename,))
+
+    def ready(self, filenames):
+        """Returns True if all of the files are decoded, or failed to."""
+        return all(filename in self.pending and self.pending[filename].ready() for filename in filenames)
+
+    def get(self, filename):
+        """Returns the decoded file, waiting for it if it isn't decoded yet. Raises whatever
+        decoding it raised."""
+        self.preload([filename])
+        start = timeit.default_timer()
+        try:
+            return self.pending[filename].get()
+        finally:
+            self.waited += timeit.default_timer() - start
+
+    def image(self, filename):
+        if filename in self.images:
+            return self.images[filename]
+        decoded = self.get(filename) # wait for it without holding the lock
+        with self.lock: # so that two threads don't both convert it
+            if filename not in self.images:
+                self.images[filename] = decoded.convert()
+            return self.images[filename]
+
+    def take(self, filename):
+        """Returns the decoded file like get(), but forgets it, so that it doesn't stay in memory
+        after the caller is done with it."""
+        try:
+            return self.get(filename)
+        finally:
+            with self.lock:
+                del self.pending[filename]
+
+    def close(self):
+        self.pool.close()
+
+assets = None # the AssetLoader, once startPreloading() was called
+
+
+ATLAS_PIXELS = 'images/atlas.raw'
+ATLAS_INDEX = 'images/atlas.json'
+
+class SpriteAtlas(object):
+    """The sprite sheets and spell icons packed into one image by --bake, stored as raw RGB
+    pixels so that loading all of them is one sequential read and one convert(). Each image
+    is handed out as a subsurface of the converted atlas."""
+    def __init__(self, rects, size, pixelsFilename=ATLAS_PIXELS):
+        self.rects = rects # keys are image filenames, values are their Rects in the atlas
+        self.size = size
+        self.pixelsFilename = pixelsFilename
+        self.surface = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Reads and converts the atlas, if that wasn't done already, and returns it."""
+        with self.lock: # the AssetLoader and the wave prefetch thread can both ask
+            if self.surface is None:
+                with open(self.pixelsFilename, 'rb') as pixelsFile:
+                    pixels = pixelsFile.read()
+                self.surface = pygame.image.frombuffer(pixels, self.size, 'RGB').convert()
+        return self.surface
+
+    def image(self, filename):
+        return self.load().subsurface(self.rects[filename])
+
+atlas = None # the SpriteAtlas, once openAtlas() found one
+
+def openAtlas():
+    """Reads the atlas index written by --bake, and returns a SpriteAtlas, or None if there is
+    no atlas or any of the images in it were changed after it was baked."""
+    if not (os.path.exists(ATLAS_INDEX) and os.path.exists(ATLAS_PIXELS)):
+        return None
+    with open(ATLAS_INDEX) as indexFile:
+        index = json.load(indexFile)
+    bakedTime = os.path.getmtime(ATLAS_PIXELS)
+    for filename in index['images']:
+        if not os.path.exists('images/' + filename) or os.path.getmtime('images/' + filename) > bakedTime:
+            sys.stderr.write('Not using the sprite atlas, %s changed since it was baked\n' % filename)
+            return None
+    return SpriteAtlas(dict((filename, pygame.Rect(rect)) for filename, rect in index['images'].items()), tuple(index['size']))
+
+BACKGROUND_PIXELS = 'images/backgrounds.raw'
+BACKGROUND_INDEX = 'images/backgrounds.json'
+
+class BackgroundStore(object):
+    """Hands out the level backgrounds, keeping only the current and the next level's Surface
+    objects and letting go of the others. When --bake has written the decoded pixels of every
+    background to one raw file, the file is memory-mapped and a background is made by converting
+    its part of the file, which takes about as long as a blit. Otherwise the next level's PNG is
+    decoded by the AssetLoader ahead of time, or else when its level starts."""
+    def __init__(self, filenames):
+        self.filenames = filenames
+        self.surfaces = {} # keys are indexes into filenames, values are converted Surface objects
+        self.pixels = None # the memory-mapped raw file, if there is a fresh one
+        self.rects = {} # keys are filenames, values are (offset, width, height) in the raw file
+        if os.path.exists(BACKGROUND_INDEX) and os.path.exists(BACKGROUND_PIXELS):
+            with open(BACKGROUND_INDEX) as indexFile:
+                index = json.load(indexFile)
+            bakedTime = os.path.getmtime(BACKGROUND_PIXELS)
+            if all(filename in index and os.path.getmtime('images/' + filename) <= bakedTime for filename in filenames):
+                with open(BACKGROUND_PIXELS, 'rb') as pixelsFile:
+                    self.pixels = memoryview(mmap.mmap(pixelsFile.fileno(), 0, access=mmap.ACCESS_READ))
+                self.rects = index
+            else:
+                sys.stderr.write('Not using %s, the backgrounds changed since it was baked\n' % BACKGROUND_PIXELS)
+
+    def load(self, imageNum):
+        if imageNum not in self.surfaces:
+            filename = self.filenames[imageNum]
+            if self.pixels is not None:
+                offset, width, height = self.rects[filename]
+                image = pygame.image.frombuffer(self.pixels[offset:offset + width * height * 3], (width, height), 'RGB')
+            elif assets is not None:
+                image = assets.take(filename)
+            else:
+                image = pygame.image.load('images/' + filename)
+            self.surfaces[imageNum] = image.convert()
+        return self.surfaces[imageNum]
+
+    def get(self, imageNum):
+        """Returns the background at index imageNum, and gets the one after it ready."""
+        for other in list(self.surfaces):
+            if other not in (imageNum, imageNum + 1):
+                del self.surfaces[other]
+        surface = self.load(imageNum)
+        if imageNum + 1 < len(self.filenames):
+            if self.pixels is not None:
+                self.load(imageNum + 1)
+            elif assets is not None:
+                assets.preload([self.filenames[imageNum + 1]])
+        return surface
+
+def bakeBackgrounds():
+    """Writes the decoded pixels of every level background to BACKGROUND_PIXELS, one after the
+    other, and where each one starts to BACKGROUND_INDEX."""
+    index = {}
+    with open(BACKGROUND_PIXELS, 'wb') as pixelsFile:
+        for filename in BACKGROUNDS:
+            image = pygame.image.load('images/' + filename)
+            index[filename] = (pixelsFile.tell(),) + image.get_size()
+            pixelsFile.write(pygame.image.tostring(image, 'RGB'))
+    with open(BACKGROUND_INDEX, 'w') as indexFile:
+        json.dump(index, indexFile, indent=1, sort_keys=True)
+    print('Baked %d backgrounds, %d KB in %s' % (len(BACKGROUNDS), os.path.getsize(BACKGROUND_PIXELS) // 1024, BACKGROUND_PIXELS))
+
+def atlasFiles():
+    """Returns the image files --bake packs into the atlas: the monster, gem and spell effect
+    sprite sheets and the spell icons."""
+    files = set(stats['image'][0] for stats in MONSTER_STATS.values())
+    files.update(['gems.bmp', 'fireballSpell.bmp', 'whirlwindSpell.bmp', 'ghostSpell.bmp'])
+    files.update(spell[0] for spell in SPELL_STATS)
+    return sorted(files)
+
+def bakeAtlas(maxWidth=1024):
+    """Packs the images from atlasFiles() into rows of an atlas at most maxWidth pixels wide,
+    tallest first, and writes its pixels to ATLAS_PIXELS and where each image is to ATLAS_INDEX."""
+    images = [(filename, pygame.image.load('images/' + filename)) for filename in atlasFiles()]
+    images.sort(key=lambda item: (-item[1].get_height(), item[0]))
+    rects = {}
+    x = y = rowHeight = width = 0
+    for filename, image in images:
+        if x + image.get_width() > maxWidth and x > 0: # start a new row
+            x = 0
+            y += rowHeight
+            rowHeight = 0
+        rects[filename] = pygame.Rect((x, y), image.get_size())
+        x += image.get_width()
+        width = max(width, x)
+        rowHeight = max(rowHeight, image.get_height())
+
+    surface = pygame.Surface((width, y + rowHeight), 0, 24)
+    surface.fill(WHITE) # the gaps are see-through like the sheets' backgrounds
+    for filename, image in images:
+        surface.blit(image, rects[filename])
+    with open(ATLAS_PIXELS, 'wb') as pixelsFile:
+        pixelsFile.write(pygame.image.tostring(surface, 'RGB'))
+    with open(ATLAS_INDEX, 'w') as indexFile:
+        json.dump({'size': surface.get_size(),
+                   'images': dict((filename, list(rect)) for filename, rect in rects.items())}, indexFile, indent=1, sort_keys=True)
+    print('Baked %d images into a %dx%d atlas, %d KB in %s' % (len(images), surface.get_width(), surface.get_height(),
+                                                             os.path.getsize(ATLAS_PIXELS) // 1024, ATLAS_PIXELS))
+
+def loadImage(filename):
+    """Returns images/filename as a Surface converted for the display, from the sprite atlas if
+    it has the image, or else from the AssetLoader if the game is preloading."""
+    if atlas is not None and filename in atlas.rects:
+        return atlas.image(filename)
+    if assets is not None:
+        return assets.image(filename)
+    return pygame.image.load('images/' + filename).convert()
+
+def loadSound(filename):
+    """Returns sounds/filename as a Sound, from the AssetLoader if the game is preloading, or a
+    SilentSound if it can't be loaded."""
+    try:
+        if assets is not None:
+            return assets.get(filename)
+        return pygame.mixer.Sound('sounds/' + filename)
+    except (pygame.error, IOError, OSError) as error:
+        sys.stderr.write('Playing without %s: %s\n' % (filename, error))
+        return SilentSound()
+
+
 # Define some colors
 BLACK      = (   0,   0,   0)
 WHITE      = ( 255, 255, 255)
@@ -230,94 +881,23 @@ RED        = ( 255,   0,   0)
 BLUE       = (   0,   0, 255)
 LIGHT_GRAY = ( 200, 200, 200)
 
-pygame.init()
+# build the next level's monsters on a background thread while the current level is played
+PREFETCH_WAVES = True
 
-# Set the height and width of the screen
-screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
-pygame.display.set_caption("Demon Kingdom")
+# only redraw the parts of the window that changed, instead of all of it every frame
+DIRTY_RENDERING = True
 
-#Loop until the user clicks the close button.
-done = False
-gameover = False
-finalWaveDone = False
-youwin = False
-level = 1
+# reuse the sprites of dead monsters, collected gems and spent spells instead of creating new ones
+POOL_SPRITES = True
 
-# Used to manage how fast the screen updates
-clock=pygame.time.Clock()
-
-#font
-mainFont = pygame.font.Font(None, 38)
-finalWaveText = mainFont.render("Now for the final wave...", 1, BLACK)
-levelText = [mainFont.render(text, 1, BLACK) for text in
-"""Level I - The Dungeon of Stone
-Level II - The Field of the Flowers
-Level III - The Ice Lands
-Level IV - The Demon's Home
-Level V - The Desert
-Level VI - The Caves of the Demon Lord""".split('\n')]
+# the width in pixels of the columns MonsterGroup files monsters under
+BUCKET_WIDTH = 40
 
-introText = ['(click anywhere to skip)',
-             'The Demon of Gar - noth has risen.',
-             'The whole land is in danger!',
-             'You must defeat the demon and his forces.']
-introText = [mainFont.render(text, 1, LIGHT_GRAY) for text in introText]
-helpText = ['(click anywhere to skip)',
-            'Click on creature to attack them.',
-            'Collect gems to cast spells.',
-            'To cast a spell either click the icon',
-            'or use their hot keys:',
-            '1 - Fireball, 2 - Whirlwind, 3 - Summon Ghost.',
-            'Don\'t let any of the monsters get off',
-            'the egde of the screen.']
-helpText = [mainFont.render(text, 1, LIGHT_GRAY) for text in helpText]
-doneText = ['(click anywhere to skip)',
-            'You have defeated The Demon of Gar - noth!',
-            'His forces are destored.',
-            'But you know the land is still in danger...',
-            'The Demon Lord has heard about the defeat',
-            'of The Demon of Gar - noth.',
-            'Knowing this you set out to the land of demons.',
-            'To once and for all destory the demons.']
-doneText = [mainFont.render(text, 1, LIGHT_GRAY) for text in doneText]
-done2Text = ['(click anywhere to skip)',
-            'Once again you have defeated your enemy!',
-            'You are now the hero of the land!']
-done2Text = [mainFont.render(text, 1, LIGHT_GRAY) for text in done2Text]
-
-loading = mainFont.render("Loading...", 1, LIGHT_GRAY)
-
-subFont = pygame.font.Font(None, 24)
-creditsText1 = subFont.render("Game by: Logan Ralston", 1, LIGHT_GRAY)
-
-screen.fill(BLACK)
-screen.blit(loading, [10, 10])
-screen.blit(creditsText1, [10, 58])
-pygame.display.flip()
-
-#sound
-pygame.mixer.init()
-swordSound     = pygame.mixer.Sound("sounds/sword.wav")
-fireballSound  = pygame.mixer.Sound("sounds/fireball.wav")
-whirlwindSound = pygame.mixer.Sound("sounds/whirlwind.wav")
-ghostSound     = pygame.mixer.Sound("sounds/ghost.wav")
-getGemSound    = pygame.mixer.Sound("sounds/pickupGem.wav")
-
-numGems = 0
-
-#background
-background = Background(('background1.png',
-                         'background2.png',
-                         'background3.png',
-                         'background4.png',
-                         'background5.png',
-                         'background6.png'))
-sidebar = Sidebar()
-
-
-#monsters
-gems = pygame.sprite.Group()
-gemTemplate = Gem(screen)
+# the monsters' and spells' speeds are in pixels per tick, so the tick rate sets how fast the game
+# plays; the window can be redrawn more often than that, with the sprites moved smoothly in between
+TICKS_PER_SECOND = 20
+FRAMES_PER_SECOND = 20
+MAX_TICKS_PER_FRAME = 5
 
 MONSTER_STATS = {'bat':        {'image': ('bats.bmp',       30, 29, 5),  'life': 1,  'speed': 3},
                  'demon':      {'image': ('demons.bmp',     49, 68, 6),  'life': 25, 'speed': 2},
@@ -378,236 +958,1338 @@ FINAL_WAVE_MONSTERS = ({'bat':        (7,  -100, -1),  # level 1
                         'demon':      (2,  -60,  -30),
                         'demon lord': (1,  -60,  -30)})
 
+NUM_LEVELS = len(MONSTER_RATIOS)
+
+BACKGROUNDS = ('background1.png',
+               'background2.png',
+               'background3.png',
+               'background4.png',
+               'background5.png',
+               'background6.png')
+
+SOUNDS = ('sword.wav', 'fireball.wav', 'whirlwind.wav', 'ghost.wav', 'pickupGem.wav')
 
-def populateRandomMonsters(level):
-    spriteGroup = pygame.sprite.Group()
-    for i in range(random.randint(RANDOM_MONSTER_AMOUNT[level - 1][0], RANDOM_MONSTER_AMOUNT[level - 1][1])):
-        type = random.choice(MONSTER_RATIOS[level - 1])
-        m = Monster(screen, *MONSTER_STATS[type]["image"])
-        m.set_rect(random.randint(-500, -1), random.randint(25, WINDOW_HEIGHT - 70 - SIDEBAR_HEIGHT))
+#               image filename,      x,   y,               cost, function,    hotkey
+SPELL_STATS = (('fireballIcon.bmp',  100, MAP_HEIGHT + 30, 5,  castFireBall,  '1'),
+               ('whirlwindIcon.bmp', 170, MAP_HEIGHT + 30, 8,  castWhirlWind, '2'),
+               ('ghostIcon.bmp',     240, MAP_HEIGHT + 30, 10, castGhost,     '3'))
+
+
+def populateRandomMonsters(level, rng=random):
+    spriteGroup = MonsterGroup()
+    for i in range(rng.randint(RANDOM_MONSTER_AMOUNT[level - 1][0], RANDOM_MONSTER_AMOUNT[level - 1][1])):
+        type = rng.choice(MONSTER_RATIOS[level - 1])
+        m = spritePool.get(Monster, *MONSTER_STATS[type]["image"])
+        m.set_rect(rng.randint(-500, -1), rng.randint(25, WINDOW_HEIGHT - 70 - SIDEBAR_HEIGHT))
         m.set_speed(MONSTER_STATS[type]["speed"])
         m.set_life(MONSTER_STATS[type]["life"])
         spriteGroup.add(m)
     return spriteGroup
 
-def populateFinalWave(level):
-    spriteGroup = pygame.sprite.Group()
+def populateFinalWave(level, rng=random):
+    spriteGroup = MonsterGroup()
     for monsterType in FINAL_WAVE_MONSTERS[level - 1]:
         numMonsters, min_start_x, max_start_x = FINAL_WAVE_MONSTERS[level - 1][monsterType]
         for i in range(numMonsters):
-            m = Monster(screen, *MONSTER_STATS[monsterType]["image"])
-            m.set_rect(random.randint(min_start_x, max_start_x), random.randint(25, WINDOW_HEIGHT - 85 - SIDEBAR_HEIGHT))
+            m = spritePool.get(Monster, *MONSTER_STATS[monsterType]["image"])
+            m.set_rect(rng.randint(min_start_x, max_start_x), rng.randint(25, WINDOW_HEIGHT - 85 - SIDEBAR_HEIGHT))
             m.set_speed(MONSTER_STATS[monsterType]["speed"])
             m.set_life(MONSTER_STATS[monsterType]["life"])
             spriteGroup.add(m)
     return spriteGroup
 
-monsters = pygame.sprite.Group()
-randomMonsters = [pygame.sprite.Group() for x in range(6)]
-finalWaves = [pygame.sprite.Group() for x in range(6)]
 
-current_time = 1
+class WaveFactory(object):
+    """Creates a level's random monsters and final wave only when that part of
+    the level is about to start, instead of building the whole game up front.
+    With prefetch on, the wave that comes next is built on a background thread
+    while the current one is being played. That thread gets its own Random,
+    seeded from the game's random on the main thread, so it never touches the
+    random module's shared state while the game is using it."""
+    def __init__(self, prefetch=False):
+        self.prefetch = prefetch
+        self.waves = {}   # keys are ('random' or 'final', level), values are sprite Groups
+        self.threads = {} # keys are the same as self.waves, values are prefetching Threads
+        self.lock = threading.Lock()
+
+    def build(self, kind, level, rng=random):
+        if kind == 'random':
+            group = populateRandomMonsters(level, rng)
+        else:
+            group = populateFinalWave(level, rng)
+        with self.lock:
+            self.waves[(kind, level)] = group
+
+    def get(self, kind, level):
+        """Returns the sprite Group for the wave, building it now if it wasn't prefetched."""
+        key = (kind, level)
+        thread = self.threads.pop(key, None)
+        if thread is not None:
+            thread.join()
+        if key not in self.waves:
+            self.build(kind, level)
+        with self.lock:
+            return self.waves.pop(key)
+
+    def startPrefetch(self, kind, level):
+        key = (kind, level)
+        if level > NUM_LEVELS or key in self.waves or key in self.threads:
+            return
+        rng = random.Random(random.getrandbits(32))
+        thread = threading.Thread(target=self.build, args=key + (rng,))
+        thread.daemon = True
+        self.threads[key] = thread
+        thread.start()
+
+    def randomMonsters(self, level):
+        group = self.get('random', level)
+        if self.prefetch:
+            self.startPrefetch('final', level)
+        return group
+
+    def finalWave(self, level):
+        group = self.get('final', level)
+        if self.prefetch:
+            self.startPrefetch('random', level + 1)
+        return group
+
+    def buildAll(self):
+        """Builds every wave of every level right now, the way the game used to at startup."""
+        for level in range(1, NUM_LEVELS + 1):
+            self.build('random', level)
+            self.build('final', level)
+
+
+def setupDisplay(headless=False):
+    global screen, clock, atlas
+    if headless:
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    pygame.init()
+
+    # Set the height and width of the screen
+    screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
+    pygame.display.set_caption("Demon Kingdom")
+
+    # Used to manage how fast the screen updates
+    clock=pygame.time.Clock()
+
+    atlas = openAtlas() # converted for this display when the first image is needed
+
+def loadText():
+    global mainFont, finalWaveText, levelText, introText, helpText, doneText, done2Text, loading, subFont, creditsText1
+    mainFont = pygame.font.Font(None, 38)
+    finalWaveText = mainFont.render("Now for the final wave...", 1, BLACK)
+    levelText = [mainFont.render(text, 1, BLACK) for text in
+"""Level I - The Dungeon of Stone
+Level II - The Field of the Flowers
+Level III - The Ice Lands
+Level IV - The Demon's Home
+Level V - The Desert
+Level VI - The Caves of the Demon Lord""".split('\n')]
+
+    introText = ['(click anywhere to skip)',
+                 'The Demon of Gar - noth has risen.',
+                 'The whole land is in danger!',
+                 'You must defeat the demon and his forces.']
+    introText = [mainFont.render(text, 1, LIGHT_GRAY) for text in introText]
+    helpText = ['(click anywhere to skip)',
+                'Click on creature to attack them.',
+                'Collect gems to cast spells.',
+                'To cast a spell either click the icon',
+                'or use their hot keys:',
+                '1 - Fireball, 2 - Whirlwind, 3 - Summon Ghost.',
+                'Don\'t let any of the monsters get off',
+                'the egde of the screen.']
+    helpText = [mainFont.render(text, 1, LIGHT_GRAY) for text in helpText]
+    doneText = ['(click anywhere to skip)',
+                'You have defeated The Demon of Gar - noth!',
+                'His forces are destored.',
+                'But you know the land is still in danger...',
+                'The Demon Lord has heard about the defeat',
+                'of The Demon of Gar - noth.',
+                'Knowing this you set out to the land of demons.',
+                'To once and for all destory the demons.']
+    doneText = [mainFont.render(text, 1, LIGHT_GRAY) for text in doneText]
+    done2Text = ['(click anywhere to skip)',
+                'Once again you have defeated your enemy!',
+                'You are now the hero of the land!']
+    done2Text = [mainFont.render(text, 1, LIGHT_GRAY) for text in done2Text]
+
+    loading = mainFont.render("Loading...", 1, LIGHT_GRAY)
+
+    subFont = pygame.font.Font(None, 24)
+    creditsText1 = subFont.render("Game by: Logan Ralston", 1, LIGHT_GRAY)
+
+def initMixer():
+    """Starts pygame's sound mixer, and returns False if there's no sound device to start."""
+    try:
+        pygame.mixer.init()
+        return True
+    except pygame.error:
+        return False
+
+def loadSounds():
+    global swordSound, fireballSound, whirlwindSound, ghostSound, getGemSound
+    if not initMixer():
+        return # the sounds stay SilentSounds
+    swordSound, fireballSound, whirlwindSound, ghostSound, getGemSound = [loadSound(filename) for filename in SOUNDS]
+
+def levelAssets(level):
+    """Returns the image files that have to be loaded to play level, its background first."""
+    types = set(MONSTER_RATIOS[level - 1]) | set(FINAL_WAVE_MONSTERS[level - 1])
+    return [BACKGROUNDS[level - 1]] + sorted(set(MONSTER_STATS[type]['image'][0] for type in types))
+
+# the image files that the game screen needs whatever the level
+GAME_ASSETS = ['logo.bmp', 'gems.bmp', 'fireballSpell.bmp', 'whirlwindSpell.bmp', 'ghostSpell.bmp'] + [spell[0] for spell in SPELL_STATS]
+
+def startPreloading():
+    """Starts decoding the game's files on background threads: what level 1 needs first, then
+    the sounds, then the other levels' sprite sheets in order. Nothing before level 1 needs any
+    of them. Returns the files that have to be loaded before level 1 can start."""
+    global assets
+    assets = AssetLoader()
+    firstFiles = notInAtlas(GAME_ASSETS + levelAssets(1)[1:])
+    if not os.path.exists(BACKGROUND_PIXELS):
+        firstFiles.insert(0, BACKGROUNDS[0]) # the later ones are left to the BackgroundStore
+    if atlas is not None:
+        assets.pending[ATLAS_PIXELS] = assets.pool.apply_async(atlas.load) # has all the sprite sheets, so it goes first
+        firstFiles.insert(0, ATLAS_PIXELS)
+    assets.preload(firstFiles)
+    if initMixer():
+        assets.preload(SOUNDS)
+        firstFiles.extend(SOUNDS)
+    for nextLevel in range(2, NUM_LEVELS + 1):
+        assets.preload(notInAtlas(levelAssets(nextLevel)[1:]))
+    return firstFiles
+
+def notInAtlas(filenames):
+    return [filename for filename in filenames if atlas is None or filename not in atlas.rects]
+
+background = None # loaded by loadGame()
+
+def loadGame(prefetch=PREFETCH_WAVES, keepAssets=False):
+    """Sets up the game state for a new game. Only level 1's monsters are created here, the
+    rest are created by the WaveFactory when they are needed. With keepAssets, the background
+    of the last game is reused instead of loading its images again."""
+    global done, gameover, finalWaveDone, youwin, level, numGems, gemsCollected, spellsCast, current_time
+    global background, sidebar, gems, monsters, waves, fireballs, whirlwinds, ghosts, renderer
+
+    #Loop until the user clicks the close button.
+    done = False
+    gameover = False
+    finalWaveDone = False
+    youwin = False
+    level = 1
+    numGems = 0
+    gemsCollected = 0
+    spellsCast = 0
+    current_time = 1
+
+    #background
+    if keepAssets and background is not None:
+        background.changeBackground(0)
+    else:
+        background = Background(BACKGROUNDS)
+    sidebar = Sidebar() # not kept, the spell costs it shows can change between games
+
+    #monsters
+    gems = pygame.sprite.Group()
+    monsters = MonsterGroup()
+    waves = WaveFactory(prefetch)
 
-# add monsters to random and final wave sprite groups for all 6 levels.
-for i in range(6):
-    randomMonsters[i] = populateRandomMonsters(i + 1)
-    finalWaves[i] = populateFinalWave(i + 1)
+    #spells
+    fireballs = pygame.sprite.Group()
+    whirlwinds = pygame.sprite.Group()
+    ghosts = pygame.sprite.Group()
 
-#spells
-fireballs = pygame.sprite.Group()
-whirlwinds = pygame.sprite.Group()
-ghosts = pygame.sprite.Group()
+    if DIRTY_RENDERING:
+        renderer = DirtyRenderer()
+    else:
+        renderer = FlipRenderer()
 
-def draw():
-    screen.fill(WHITE)
-    background.draw()
-    sidebar.draw()
-    for monster in monsters:
-        monster.update(current_time)
+def simulate():
+    """Advances the game by one tick: moves and animates the sprites, lets the spells hit the
+    monsters and sometimes drops a gem. Nothing is drawn."""
+    global current_time
+    current_time += 15
+    for group in (monsters, fireballs, whirlwinds, ghosts):
+        for sprite in group:
+            sprite.prevTopleft = sprite.rect.topleft # where render() interpolates from
+
+    profiler.begin('update monsters')
+    monsters.update(current_time)
+    profiler.end()
+    profiler.begin('update gems')
     for gem in gems:
         gem.update(current_time)
+    profiler.end()
+    profiler.begin('update fireballs')
     for fireball in fireballs:
         fireball.update(current_time)
-        if fireball.rect.bottom >= WINDOW_HEIGHT - SIDEBAR_HEIGHT - 5:
-            fireballs.remove(fireball)
-        hits = pygame.sprite.spritecollide(fireball, monsters, False)
-        if hits:
-            for hit in hits:
-                for i in range(3):
-                    hit.kill()
+        hits = monsters.colliding(fireball)
+        for hit in hits:
+            for i in range(3):
+                hit.kill()
+        if hits or fireball.rect.bottom >= WINDOW_HEIGHT - SIDEBAR_HEIGHT - 5:
             fireballs.remove(fireball)
+            spritePool.release(fireball)
+    profiler.end()
+    profiler.begin('update whirlwinds')
     for whirlwind in whirlwinds:
         whirlwind.update(current_time)
+        hits = monsters.colliding(whirlwind)
+        for hit in hits:
+            if hit.life <= 5:
+                for i in range(hit.life):
+                    hit.kill()
         if whirlwind.rect.left <= 5:
             whirlwinds.remove(whirlwind)
-        hits = pygame.sprite.spritecollide(whirlwind, monsters, False)
-        if hits:
-            for hit in hits:
-                if hit.life <= 5:
-                    for i in range(hit.life):
-                        hit.kill()
+            spritePool.release(whirlwind)
+    profiler.end()
+    profiler.begin('update ghosts')
     for ghost in ghosts:
         ghost.update(current_time)
+        hits = monsters.colliding(ghost)
+        for hit in hits:
+            hit.rect.left -= 140
+            hit.prevTopleft = hit.rect.topleft # knocked back, not walking backwards
+            monsters.moved(hit)
         if ghost.rect.left >= WINDOW_WIDTH - 5:
             ghosts.remove(ghost)
-        hits = pygame.sprite.spritecollide(ghost, monsters, False)
-        if hits:
-            for hit in hits:
-                hit.rect.left -= 140
-    pygame.display.flip()
+            spritePool.release(ghost)
+    profiler.end()
 
-introdone = False
-y = WINDOW_HEIGHT + 26 * 3 + 5
-while not introdone:
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            sys.exit()
-        elif event.type == pygame.MOUSEBUTTONDOWN:
-            introdone = True
-    screen.fill(BLACK)
-    for i in range(len(introText)):
-        screen.blit(introText[i], (10, y - (26 * (len(introText) - 1 - i))))
-    if y <= 0:
-        introdone = True
-    pygame.display.flip()
-    y -= 1
-    clock.tick(20)
-instructionsdone = False
-y = WINDOW_HEIGHT + 26 * 7 + 5
-while not instructionsdone:
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            sys.exit()
-        elif event.type == pygame.MOUSEBUTTONDOWN:
-            instructionsdone = True
-    screen.fill(BLACK)
-    for i in range(len(helpText)):
-        screen.blit(helpText[i], (10, y - 26 * (len(helpText) - 1 - i)))
-    if y <= 0:
-        instructionsdone = True
+    if random.randint(0, 150) == 150:
+        spawnGem(random.randint(20, WINDOW_HEIGHT - 20), random.randint(36, WINDOW_HEIGHT - 36 - SIDEBAR_HEIGHT))
+
+def nextWave():
+    """Sends in the next wave once every monster of the current one is gone. Returns 'final wave'
+    or 'level' when the final wave or the next level starts, 'won' after the last level, and
+    None while monsters are left."""
+    global finalWaveDone, gameover, youwin, level, monsters
+    if len(monsters) > 0:
+        return None
+    if not finalWaveDone:
+        finalWaveDone = True
+        monsters = waves.finalWave(level)
+        return 'final wave'
+    if level == NUM_LEVELS:
+        gameover = True
+        youwin = True
+        return 'won'
+    finalWaveDone = False
+    level += 1
+    for gem in gems.sprites(): # the gems left lying around don't carry over to the next level
+        gem.remove()
+    background.changeBackground(level - 1)
+    monsters = waves.randomMonsters(level)
+    return 'level'
+
+def clickAt(pos):
+    """Does what a mouse click at pos does: attacks the monsters and picks up the gems there,
+    and casts the spell whose icon is there."""
+    global numGems, gemsCollected
+    for monster in monsters.at(pos):
+        swordSound.play()
+        monster.kill()
+    for gem in gems:
+        if gem.rect.collidepoint(pos):
+            gem.remove()
+            numGems += 1
+            gemsCollected += 1
+            getGemSound.play()
+    for spell in sidebar.spells:
+        if spell.rect.collidepoint(pos):
+            castSpell(spell.cost, spell.action)
+
+def castSpell(cost, action):
+    """Casts a spell if the player has the gems for it, and returns True if it was cast."""
+    global numGems, spellsCast
+    if numGems < cost:
+        return False
+    numGems -= cost
+    spellsCast += 1
+    action()
+    return True
+
+def render(alpha=1.0):
+    """Draws the game with every moving sprite alpha of the way from where it was before the
+    last tick to where it is now, and returns the parts of the window that were updated."""
+    profiler.begin('render')
+    moved = []
+    if alpha < 1:
+        for group in (monsters, fireballs, whirlwinds, ghosts):
+            for sprite in group:
+                prev = getattr(sprite, 'prevTopleft', sprite.rect.topleft)
+                if prev != sprite.rect.topleft:
+                    moved.append((sprite, sprite.rect))
+                    sprite.rect = sprite.rect.move(int(round((prev[0] - sprite.rect.left) * (1 - alpha))),
+                                                   int(round((prev[1] - sprite.rect.top) * (1 - alpha))))
+    rects = renderer.draw()
+    for sprite, rect in moved:
+        sprite.rect = rect # the simulation carries on from the real position
+    overlay = drawProfile()
+    if overlay:
+        rects.append(overlay)
+    profiler.end()
+    return rects
+
+def drawProfile():
+    """Draws the profiler's summary of the last frames over the top left corner of the window,
+    and returns the Rect it covered, or None if there is nothing to show."""
+    global profileFont, profileText
+    lines = profiler.summaryLines()
+    if not lines:
+        return None
+    if profileText[0] is not lines:
+        if profileFont is None:
+            profileFont = pygame.font.Font(None, 18)
+        profileText = (lines, [profileFont.render(line, 1, WHITE, BLACK) for line in lines])
+    covered = []
+    for text in profileText[1]:
+        covered.append(screen.blit(text, (0, sum(rect.height for rect in covered))))
+    overlay = covered[0].unionall(covered)
+    pygame.display.update(overlay)
+    renderer.repaint(overlay) # the next frame draws the game there again
+    return overlay
+
+def showMessage(text):
+    """Draws a frame with text in the top left corner and holds it there for a moment."""
+    render()
+    screen.blit(text, [10, 10])
     pygame.display.flip()
-    y -= 1
-    clock.tick(20)
-
-
-draw()
-screen.blit(levelText[0], [10, 10])
-pygame.display.flip()
-pygame.time.delay(1750)
-monsters = randomMonsters[0]
-# - - -- - --- Main Program Loop - - -- - -- - ---
-while not done and not gameover:
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            done=True
-
-        elif event.type == pygame.KEYDOWN:
-            for spell in SPELL_STATS:
-                # cast spells if the hotkey was pressed
-                # spell[5] is hotkey, spell[3] is cost, spell[4] is function
-                if event.key == ord(spell[5]) and numGems >= spell[3]:
-                    numGems -= spell[3]
-                    spell[4]()
-        elif event.type == pygame.MOUSEBUTTONDOWN:
-            for monster in monsters:
-                if monster.rect.collidepoint(event.pos):
-                    swordSound.play()
-                    monster.kill()
-            for gem in gems:
-                if gem.rect.collidepoint(event.pos):
-                    gem.remove()
-                    numGems += 1
-                    getGemSound.play()
-            for spell in sidebar.spells:
-                if spell.rect.collidepoint(event.pos):
-                    if numGems >= spell.cost:
-                        numGems -= spell.cost
-                        spell.action()
-    current_time += 15
+    pygame.time.delay(1750)
+    renderer.invalidate() # the text has to be drawn over in the next frame
 
-    i = len(monsters)
-    if i == 0:
-        if not finalWaveDone:
-            finalWaveDone = True
-            draw()
-            screen.blit(finalWaveText, [10, 10])
-            pygame.display.flip()
-            pygame.time.delay(1750)
-            monsters = finalWaves[level - 1]
-        else:
-            if level == 4:
-                # after level 3, display doneText to the user
-                viewDone = False
-                y = WINDOW_HEIGHT + 27 * 6 + 5
-                while not viewDone:
-                    for event in pygame.event.get():
-                        if event.type == pygame.QUIT:
-                            sys.exit()
-                        elif event.type == pygame.MOUSEBUTTONDOWN:
-                            viewDone = True
-                    screen.fill(BLACK)
-                    for i in range(len(doneText)):
-                        screen.blit(doneText[i], (10, y - 26 * (len(doneText) - 1 - i)))
-                    if y <= 0:
-                        viewDone = True
-                    pygame.display.flip()
-                    y -= 1
-                    clock.tick(20)
-            if level == 6:
+def scrollText(lines, y):
+    """Scrolls the rendered lines of text up a black window, starting with the last line at y,
+    until they reach the top or the player clicks."""
+    while y > 0:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                sys.exit()
+            elif event.type == pygame.MOUSEBUTTONDOWN:
+                return
+        screen.fill(BLACK)
+        for i in range(len(lines)):
+            screen.blit(lines[i], (10, y - 26 * (len(lines) - 1 - i)))
+        pygame.display.flip()
+        y -= 1
+        clock.tick(20)
+
+# the player's inputs, as they are stored in a recording
+INPUT_CLICK = 1 # a mouse click at x, y
+INPUT_SPELL = 2 # a spell's hotkey, x is the spell's index in SPELL_STATS
+INPUT_END   = 3 # the last tick of the recording, followed by the RECORDING_RESULT
+
+RECORDING_MAGIC = b'DKRP'
+RECORDING_VERSION = 1
+RECORDING_HEADER = struct.Struct('<4sBI')   # magic, version, random seed
+RECORDING_INPUT = struct.Struct('<IBhh')    # tick, INPUT_ kind, x, y
+RECORDING_RESULT = struct.Struct('<BiiiBB') # level, gems, gems collected, spells cast, game over, won
+
+def applyInput(kind, x, y):
+    """Does what one of the player's INPUT_ inputs does to the game."""
+    if kind == INPUT_CLICK:
+        clickAt((x, y))
+    elif kind == INPUT_SPELL:
+        castSpell(SPELL_STATS[x][3], SPELL_STATS[x][4])
+
+class InputRecorder(object):
+    """Writes the random seed of a game and the player's clicks and hotkeys during it to a
+    file, each with the number of ticks simulated before it, so that replayRecording() can
+    play exactly the same game again."""
+    def __init__(self, filename, seed):
+        self.file = open(filename, 'wb')
+        self.file.write(RECORDING_HEADER.pack(RECORDING_MAGIC, RECORDING_VERSION, seed))
+
+    def record(self, tick, kind, x=0, y=0):
+        self.file.write(RECORDING_INPUT.pack(tick, kind, x, y))
+
+    def close(self, tick):
+        """Ends the recording after tick ticks, with the state of the game to check the replay against."""
+        self.record(tick, INPUT_END)
+        self.file.write(RECORDING_RESULT.pack(level, numGems, gemsCollected, spellsCast, gameover, youwin))
+        self.file.close()
+
+def readRecording(filename):
+    """Returns the random seed, the list of (tick, kind, x, y) inputs, and the result dictionary
+    (or None, if the game didn't end properly) of a recording made by InputRecorder."""
+    with open(filename, 'rb') as recording:
+        data = recording.read()
+    magic, version, seed = RECORDING_HEADER.unpack_from(data)
+    if magic != RECORDING_MAGIC or version != RECORDING_VERSION:
+        raise ValueError('%s is not a Demon Kingdom recording' % filename)
+
+    inputs = []
+    result = None
+    offset = RECORDING_HEADER.size
+    while offset + RECORDING_INPUT.size <= len(data):
+        tick, kind, x, y = RECORDING_INPUT.unpack_from(data, offset)
+        offset += RECORDING_INPUT.size
+        if kind == INPUT_END:
+            values = RECORDING_RESULT.unpack_from(data, offset)
+            result = dict(zip(('level', 'gems', 'gemsCollected', 'spellsCast', 'gameover', 'youwin'), values))
+            result['ticks'] = tick
+            break
+        inputs.append((tick, kind, x, y))
+    return seed, inputs, result
+
+def main(recordFile=None):
+    """Plays the game in a window. If recordFile is a filename, the game's random seed and
+    inputs are recorded there for replayRecording()."""
+    global done, monsters
+
+    recorder = None
+    if recordFile:
+        seed = random.getrandbits(32)
+        random.seed(seed)
+        recorder = InputRecorder(recordFile, seed)
+
+    setupDisplay()
+    loadText()
+    firstFiles = startPreloading()
+
+    # the intro and instructions only need the text, the rest loads while they scroll by
+    scrollText(introText, WINDOW_HEIGHT + 26 * 3 + 5)
+    scrollText(helpText, WINDOW_HEIGHT + 26 * 7 + 5)
+
+    if not assets.ready(firstFiles):
+        screen.fill(BLACK)
+        screen.blit(loading, [10, 10])
+        screen.blit(creditsText1, [10, 58])
+        pygame.display.flip()
+    loadSounds()
+    # a prefetched wave takes one seed from the random module for its own Random, but a wave
+    # built on the spot takes all of its numbers from the random module, like --replay builds
+    # them, so a recorded game builds them on the spot to use up the same random numbers
+    loadGame(prefetch=PREFETCH_WAVES and recorder is None)
+
+    renderer.invalidate() # the intro and instructions were drawn over the whole window
+    showMessage(levelText[0])
+    monsters = waves.randomMonsters(1)
+    # only draw the latest tick when the window isn't redrawn more often than the game ticks
+    interpolate = FRAMES_PER_SECOND > TICKS_PER_SECOND
+    tickLength = 1000.0 / TICKS_PER_SECOND
+    lag = 0.0
+    gameTicks = 0 # the ticks simulated so far, which is when the inputs are recorded
+    clock.tick()
+    # - - -- - --- Main Program Loop - - -- - -- - ---
+    while not done and not gameover:
+        profiler.startFrame()
+        profiler.begin('events')
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                done=True
+
+            elif event.type == pygame.KEYDOWN:
+                for i, spell in enumerate(SPELL_STATS):
+                    # cast spells if the hotkey was pressed
+                    # spell[5] is hotkey, spell[3] is cost, spell[4] is function
+                    if event.key == ord(spell[5]):
+                        applyInput(INPUT_SPELL, i, 0)
+                        if recorder:
+                            recorder.record(gameTicks, INPUT_SPELL, i)
+            elif event.type == pygame.MOUSEBUTTONDOWN:
+                applyInput(INPUT_CLICK, event.pos[0], event.pos[1])
+                if recorder:
+                    recorder.record(gameTicks, INPUT_CLICK, event.pos[0], event.pos[1])
+        profiler.end()
+
+        # run as many ticks as the time since the last frame calls for, but give up on
+        # catching up after a few so a slow frame can't snowball into slower ones
+        ticks = 0
+        while lag >= tickLength and not gameover:
+            if ticks == MAX_TICKS_PER_FRAME:
+                lag = 0.0
+                break
+            profiler.begin('simulate')
+            simulate()
+            profiler.end()
+            lag -= tickLength
+            ticks += 1
+            gameTicks += 1
+
+            wave = nextWave()
+            if wave == 'final wave':
+                showMessage(finalWaveText)
+            elif wave == 'level':
+                if level == 5:
+                    # after level 4, display doneText to the user
+                    scrollText(doneText, WINDOW_HEIGHT + 27 * 6 + 5)
+                renderer.invalidate() # new background, and maybe the doneText on top of it
+                showMessage(levelText[level - 1])
+            elif wave == 'won':
                 # player has beaten the last level of the game, display done2Text
-                viewDone = False
-                y = WINDOW_HEIGHT + 27 * 2 + 5
-                while not viewDone:
-                    for event in pygame.event.get():
-                        if event.type == pygame.QUIT:
-                            sys.exit()
-                        elif event.type == pygame.MOUSEBUTTONDOWN:
-                            viewDone = True
-                    screen.fill(BLACK)
-                    for j in range(len(done2Text)):
-                        screen.blit(done2Text[j], [10, y - 26 * (len(done2Text) - 1 - j)])
-                    if y <= 0:
-                        viewDone = True
-                    pygame.display.flip()
-                    y -= 1
-                    clock.tick(20)
-                gameover = True
-                youwin = True
+                scrollText(done2Text, WINDOW_HEIGHT + 27 * 2 + 5)
+            if wave:
+                lag = 0.0
+                clock.tick() # the time spent on the message doesn't count as lag
+                profiler.startFrame() # and doesn't count in the frame's time either
                 break
 
-            finalWaveDone = False
-            level += 1
-            gems = pygame.sprite.Group()
-            background.changeBackground(level - 1)
-            draw()
-            screen.blit(levelText[level - 1], [10, 10])
-            pygame.display.flip()
-            pygame.time.delay(1750)
-            monsters = randomMonsters[level - 1]
+        if not gameover:
+            render(lag / tickLength if interpolate else 1.0)
+        profiler.endFrame()
+        lag += clock.tick(FRAMES_PER_SECOND)
 
-    if random.randint(0, 150) == 150:
-        gem = copy.copy(gemTemplate)
-        gem.update(1, False)
-        gem.set_rect(random.randint(20, WINDOW_HEIGHT - 20), random.randint(36, WINDOW_HEIGHT - 36 - SIDEBAR_HEIGHT))
-        gems.add(copy.copy(gem))
-
-    draw()
-    # Limit to 20 frames per second
-    clock.tick(20)
-
-if not done:
-    if youwin:
-        gameOverText = mainFont.render("You Win!", 1, BLACK)
-    else:
-        gameOverText = mainFont.render("You Lose!", 1, BLACK)
-    screen.fill(WHITE)
-    background.draw()
-    sidebar.draw()
-    screen.blit(gameOverText, [10, 10])
-    pygame.display.flip()
-    while not done:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                done=True
+    if recorder:
+        recorder.close(gameTicks)
+    profiler.close()
 
-sys.exit()
\ No newline at end of file
+    if not done:
+        if youwin:
+            gameOverText = mainFont.render("You Win!", 1, BLACK)
+        else:
+            gameOverText = mainFont.render("You Lose!", 1, BLACK)
+        screen.fill(WHITE)
+        background.draw(screen)
+        sidebar.draw(screen)
+        screen.blit(gameOverText, [10, 10])
+        pygame.display.flip()
+        while not done:
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    done=True
+
+    sys.exit()
+
+
+class RandomClicker(object):
+    """A scripted player for headless levels that clicks somewhere random on the map every
+    "interval" ticks."""
+
+    def __init__(self, interval=4):
+        self.interval = interval
+
+    def play(self, tick):
+        if tick % self.interval == 0:
+            clickAt((random.randint(0, MAP_WIDTH - 1), random.randint(0, MAP_HEIGHT - 1)))
+
+
+class ExitClicker(RandomClicker):
+    """A scripted player for headless levels that every "interval" ticks picks up a gem if
+    there is one, or else attacks the monster closest to the exit. Once a monster is over
+    halfway there, it casts the dearest spell it has the gems for."""
+
+    def play(self, tick):
+        if tick % self.interval != 0:
+            return
+        mapRect = pygame.Rect(0, 0, MAP_WIDTH, MAP_HEIGHT)
+        visible = [monster for monster in monsters if monster.rect.colliderect(mapRect)]
+        if visible and max(monster.rect.right for monster in visible) > MAP_WIDTH // 2:
+            for spell in sorted(SPELL_STATS, key=lambda spell: -spell[3]):
+                if castSpell(spell[3], spell[4]):
+                    return
+        if len(gems):
+            clickAt(gems.sprites()[0].rect.center)
+        elif visible:
+            target = max(visible, key=lambda monster: monster.rect.right)
+            clickAt(target.rect.clip(mapRect).center)
+
+POLICIES = {'random': RandomClicker,
+            'exit': ExitClicker}
+
+
+def playLevel(policy, startLevel=1, startGems=0, maxTicks=TICKS_PER_SECOND * 60 * 10):
+    """Plays one level without a window, delays or scrolling text, with the policy object
+    choosing the clicks and spells, until the level is survived or lost or maxTicks ticks have
+    been simulated. Returns a dictionary of the results."""
+    global level, numGems, monsters
+    if pygame.display.get_surface() is None:
+        setupDisplay(headless=True)
+    loadGame(prefetch=False, keepAssets=True)
+    level = startLevel
+    numGems = startGems
+    monsters = waves.randomMonsters(level)
+
+    start = timeit.default_timer()
+    tick = 0
+    survived = False
+    while not gameover and tick < maxTicks:
+        policy.play(tick)
+        simulate()
+        tick += 1
+        if finalWaveDone and len(monsters) == 0:
+            survived = True
+            break
+        nextWave()
+    elapsed = timeit.default_timer() - start
+
+    return {'ticks': tick,
+            'seconds': elapsed,
+            'ticksPerSecond': tick / elapsed if elapsed else float('inf'),
+            'survived': survived,
+            'gemsCollected': gemsCollected,
+            'gemsLeft': numGems,
+            'spellsCast': spellsCast}
+
+
+def replayRecording(filename, draw=False):
+    """Plays a game recorded by main() again without a window, delays or scrolling text,
+    applying the recorded inputs at the same ticks, and times every tick. With draw, every
+    tick is also drawn in a hidden window. Returns a dictionary of the results, with 'matches'
+    True if the game ended in the same state as the recording."""
+    global monsters
+    seed, inputs, recorded = readRecording(filename)
+    if pygame.display.get_surface() is None:
+        setupDisplay(headless=True)
+    random.seed(seed)
+    loadGame(prefetch=False)
+    monsters = waves.randomMonsters(1)
+
+    lastTick = recorded['ticks'] if recorded else (inputs[-1][0] if inputs else 0)
+    tickTimes = [] # the seconds each tick took
+    tick = nextInput = 0
+    while True:
+        while nextInput < len(inputs) and inputs[nextInput][0] == tick:
+            applyInput(*inputs[nextInput][1:])
+            nextInput += 1
+        if tick == lastTick or gameover:
+            break
+        profiler.startFrame()
+        start = timeit.default_timer()
+        profiler.begin('simulate')
+        simulate()
+        nextWave()
+        profiler.end()
+        if draw:
+            render()
+        tickTimes.append(timeit.default_timer() - start)
+        profiler.endFrame()
+        tick += 1
+
+    elapsed = sum(tickTimes)
+    slowest = sorted(range(len(tickTimes)), key=lambda i: -tickTimes[i])[:5]
+    state = {'ticks': tick, 'level': level, 'gems': numGems, 'gemsCollected': gemsCollected,
+             'spellsCast': spellsCast, 'gameover': int(gameover), 'youwin': int(youwin)}
+    return {'ticks': tick,
+            'seconds': elapsed,
+            'ticksPerSecond': tick / elapsed if elapsed else float('inf'),
+            'tickTimes': tickTimes,
+            'slowestTicks': [(i, tickTimes[i]) for i in slowest],
+            'state': state,
+            'recorded': recorded,
+            'matches': recorded == state}
+
+def percentile(values, fraction):
+    # nearest rank: e.g. fraction 0.99 of 200 tick times is the 199th fastest one
+    ranked = sorted(values)
+    return ranked[min(len(ranked) - 1, int(fraction * len(ranked)))]
+
+
+# the module-level tables that applySettings() can change
+TUNABLE_TABLES = ('MONSTER_STATS', 'RANDOM_MONSTER_AMOUNT', 'FINAL_WAVE_MONSTERS', 'SPELL_STATS')
+
+def applySettings(settings):
+    """Changes the game's balance tables. settings is a dictionary whose keys are one of:
+        life.<monster>, speed.<monster>  - a monster's stats in MONSTER_STATS
+        minAmount.<level>, maxAmount.<level>  - a level's RANDOM_MONSTER_AMOUNT
+        final.<level>.<monster>  - how many of a monster are in a level's final wave
+        cost.<spell>  - a spell's cost in gems, where spell is fireball, whirlwind or ghost
+    and whose values are ints. The tables are replaced, not changed in place, and the old ones
+    are returned so restoreSettings() can put them back."""
+    global MONSTER_STATS, RANDOM_MONSTER_AMOUNT, FINAL_WAVE_MONSTERS, SPELL_STATS
+    saved = dict((name, globals()[name]) for name in TUNABLE_TABLES)
+    for name, value in settings.items():
+        field, _, key = name.partition('.')
+        value = int(value)
+        if field in ('life', 'speed') and key in MONSTER_STATS:
+            MONSTER_STATS = dict(MONSTER_STATS)
+            MONSTER_STATS[key] = dict(MONSTER_STATS[key])
+            MONSTER_STATS[key][field] = value
+        elif field in ('minAmount', 'maxAmount') and key.isdigit() and 1 <= int(key) <= NUM_LEVELS:
+            amounts = list(RANDOM_MONSTER_AMOUNT)
+            low, high = amounts[int(key) - 1]
+            amounts[int(key) - 1] = (value, high) if field == 'minAmount' else (low, value)
+            RANDOM_MONSTER_AMOUNT = tuple(amounts)
+        elif field == 'final' and key.partition('.')[0].isdigit() and 1 <= int(key.partition('.')[0]) <= NUM_LEVELS:
+            levelNum, _, monster = key.partition('.')
+            if monster not in MONSTER_STATS:
+                raise ValueError('Unknown setting: ' + name)
+            finalWaves = list(FINAL_WAVE_MONSTERS)
+            wave = dict(finalWaves[int(levelNum) - 1])
+            wave[monster] = (value,) + wave.get(monster, (0, -60, -30))[1:]
+            finalWaves[int(levelNum) - 1] = wave
+            FINAL_WAVE_MONSTERS = tuple(finalWaves)
+        elif field == 'cost' and key + 'Icon.bmp' in [spell[0] for spell in SPELL_STATS]:
+            SPELL_STATS = tuple(spell[:3] + (value,) + spell[4:] if spell[0] == key + 'Icon.bmp' else spell
+                                for spell in SPELL_STATS)
+        else:
+            raise ValueError('Unknown setting: ' + name)
+    for low, high in RANDOM_MONSTER_AMOUNT:
+        if low > high:
+            globals().update(saved)
+            raise ValueError('A level\'s minAmount is more than its maxAmount')
+    return saved
+
+def restoreSettings(saved):
+    """Puts back the balance tables that applySettings() returned."""
+    globals().update(saved)
+
+
+def playSweepTrial(job):
+    """Plays one headless level for runSweep() in a worker process."""
+    configNum, settings, playedLevel, seed, policyName, interval, maxTicks = job
+    saved = applySettings(settings)
+    try:
+        random.seed(seed)
+        result = playLevel(POLICIES[policyName](interval), playedLevel, 0, maxTicks)
+    finally:
+        restoreSettings(saved)
+    result['config'] = configNum
+    result['level'] = playedLevel
+    return result
+
+def runSweep(variations, levels=range(1, NUM_LEVELS + 1), trials=20, policyName='exit', interval=4,
+             maxTicks=TICKS_PER_SECOND * 60 * 10, firstSeed=0, processes=None):
+    """Plays trials headless games of each level for every combination of the settings in
+    variations, a list of (setting name, list of values) pairs, spread across a pool of processes
+    (one per CPU by default). Every combination plays the same seeds, firstSeed, firstSeed + 1,
+    and so on, so they are compared on the same waves of monsters. Returns a list of rows, one
+    per combination and level, of the setting values followed by the results."""
+    names = [name for name, values in variations]
+    configs = [dict(zip(names, values)) for values in itertools.product(*[values for name, values in variations])]
+    jobs = [(configNum, config, playedLevel, firstSeed + trial, policyName, interval, maxTicks)
+            for configNum, config in enumerate(configs) for playedLevel in levels for trial in range(trials)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(playSweepTrial, jobs, chunksize=max(1, len(jobs) // (4 * (processes or multiprocessing.cpu_count()))))
+    finally:
+        pool.close()
+        pool.join()
+
+    rows = []
+    for configNum, config in enumerate(configs):
+        for playedLevel in levels:
+            played = [result for result in results if result['config'] == configNum and result['level'] == playedLevel]
+            wins = sum(result['survived'] for result in played)
+            rows.append([config[name] for name in names] + [
+                playedLevel, len(played), wins, wins / float(len(played)),
+                sum(result['ticks'] for result in played) / float(len(played)),
+                sum(result['gemsCollected'] for result in played) / float(len(played)),
+                sum(result['spellsCast'] for result in played) / float(len(played))])
+    return rows
+
+SWEEP_COLUMNS = ('level', 'trials', 'wins', 'winRate', 'meanTicks', 'meanGemsCollected', 'meanSpellsCast')
+
+def writeSweep(filename, variations, rows):
+    """Writes runSweep()'s rows to a CSV file with a header row."""
+    with open(filename, 'w') as sweepFile:
+        writer = csv.writer(sweepFile)
+        writer.writerow([name for name, values in variations] + list(SWEEP_COLUMNS))
+        for row in rows:
+            writer.writerow(['%.3f' % value if isinstance(value, float) else value for value in row])
+
+
+def benchmarkStartup(trials=5):
+    """Prints the time from starting to load the game until the first frame of level 1 is
+    drawn, when every level's monsters are built up front versus only level 1's."""
+    global spriteSheets, monsters
+    setupDisplay(headless=True)
+    loadText()
+    for label, eager in (('all levels at startup', True), ('lazy waves', False)):
+        times = []
+        for trial in range(trials):
+            spriteSheets = SpriteSheetCache() # start every trial with nothing decoded
+            start = timeit.default_timer()
+            loadGame(prefetch=False)
+            if eager:
+                waves.buildAll()
+            monsters = waves.randomMonsters(1)
+            render()
+            times.append(timeit.default_timer() - start)
+            numMonsters = len(monsters) + sum(len(group) for group in waves.waves.values())
+        print('%-22s time to first frame: best %7.1f ms, mean %7.1f ms (%d monsters built)' % (label, min(times) * 1000, sum(times) / len(times) * 1000, numMonsters))
+
+def benchmarkAnimation(numMonsters=2000, numFrames=200):
+    """Prints the time per frame and Surface objects created per frame to animate numMonsters
+    monsters with the precomputed frame tables, compared to cutting a new subsurface whenever
+    a monster's frame changes."""
+    setupDisplay(headless=True)
+    sprites = []
+    for i in range(numMonsters):
+        type = random.choice(MONSTER_RATIOS[NUM_LEVELS - 1])
+        sprites.append(Monster(screen, *MONSTER_STATS[type]['image']))
+
+    def sliceEveryFrame(sprite, current_time, rate=30):
+        # this is what AnimatedSprite.update() did before the frame tables
+        if current_time > sprite.last_time + rate:
+            sprite.frame += 1
+            if sprite.frame > sprite.last_frame:
+                sprite.frame = 0
+            sprite.last_time = current_time
+            frame_x = (sprite.frame % sprite.columns) * sprite.frame_width
+            frame_y = (sprite.frame // sprite.columns) * sprite.frame_height
+            sprite.image = sprite.master_image.subsurface((frame_x, frame_y, sprite.frame_width, sprite.frame_height))
+
+    for label, animate in (('subsurface per frame', sliceEveryFrame), ('frame tables', AnimatedSprite.update)):
+        current_time = 1
+        for sprite in sprites:
+            sprite.frame = sprite.last_time = 0
+        # Both ways are counted the same way: a sprite image that isn't one of the Surfaces that
+        # existed before the run was created during it. The old and new Surfaces are all kept
+        # until the run is over, so a freed Surface's id can't be handed to a later one.
+        oldSurfaces = dict((id(image), image) for sprite in sprites for image in sprite.frames + (sprite.image,))
+        newSurfaces = {}
+        elapsed = 0
+        for frame in range(numFrames):
+            current_time += 15
+            start = timeit.default_timer()
+            for sprite in sprites:
+                animate(sprite, current_time)
+            elapsed += timeit.default_timer() - start
+            for sprite in sprites:
+                if id(sprite.image) not in oldSurfaces:
+                    newSurfaces[id(sprite.image)] = sprite.image
+        print('%-20s %6.2f ms/frame, %6.1f Surfaces created/frame' % (label, elapsed / numFrames * 1000, len(newSurfaces) / float(numFrames)))
+        del oldSurfaces, newSurfaces
+
+def benchmarkRendering(levels=(1, NUM_LEVELS), numFrames=300):
+    """Prints the time per frame and how much of the window gets updated per frame with the
+    FlipRenderer and the DirtyRenderer, while the levels' monsters walk across the screen and
+    spells are cast."""
+    global DIRTY_RENDERING, monsters
+    setupDisplay(headless=True)
+    loadText()
+    windowArea = float(WINDOW_WIDTH * WINDOW_HEIGHT)
+    for benchmarkLevel in levels:
+        for dirtyRendering in (False, True):
+            DIRTY_RENDERING = dirtyRendering
+            random.seed(benchmarkLevel) # both renderers draw the same game
+            loadGame(prefetch=False)
+            monsters = waves.randomMonsters(benchmarkLevel)
+            for i in range(10):
+                spawnGem(random.randint(20, WINDOW_HEIGHT - 20), random.randint(36, WINDOW_HEIGHT - 36 - SIDEBAR_HEIGHT))
+
+            updatedArea = 0
+            start = timeit.default_timer()
+            for frame in range(numFrames):
+                if frame % 40 == 0:
+                    random.choice((castFireBall, castWhirlWind, castGhost))()
+                simulate()
+                rects = render()
+                updatedArea += sum(rect.width * rect.height for rect in rects)
+            elapsed = timeit.default_timer() - start
+            print('level %d %-14s %6.2f ms/frame, %5.1f%% of the window updated/frame' % (
+                benchmarkLevel, type(renderer).__name__, elapsed / numFrames * 1000, updatedArea / windowArea / numFrames * 100))
+
+def benchmarkCollisions(monsterCounts=(50, 500, 5000), numEffects=50, numClicks=10, numTicks=100):
+    """Prints the time per tick to move the monsters, find the ones each of numEffects spell
+    effects touches and the ones under numClicks mouse clicks, with a MonsterGroup compared to
+    testing every monster in a plain sprite group."""
+    global monsters
+    setupDisplay(headless=True)
+    for numMonsters in monsterCounts:
+        for groupClass in (pygame.sprite.Group, MonsterGroup):
+            random.seed(numMonsters) # both groups get the same monsters, spells and clicks
+            monsters = groupClass()
+            for i in range(numMonsters):
+                type = random.choice(MONSTER_RATIOS[NUM_LEVELS - 1])
+                monster = Monster(screen, *MONSTER_STATS[type]['image'])
+                monster.set_rect(random.randint(-500, WINDOW_WIDTH - 100), random.randint(25, WINDOW_HEIGHT - 70 - SIDEBAR_HEIGHT))
+                monster.set_speed(MONSTER_STATS[type]['speed'])
+                monster.set_life(MONSTER_STATS[type]['life'])
+                monsters.add(monster)
+            effects = []
+            for i in range(numEffects):
+                effect = SpellEffect(screen, *random.choice((('fireballSpell.bmp', 16, 48, 6),
+                                                             ('whirlwindSpell.bmp', 29, 32, 2),
+                                                             ('ghostSpell.bmp', 32, 32, 2))))
+                effect.set_rect(random.randint(0, WINDOW_WIDTH), random.randint(0, MAP_HEIGHT))
+                effects.append(effect)
+            clicks = [(random.randint(0, WINDOW_WIDTH), random.randint(0, MAP_HEIGHT)) for i in range(numClicks * numTicks)]
+
+            hits = 0
+            current_time = 1
+            start = timeit.default_timer()
+            for tick in range(numTicks):
+                current_time += 15
+                monsters.update(current_time)
+                if groupClass is MonsterGroup:
+                    for effect in effects:
+                        hits += len(monsters.colliding(effect))
+                    for pos in clicks[tick * numClicks:(tick + 1) * numClicks]:
+                        hits += len(monsters.at(pos))
+                else:
+                    for effect in effects:
+                        hits += len(pygame.sprite.spritecollide(effect, monsters, False))
+                    for pos in clicks[tick * numClicks:(tick + 1) * numClicks]:
+                        hits += len([monster for monster in monsters if monster.rect.collidepoint(pos)])
+            elapsed = timeit.default_timer() - start
+            print('%5d monsters %-12s %7.3f ms/tick, %8d hits' % (numMonsters, groupClass.__name__, elapsed / numTicks * 1000, hits))
+
+def benchmarkPooling(numTicks=3000, benchmarkLevel=4):
+    """Plays numTicks ticks of a level that refills with monsters as fast as spells are cast at
+    them and gems are picked up, and prints the sprites created, garbage collections and time
+    per tick with and without the SpritePool."""
+    global POOL_SPRITES, spritePool, monsters, numGems
+    setupDisplay(headless=True)
+    for pooling in (False, True):
+        POOL_SPRITES = pooling
+        spritePool = SpritePool()
+        random.seed(benchmarkLevel) # both play the same game
+        loadGame(prefetch=False, keepAssets=True)
+        collections = sum(generation['collections'] for generation in gc.get_stats())
+        start = timeit.default_timer()
+        for tick in range(numTicks):
+            if len(monsters) == 0:
+                monsters = populateRandomMonsters(benchmarkLevel)
+            for monster in monsters.sprites():
+                if monster.rect.left >= WINDOW_WIDTH: # got away, but the benchmark isn't over
+                    monsters.remove(monster)
+                    spritePool.release(monster)
+            numGems = 100
+            castSpell(*SPELL_STATS[tick % len(SPELL_STATS)][3:5])
+            for gem in gems.sprites():
+                clickAt(gem.rect.center)
+            simulate()
+        elapsed = timeit.default_timer() - start
+        collections = sum(generation['collections'] for generation in gc.get_stats()) - collections
+        stats = spritePool.stats()
+        print('%-10s %6.3f ms/tick, %6d sprites created, %5d reused, high water %4d, %3d garbage collections' % (
+            'pooled' if pooling else 'not pooled', elapsed / numTicks * 1000, stats['created'], stats['reused'],
+            stats['high water'], collections))
+
+def benchmarkLoading(trials=5):
+    """Prints the time until the intro can be clicked (time to interactive) and until level 1
+    is ready to play, when the game loads everything before the intro compared to preloading
+    on background threads while the intro is shown and skipped right away, with and without
+    the sprite atlas. Then prints the time to load every sprite sheet with and without it."""
+    global assets, atlas, spriteSheets
+    setupDisplay(headless=True)
+    loadText()
+    modes = [('loading before intro', False, False), ('preloading', True, False)]
+    if openAtlas() is not None:
+        modes.append(('preloading with atlas', True, True))
+    for label, preloading, useAtlas in modes:
+        interactive, playable, everything = [], [], []
+        for trial in range(trials):
+            assets = None
+            atlas = openAtlas() if useAtlas else None
+            spriteSheets = SpriteSheetCache()
+            start = timeit.default_timer()
+            if preloading:
+                startPreloading()
+            else:
+                loadSounds()
+                loadGame(prefetch=False)
+            screen.fill(BLACK) # the first frame of the intro
+            screen.blit(introText[-1], (10, WINDOW_HEIGHT))
+            pygame.display.flip()
+            interactive.append(timeit.default_timer() - start)
+            if preloading:
+                loadSounds()
+                loadGame(prefetch=False)
+            playable.append(timeit.default_timer() - start)
+            if preloading:
+                for result in list(assets.pending.values()):
+                    result.wait()
+                assets.close()
+            everything.append(timeit.default_timer() - start)
+        print('%-22s time to interactive %6.1f ms, level 1 ready %6.1f ms%s' % (
+            label, min(interactive) * 1000, min(playable) * 1000,
+            ', every level decoded %6.1f ms' % (min(everything) * 1000) if preloading else ''))
+    assets = None
+
+    for useAtlas in (False, True)[:len(modes) - 1]:
+        times = []
+        for trial in range(trials):
+            atlas = openAtlas() if useAtlas else None
+            start = timeit.default_timer()
+            for filename in atlasFiles():
+                loadImage(filename)
+            times.append(timeit.default_timer() - start)
+        print('%-22s %d sprite sheets and icons loaded in %6.1f ms' % (
+            'from the atlas' if useAtlas else 'from separate files', len(atlasFiles()), min(times) * 1000))
+    atlas = openAtlas()
+
+def benchmarkBackgrounds(rounds=5):
+    """Prints how long changeBackground() takes when switching through every level, and how
+    much memory the background Surfaces it keeps take up at most, with the backgrounds decoded from
+    the PNGs when their level starts, decoded ahead by the AssetLoader, or converted from the
+    raw file written by --bake when there is one."""
+    global assets
+    setupDisplay(headless=True)
+    modes = [('PNG at switch', False), ('PNG ahead', True)]
+    if os.path.exists(BACKGROUND_PIXELS):
+        modes = [('baked raw file', False)]
+        print('(run without %s to compare with decoding the PNGs)' % BACKGROUND_PIXELS)
+    for label, preloading in modes:
+        times = []
+        mostKept = 0 # bytes
+        for trial in range(rounds):
+            assets = AssetLoader() if preloading else None
+            background = Background(BACKGROUNDS)
+            for imageNum in range(1, len(BACKGROUNDS)):
+                if preloading:
+                    time.sleep(0.05) # playing the level, while the next background decodes
+                start = timeit.default_timer()
+                background.changeBackground(imageNum)
+                times.append(timeit.default_timer() - start)
+                kept = background.store.surfaces.values()
+                mostKept = max(mostKept, sum(surface.get_width() * surface.get_height() * surface.get_bytesize() for surface in kept))
+            if preloading:
+                assets.close()
+        print('%-15s changeBackground() mean %6.2f ms, worst %6.2f ms; at most %d KB of backgrounds kept' % (
+            label, sum(times) / len(times) * 1000, max(times) * 1000, mostKept // 1024))
+    assets = None
+
+BENCHMARKS = {'startup': benchmarkStartup,
+              'rendering': benchmarkRendering,
+              'animation': benchmarkAnimation,
+              'collisions': benchmarkCollisions,
+              'pooling': benchmarkPooling,
+              'loading': benchmarkLoading,
+              'backgrounds': benchmarkBackgrounds}
+
+
+def suiteSprites(cls, numSprites, numFrames=50):
+    """Returns the seconds to update numSprites sprites of every kind of monster once, with
+    cls.update() (an AnimatedSprite only animates, a Monster also walks)."""
+    random.seed(numSprites)
+    sprites = []
+    for i in range(numSprites):
+        type = random.choice(MONSTER_RATIOS[NUM_LEVELS - 1])
+        sprite = cls(screen, *MONSTER_STATS[type]['image'])
+        sprite.set_rect(random.randint(-3000, -100), random.randint(25, WINDOW_HEIGHT - 70 - SIDEBAR_HEIGHT))
+        if cls is Monster:
+            sprite.set_speed(MONSTER_STATS[type]['speed']) # too far left to reach the right edge in numFrames
+        sprites.append(sprite)
+    current_time = 1
+    start = timeit.default_timer()
+    for frame in range(numFrames):
+        current_time += 15
+        for sprite in sprites:
+            sprite.update(current_time)
+    return (timeit.default_timer() - start) / numFrames
+
+def suitePopulate(rounds=10):
+    """Returns the seconds for populateRandomMonsters() to build every level's random monsters,
+    starting with an empty SpritePool but the sprite sheets already loaded."""
+    global spritePool
+    random.seed(1)
+    elapsed = 0
+    for round in range(rounds):
+        spritePool = SpritePool()
+        start = timeit.default_timer()
+        for populateLevel in range(1, NUM_LEVELS + 1):
+            populateRandomMonsters(populateLevel)
+        elapsed += timeit.default_timer() - start
+    spritePool = SpritePool()
+    return elapsed / rounds
+
+def suiteDraw(dirtyRendering, numEffects=300, numFrames=300):
+    """Returns the seconds per renderer.draw() call with the FlipRenderer or the DirtyRenderer,
+    for level 1's monsters and numEffects spell effects spread over the map and animating."""
+    global DIRTY_RENDERING, monsters
+    dirty, DIRTY_RENDERING = DIRTY_RENDERING, dirtyRendering
+    random.seed(numEffects)
+    loadGame(prefetch=False, keepAssets=True)
+    DIRTY_RENDERING = dirty
+    monsters = waves.randomMonsters(1)
+    for monster in monsters:
+        monster.set_rect(random.randint(0, WINDOW_WIDTH - 100), monster.rect.top)
+    for i in range(numEffects):
+        group, args = random.choice(((fireballs, ('fireballSpell.bmp', 16, 48, 6)),
+                                     (whirlwinds, ('whirlwindSpell.bmp', 29, 32, 2)),
+                                     (ghosts, ('ghostSpell.bmp', 32, 32, 2))))
+        effect = spritePool.get(SpellEffect, *args)
+        effect.set_rect(random.randint(0, WINDOW_WIDTH - 30), random.randint(0, MAP_HEIGHT - 50))
+        group.add(effect)
+    renderer.draw() # the first frame draws the whole window
+    elapsed = 0
+    current_time = 1
+    for frame in range(numFrames):
+        current_time += 15
+        for group in (monsters, fireballs, whirlwinds, ghosts):
+            for sprite in group:
+                sprite.update(current_time, False)
+        start = timeit.default_timer()
+        renderer.draw()
+        elapsed += timeit.default_timer() - start
+    return elapsed / numFrames
+
+# what --suite times: each entry is its name, what one of its times is for (a frame, a game),
+# and the function that returns that time in seconds
+SUITE = [('AnimatedSprite.update, 1k sprites',     'frame', lambda: suiteSprites(AnimatedSprite, 1000, 500)),
+         ('AnimatedSprite.update, 10k sprites',    'frame', lambda: suiteSprites(AnimatedSprite, 10000)),
+         ('Monster.update, 1k sprites',            'frame', lambda: suiteSprites(Monster, 1000, 500)),
+         ('Monster.update, 10k sprites',           'frame', lambda: suiteSprites(Monster, 10000)),
+         ('populateRandomMonsters, every level',   'game',  suitePopulate),
+         ('FlipRenderer.draw, 300 spell effects',  'frame', lambda: suiteDraw(False)),
+         ('DirtyRenderer.draw, 300 spell effects', 'frame', lambda: suiteDraw(True))]
+
+BASELINES = 'benchmark_baselines.json' # in the game's folder, like the images
+
+def bestOf(benchmark, runs):
+    # the quickest run is the one the least disturbed by other programs; garbage collections
+    # would land in some runs and not others, so they are put off until between runs
+    times = []
+    for run in range(runs):
+        gc.collect()
+        gc.disable()
+        try:
+            times.append(benchmark())
+        finally:
+            gc.enable()
+    return min(times)
+
+def showTime(seconds, unit):
+    if seconds >= 0.001:
+        return '%.3f ms/%s' % (seconds * 1000, unit)
+    return '%.3f us/%s' % (seconds * 1e6, unit)
+
+def machineInfo():
+    # saved with the baselines: times from another Python, pygame or kind of computer won't compare
+    return {'python': platform.python_version(),
+            'pygame': pygame.version.ver,
+            'machine': platform.machine(),
+            'system': platform.system()}
+
+def loadBaselines(baselineFile):
+    if not os.path.exists(baselineFile):
+        return {}
+    with open(baselineFile) as stored:
+        saved = json.load(stored)
+    if saved.get('environment') != machineInfo():
+        print('(baselines from %s, so the times may not compare)' % ', '.join(
+            '%s %s' % item for item in sorted(saved.get('environment', {}).items())))
+    return saved.get('times', {})
+
+def saveBaselines(baselineFile, times):
+    # the file is laid out like Square Shooter's, an environment and a times dictionary, so that
+    # both games' baselines can be read the same way
+    with open(baselineFile, 'w') as stored:
+        stored.write(json.dumps({'environment': machineInfo(), 'times': times}, indent=2) + '\n')
+    print('wrote %d new baselines to %s' % (len(times), baselineFile))
+
+def runSuite(baselineFile=BASELINES, threshold=0.3, save=False, runs=5):
+    """Times everything in SUITE (best of several runs) against the baselines in baselineFile.
+    Returns the names of the ones that got slower by more than threshold, e.g. 0.3 for 30%.
+    With save, the new times replace the baselines and nothing is compared."""
+    setupDisplay(headless=True)
+    loadText()
+    baselines = {} if save else loadBaselines(baselineFile)
+
+    times = collections.OrderedDict()
+    slower = []
+    print('%-40s %16s %16s %8s' % ('benchmark', 'baseline', 'now', 'change'))
+    for name, unit, benchmark in SUITE:
+        times[name] = bestOf(benchmark, runs)
+        if name not in baselines:
+            print('%-40s %16s %16s' % (name, '-', showTime(times[name], unit)))
+            continue
+        change = times[name] / baselines[name] - 1
+        flag = ''
+        if change > threshold:
+            slower.append(name)
+            flag = '  REGRESSION'
+        print('%-40s %16s %16s %+7.1f%%%s' % (name, showTime(baselines[name], unit), showTime(times[name], unit), change * 100, flag))
+
+    if save:
+        saveBaselines(baselineFile, times)
+    elif slower:
+        print('slower than their baselines by over %d%%: %s' % (threshold * 100, '; '.join(slower)))
+    return slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Demon Kingdom')
+    parser.add_argument('--benchmark', choices=sorted(BENCHMARKS), help='run a benchmark without a window instead of playing')
+    parser.add_argument('--suite', action='store_true',
+                        help='time the SUITE benchmarks without a window and exit with status 1 if any regressed from its baseline')
+    parser.add_argument('--save-baselines', action='store_true', help="with --suite, replace the baselines with this run's times")
+    parser.add_argument('--baselines', default=BASELINES, metavar='FILE',
+                        help='read the --suite baselines from FILE, or write them there with --save-baselines')
+    parser.add_argument('--threshold', type=float, default=0.3,
+                        help='the fraction a --suite time can grow past its baseline before it counts as a regression (default: 0.3)')
+    parser.add_argument('--bake', action='store_true',
+                        help='pack the sprite sheets into %s and decode the backgrounds into %s, which the game loads faster than the separate images' % (ATLAS_PIXELS, BACKGROUND_PIXELS))
+    parser.add_argument('--record', metavar='FILE', help='record the random seed and inputs of the game to FILE, for --replay')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='play a game recorded with --record again without a window as fast as possible and print how long its ticks took')
+    parser.add_argument('--render', action='store_true', help='also draw every tick of --replay in a hidden window')
+    parser.add_argument('--profile', action='store_true', help='time the phases of every frame and show them over the game')
+    parser.add_argument('--profile-output', metavar='FILE',
+                        help='with --profile, write every frame\'s phase times to FILE, as a Chrome trace if it ends in .json or else as CSV')
+    parser.add_argument('--headless', type=int, default=0, metavar='TRIALS',
+                        help='play a level this many times without a window as fast as possible and print the results')
+    parser.add_argument('--policy', choices=sorted(POLICIES), default='exit', help='the scripted player for headless levels')
+    parser.add_argument('--interval', type=int, default=4, help='the ticks between the scripted player\'s clicks')
+    parser.add_argument('--level', type=int, action='append', choices=range(1, NUM_LEVELS + 1),
+                        help='the level to play headless (default: level 1 for --headless, every level for --sweep)')
+    parser.add_argument('--gems', type=int, default=0, help='the gems the player starts a headless level with')
+    parser.add_argument('--ticks', type=int, default=TICKS_PER_SECOND * 60 * 10, help='the most ticks a headless level can last')
+    parser.add_argument('--seed', type=int, help='the random seed for headless levels')
+    parser.add_argument('--sweep', type=int, default=0, metavar='TRIALS',
+                        help='play every level this many times for each combination of --vary settings across all CPUs and write the win rates to a CSV file')
+    parser.add_argument('--vary', action='append', default=[], metavar='NAME=VALUE,VALUE,...',
+                        help='the values to try for a balance setting in --sweep, where NAME is life.<monster>, speed.<monster>, '
+                             'minAmount.<level>, maxAmount.<level>, final.<level>.<monster> or cost.<spell>')
+    parser.add_argument('--processes', type=int, help='the number of processes for --sweep (default: one per CPU)')
+    parser.add_argument('--output', default='sweep.csv', help='the CSV file --sweep writes to')
+    args = parser.parse_args()
+    if args.profile or args.profile_output:
+        profiler = FrameProfiler(output=args.profile_output)
+
+    # images and sounds are loaded relative to the game's folder
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    if args.benchmark:
+        BENCHMARKS[args.benchmark]()
+    elif args.suite:
+        if runSuite(args.baselines, args.threshold, args.save_baselines):
+            sys.exit(1)
+    elif args.replay:
+        result = replayRecording(args.replay, args.render)
+        state = result['state']
+        print('replayed %d ticks in %.2f seconds (%.0f ticks/sec), level %d, %d gems collected, %d spells cast%s' % (
+            result['ticks'], result['seconds'], result['ticksPerSecond'], state['level'], state['gemsCollected'],
+            state['spellsCast'], ', you win' if state['youwin'] else ', game over' if state['gameover'] else ''))
+        if result['ticks']:
+            tickTimes = result['tickTimes']
+            print('tick times: median %.3f ms, 99th percentile %.3f ms, max %.3f ms' % (
+                percentile(tickTimes, 0.5) * 1000, percentile(tickTimes, 0.99) * 1000, max(tickTimes) * 1000))
+            print('slowest ticks: ' + ', '.join('%d (%.3f ms)' % (tick, seconds * 1000) for tick, seconds in result['slowestTicks']))
+        profiler.close()
+        recorded = result['recorded']
+        if recorded is None:
+            print('the recording has no ending, the game did not end normally')
+        elif not result['matches']:
+            print('the replay does not match the recording, which ended with %s' % ', '.join(
+                '%s %d' % (name, recorded[name]) for name in sorted(recorded)))
+            sys.exit(1)
+    elif args.bake:
+        bakeAtlas()
+        bakeBackgrounds()
+    elif args.sweep:
+        variations = []
+        for vary in args.vary:
+            name, values = vary.split('=')
+            variations.append((name, [int(value) for value in values.split(',')]))
+        restoreSettings(applySettings(dict((name, values[0]) for name, values in variations))) # fail early on a bad name
+        start = timeit.default_timer()
+        rows = runSweep(variations, args.level or range(1, NUM_LEVELS + 1), args.sweep, args.policy, args.interval,
+                        args.ticks, args.seed or 0, args.processes)
+        elapsed = timeit.default_timer() - start
+        writeSweep(args.output, variations, rows)
+        numConfigs = len(rows) // len(args.level or range(1, NUM_LEVELS + 1))
+        print('%d configurations, %d levels played in %.2f seconds (%.0f configurations/minute), written to %s' % (
+            numConfigs, sum(row[len(variations) + 1] for row in rows), elapsed, numConfigs / elapsed * 60, args.output))
+    elif args.headless:
+        if args.seed is not None:
+            random.seed(args.seed)
+        args.level = (args.level or [1])[0]
+        totalTicks = totalSeconds = survived = 0
+        for trial in range(args.headless):
+            result = playLevel(POLICIES[args.policy](args.interval), args.level, args.gems, args.ticks)
+            totalTicks += result['ticks']
+            totalSeconds += result['seconds']
+            survived += result['survived']
+            print('trial %d: %s after %d ticks (%.0f ticks/sec), %d gems collected, %d spells cast' % (
+                trial + 1, 'survived' if result['survived'] else 'lost', result['ticks'], result['ticksPerSecond'],
+                result['gemsCollected'], result['spellsCast']))
+        print('level %d survived %d of %d times, %d ticks in %.2f seconds, %.0f ticks/sec' % (
+            args.level, survived, args.headless, totalTicks, totalSeconds, totalTicks / totalSeconds))
+    else:
+        main(args.record)
@@ -24,8 +24,25 @@
 
 import math
 import random
+import argparse
+import timeit
+import multiprocessing
+import collections
+import csv
+import gc
+import json
+import os
+import platform
+import sys
+import struct
+import tracemalloc
 import pygame
 
+try:
+    import numpy
+except ImportError:
+    numpy = None # ArrayGameWorld needs NumPy, the rest of the game does not
+
 BLACK  = (  0,   0,   0)
 GREEN  = (  0, 204,   0)
 RED    = (255,   0,   0)
@@ -50,16 +67,129 @@ MAP_QUARTER_HEIGHT       = int(MAP_HEIGHT / 4.0)
 MAP_HALF_HEIGHT          = int(MAP_HEIGHT / 2.0)
 MAP_THREE_QUARTER_HEIGHT = int(3 * MAP_HEIGHT / 4.0)
 
-DECELERATION = 0.99 # set between 0.0 and 1.0
+TICK_LENGTH = 1 / 60.0 # the seconds of game time simulated by each GameWorld.update() in main()
+MAX_TICKS_PER_FRAME = 5 # main() drops game time rather than run more updates than this per frame
+DECELERATION = 0.99 # set between 0.0 and 1.0, the fraction of its speed the ship keeps every TICK_LENGTH seconds
 MAX_EXPLOSION_SIZE = 0.5 # set between 0.0 and 1.0
 MAX_POWERUP_AGE = 9 # in seconds
+POWERUP_CHANCE = 0.25 # the chance that a small bubble leaves a powerup when it is hit
+DIRTY_RECTS = True # only update the parts of the window that changed, instead of all of it
+MAX_DIRTY_AREA = 0.5 # update the whole window when more than this fraction of it changed
+COLLISION_GRID_CELLS = 16 # the map is split into this many cells across and down for collision checks
+SWEPT_COLLISIONS = True # check for bullets hitting bubbles anywhere along each update's moves, not just where they are
 
 def scale_and_round(x, y):
     """Returns x and y coordinates from 0.0 to 1.0 scaled to 0 to MAP_WIDTH or MAP_HEIGHT."""
     return int(round(x * MAP_WIDTH)), int(round(y * MAP_HEIGHT))
 
+# The collision kernel. The map wraps around at its edges, so the distance between two
+# objects is measured the short way around (the "minimum image"), and objects touching
+# across an edge collide. Distances are compared squared, without a square root, after
+# checking the distance across and down alone rules out most pairs that are far apart.
+
+def wrapped_distance(d):
+    """Returns d, a difference between two coordinates from 0.0 to 1.0, measured the short way
+    around the map, from -0.5 to 0.5."""
+    if d > 0.5: return d - 1
+    if d < -0.5: return d + 1
+    return d
+
+def circle_touches(x, y, radius, obj):
+    """Returns True if the circle of radius at x, y overlaps obj's circle."""
+    reach = radius + obj.radius
+    a = x - obj.x
+    if a > 0.5: a -= 1
+    elif a < -0.5: a += 1
+    if a >= reach or a <= -reach:
+        return False
+    b = y - obj.y
+    if b > 0.5: b -= 1
+    elif b < -0.5: b += 1
+    if b >= reach or b <= -reach:
+        return False
+    return a * a + b * b < reach * reach
+
+def circles_touching(x, y, radius, objects):
+    """Returns a list of the objects whose circles overlap the circle of radius at x, y, in
+    the same order. The same test as circle_touches(), without a function call per object."""
+    touching = []
+    for obj in objects:
+        reach = radius + obj.radius
+        a = x - obj.x
+        if a > 0.5: a -= 1
+        elif a < -0.5: a += 1
+        if a >= reach or a <= -reach:
+            continue
+        b = y - obj.y
+        if b > 0.5: b -= 1
+        elif b < -0.5: b += 1
+        if b >= reach or b <= -reach:
+            continue
+        if a * a + b * b < reach * reach:
+            touching.append(obj)
+    return touching
+
+def array_wrapped_distance(d):
+    """wrapped_distance() for a NumPy array of differences from -1.0 to 1.0."""
+    return d - numpy.rint(d) # faster than numpy.round(), or folding with (d > 0.5) - (d < -0.5)
+
+def image_shifts(a, move, reach):
+    """Returns the shifts out of 0, -1 and 1 (the map itself and the copies of it on either
+    side) that bring a point moving from a to a + move on one axis within reach of 0."""
+    low, high = (a, a + move) if move >= 0 else (a + move, a)
+    if reach - 1 < low and high < 1 - reach:
+        # the copies are too far away, which is nearly always the case
+        return (0,) if low < reach and high > -reach else ()
+    return [shift for shift in (0, -1, 1) if low + shift < reach and high + shift > -reach]
+
+def sweep_touches(a, b, move_x, move_y, reach, start=0.0, end=1.0):
+    """Returns True if a point at a, b from the origin comes closer than reach to it while
+    moving by move_x, move_y in a straight line, between the start and end fractions of
+    that move."""
+    if start >= end:
+        return False
+    length = move_x * move_x + move_y * move_y
+    if length:
+        # the fraction of the move where the point is closest to the origin
+        closest = min(max(-(a * move_x + b * move_y) / length, start), end)
+        a += move_x * closest
+        b += move_y * closest
+    return a * a + b * b < reach * reach
+
+def on_map_fraction(x, move_x, y, move_y):
+    """Returns the fraction, from 0.0 to 1.0, of a move by move_x, move_y from x, y that
+    happens before going off the map."""
+    fraction = 1.0
+    if move_x: fraction = min(fraction, (-x if move_x < 0 else 1 - x) / move_x)
+    if move_y: fraction = min(fraction, (-y if move_y < 0 else 1 - y) / move_y)
+    return fraction
+
+def array_sweep_touches(a, b, move_x, move_y, reach, start=0.0, end=1.0):
+    """sweep_touches() for NumPy arrays of points, moves, reaches, and ends. Returns a boolean array."""
+    length = move_x * move_x + move_y * move_y
+    closest = numpy.minimum(numpy.maximum(-(a * move_x + b * move_y) / numpy.where(length, length, 1.0), start), end)
+    a = a + move_x * closest
+    b = b + move_y * closest
+    return (a * a + b * b < reach * reach) & (start < end)
+
+def sweep_images_touch(a, b, move_x, move_y, reach, end=1.0):
+    """sweep_touches() on the wrapping map: returns True if a point at a, b from the origin
+    comes closer than reach to it, or to a copy of it on the map's other side, while moving
+    by move_x, move_y up to the end fraction of the move."""
+    shifts_x = image_shifts(a, move_x, reach)
+    if not shifts_x:
+        return False # too far apart across to meet during the move
+    shifts_y = image_shifts(b, move_y, reach)
+    for shift_x in shifts_x:
+        for shift_y in shifts_y:
+            if sweep_touches(a + shift_x, b + shift_y, move_x, move_y, reach, 0.0, end):
+                return True
+    return False
+
+
+class Vector2D(object):
+    __slots__ = ('x', 'y')
 
-class Vector2D:
     def __init__(self, x, y):
         self.x = x
         self.y = y
@@ -79,18 +209,93 @@ class Vector2D:
         self.y = vector.y
 
 
+class Position(Vector2D):
+    """What ObjectOnMap.pos returns: a Vector2D that reads and writes the x and y of the
+    object itself, instead of holding its own."""
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    @property
+    def x(self):
+        return self.obj.x
+
+    @x.setter
+    def x(self, value):
+        self.obj.x = value
+
+    @property
+    def y(self):
+        return self.obj.y
+
+    @y.setter
+    def y(self, value):
+        self.obj.y = value
+
+
+class Velocity(Vector2D):
+    """What ObjectOnMap.speed returns: a Vector2D that reads and writes the vx and vy of the
+    object itself, instead of holding its own."""
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    @property
+    def x(self):
+        return self.obj.vx
+
+    @x.setter
+    def x(self, value):
+        self.obj.vx = value
+
+    @property
+    def y(self):
+        return self.obj.vy
+
+    @y.setter
+    def y(self, value):
+        self.obj.vy = value
+
+
 class ObjectOnMap(object):
-    """Represents a circular object on the game map with position, radius, and velocity."""
+    """Represents a circular object on the game map with position, radius, and velocity.
+    The position and velocity are kept as plain floats in the object's slots (x, y, vx and
+    vy), so that a level with many bubbles doesn't need two more Python objects for each
+    one. pos and speed still work like Vector2D attributes, for code that doesn't need to be
+    fast."""
+    __slots__ = ('x', 'y', 'vx', 'vy', 'radius')
 
     def __init__(self, radius):
-        self.pos = Vector2D(0.5, 0.5)
+        self.x = 0.5
+        self.y = 0.5
         self.radius = radius;
-        self.speed = Vector2D(0, 0)
+        self.vx = 0
+        self.vy = 0
+
+    @property
+    def pos(self):
+        return Position(self)
+
+    @pos.setter
+    def pos(self, vector):
+        self.x = vector.x
+        self.y = vector.y
+
+    @property
+    def speed(self):
+        return Velocity(self)
+
+    @speed.setter
+    def speed(self, vector):
+        self.vx = vector.x
+        self.vy = vector.y
 
     def update(self, delta_t):
         """Update the object's position as though delta_t seconds have passed."""
-        self.pos.x += self.speed.x * delta_t
-        self.pos.y += self.speed.y * delta_t
+        self.x += self.vx * delta_t
+        self.y += self.vy * delta_t
 
         wrapped = self.is_out()
         self.wrap_around()
@@ -98,24 +303,103 @@ class ObjectOnMap(object):
 
     def wrap_around(self):
         """Change the position of the bubble to toroidally "wrap around" if it goes off one edge of the map."""
-        if self.pos.x < 0: self.pos.x += 1
-        if self.pos.y < 0: self.pos.y += 1
-        if self.pos.x > 1: self.pos.x -= 1
-        if self.pos.y > 1: self.pos.y -= 1
+        if self.x < 0: self.x += 1
+        if self.y < 0: self.y += 1
+        if self.x > 1: self.x -= 1
+        if self.y > 1: self.y -= 1
 
     def is_out(self):
         """Returns True if the center of the bubble is outside the game map, False if it is on the map."""
-        return not (0 < self.pos.x < 1 and 0 < self.pos.y < 1)
+        return not (0 < self.x < 1 and 0 < self.y < 1)
+
+    def render_pos(self, lag):
+        """Returns the scaled position the object was at lag seconds before its last update, so
+        that it can be drawn in between updates."""
+        return scale_and_round(self.x - self.vx * lag, self.y - self.vy * lag)
 
     def collides_with(self, other):
         """Returns True if this bubble is intersecting with the ObjectOnMap object passed in for the "other" parameter."""
-        a = self.pos.x - other.pos.x
-        b = self.pos.y - other.pos.y
-        distance = math.sqrt(a * a + b * b)
-        return distance < (self.radius + other.radius)
+        # circle_touches(), written out here to save a function call per pair
+        reach = self.radius + other.radius
+        a = self.x - other.x
+        if a > 0.5: a -= 1
+        elif a < -0.5: a += 1
+        if a >= reach or a <= -reach:
+            return False
+        b = self.y - other.y
+        if b > 0.5: b -= 1
+        elif b < -0.5: b += 1
+        if b >= reach or b <= -reach:
+            return False
+        return a * a + b * b < reach * reach
+
+
+class SpatialGrid(object):
+    """A uniform grid over the (toroidal) map that finds which objects might be touching
+    another object, so that collides_with() doesn't need to be called for every pair.
+    Each object is filed under every cell that a circle "reach" larger than the object
+    overlaps, wrapping around the edges of the map the same way wrap_around() does. Then the
+    objects near a given object are just the ones filed under the cell its center is in.
+    If delta_t is not 0, objects are filed under every cell they would pass over while
+    moving at their speed for delta_t seconds, for Bullet.sweeps_into()."""
+
+    def __init__(self, objects, reach, cells=COLLISION_GRID_CELLS, delta_t=0):
+        self.reach = reach # the largest radius (plus move, if swept) of the objects that will be looked up
+        self.cells = cells
+        self.delta_t = delta_t
+        self.grid = {} # keys are (column, row) tuples, values are lists of objects
+        self.filed_under = {} # keys are id()s of objects, values are the lists in self.grid they are in
+        for obj in objects:
+            self.add(obj)
+
+    def cell_range(self, center, radius):
+        first = int(math.floor((center - radius) * self.cells))
+        last = int(math.floor((center + radius) * self.cells))
+        if last - first >= self.cells - 1:
+            return range(self.cells) # covers the whole map
+        return [i % self.cells for i in range(first, last + 1)]
+
+    def add(self, obj):
+        move_x = obj.vx * self.delta_t * 0.5
+        move_y = obj.vy * self.delta_t * 0.5
+        radius = obj.radius + self.reach
+        filed_under = self.filed_under.setdefault(id(obj), [])
+        for column in self.cell_range(obj.x + move_x, radius + abs(move_x)):
+            for row in self.cell_range(obj.y + move_y, radius + abs(move_y)):
+                objects = self.grid.setdefault((column, row), [])
+                objects.append(obj)
+                filed_under.append(objects)
+
+    def remove(self, obj):
+        for objects in self.filed_under.pop(id(obj), []):
+            objects.remove(obj)
+
+    def near(self, obj):
+        """Returns a list of the objects that might collide with obj, in the order they were added."""
+        cell = (int(obj.x * self.cells) % self.cells, int(obj.y * self.cells) % self.cells)
+        return self.grid.get(cell, [])
+
+
+class AllPairs(object):
+    """The same interface as SpatialGrid, but every object is near every other object. This
+    is how collisions were checked before SpatialGrid, and is kept for comparing against it."""
+
+    def __init__(self, objects, reach, cells=None, delta_t=0):
+        self.objects = list(objects)
+
+    def add(self, obj):
+        self.objects.append(obj)
+
+    def remove(self, obj):
+        self.objects.remove(obj)
+
+    def near(self, obj):
+        return self.objects
 
 
 class Bubble(ObjectOnMap):
+    __slots__ = ('kind', 'color')
+
     #                  (size, speed)
     kinds = {'big':    (0.1,   0.1),
              'medium': (0.075, 0.15),
@@ -132,12 +416,10 @@ class Bubble(ObjectOnMap):
         size, speed = Bubble.kinds[kind]
         super(Bubble ,self).__init__(size)
 
-        self.pos = Vector2D(
-            random.random(),
-            random.random())
-        self.speed = Vector2D(
-            random.uniform(-speed, speed),
-            random.uniform(-speed, speed))
+        self.x = random.random()
+        self.y = random.random()
+        self.vx = random.uniform(-speed, speed)
+        self.vy = random.uniform(-speed, speed)
         self.kind = kind
         self.color = random.choice(Bubble.colors)
 
@@ -148,7 +430,7 @@ class Bubble(ObjectOnMap):
 
         if self.kind == "small":
             # Small Bubbles do not create new Bubbles, but might create Powerups.
-            if random.random() < 0.25:
+            if random.random() < POWERUP_CHANCE:
                 spawned_powerups.append(Powerup(self.pos))
         else:
             # Medium and Big Bubbles create new Bubble objects of the next smaller size. They don't create Powerups.
@@ -163,23 +445,30 @@ class Bubble(ObjectOnMap):
 
         return (spawned_bubbles, spawned_powerups)
 
-    def render(self, surface):
-        pygame.draw.circle(
+    def render(self, surface, lag=0):
+        """Draws the bubble on surface and returns the Rect that was drawn over."""
+        return pygame.draw.circle(
             surface,
             self.color,
-            scale_and_round(self.pos.x, self.pos.y),
+            self.render_pos(lag),
             int(round(self.radius * MAP_SIZE)),
             1)
 
 class Powerup(ObjectOnMap):
+    __slots__ = ('kind', 'age')
+
+    size = 0.03 # all Powerups are the same size.
+    kinds = ("shield", "bullet", "freeze", "shotgun")
+
     def __init__(self, pos):
-        super(Powerup, self).__init__(0.03) # all Powerups are the same size.
+        super(Powerup, self).__init__(Powerup.size)
         self.pos.copy(pos)
-        self.kind = random.choice(("shield", "bullet", "freeze", "shotgun"))
+        self.kind = random.choice(Powerup.kinds)
         self.age = 0
 
-    def render(self, surface):
-        scaled_x, scaled_y = scale_and_round(self.pos.x, self.pos.y)
+    def render(self, surface, lag=0):
+        """Draws the powerup on surface and returns the Rect that was drawn over."""
+        scaled_x, scaled_y = self.render_pos(lag)
         scaled_r = int(round(self.radius * MAP_SIZE))
         if self.kind == "shield":
             bbox = pygame.draw.circle(
@@ -188,7 +477,7 @@ class Powerup(ObjectOnMap):
                 (scaled_x, scaled_y),
                 scaled_r,
                 1)
-            pygame.draw.rect(surface, WHITE, bbox, 1)
+            return pygame.draw.rect(surface, WHITE, bbox, 1)
         elif self.kind == "bullet":
             pygame.draw.circle(
                 surface,
@@ -198,27 +487,31 @@ class Powerup(ObjectOnMap):
                 1)
             bbox = pygame.Rect(0, 0, scaled_r * 2, scaled_r * 2)
             bbox.center = (scaled_x, scaled_y)
-            pygame.draw.rect(surface, WHITE, bbox, 1)
+            return pygame.draw.rect(surface, WHITE, bbox, 1)
         elif self.kind == "freeze":
             bbox = pygame.Rect(0, 0, scaled_r * 2, scaled_r * 2)
             bbox.center = (scaled_x, scaled_y)
-            pygame.draw.rect(surface, WHITE, bbox, 1)
+            drawn = pygame.draw.rect(surface, WHITE, bbox, 1)
             bbox.inflate_ip(-scaled_r, -scaled_r)
             pygame.draw.rect(surface, WHITE, bbox, 1)
             bbox.inflate_ip(-scaled_r * 0.5, -scaled_r * 0.5)
             pygame.draw.rect(surface, WHITE, bbox, 1)
+            return drawn
         elif self.kind == "shotgun":
             bbox = pygame.Rect(0, 0, scaled_r * 2, scaled_r * 2)
             bbox.center = (scaled_x, scaled_y)
-            pygame.draw.rect(surface, WHITE, bbox, 1)
+            drawn = pygame.draw.rect(surface, WHITE, bbox, 1)
             pygame.draw.line(surface, WHITE, bbox.midleft, bbox.midright, 1)
             pygame.draw.line(surface, WHITE, bbox.midleft, bbox.topright, 1)
             pygame.draw.line(surface, WHITE, bbox.midleft, bbox.bottomright, 1)
+            return drawn
         else:
             raise "Bad power-up kind: " + self.kind
 
 
 class Ship(ObjectOnMap):
+    __slots__ = ('_shield_timer', '_super_bullet_timer', '_freeze_timer', '_shotgun_timer', 'accel_x', 'accel_y')
+
     def __init__(self):
         super(Ship, self).__init__(0.04) # all Ships are the same size.
         self._shield_timer = 0
@@ -231,8 +524,8 @@ class Ship(ObjectOnMap):
     def thrust_at(self, x, y):
         """Increase acceleration of the ship in the direction of x, y.
         The further away x, y is from the current position of the ship, the larger the acceleration increase."""
-        x -= self.pos.x;
-        y -= self.pos.y;
+        x -= self.x;
+        y -= self.y;
 
         self.accel_x += x * 0.03;
         self.accel_y += y * 0.03;
@@ -244,10 +537,13 @@ class Ship(ObjectOnMap):
 
     def update(self, delta_t):
         """Update the ship's position as though delta_t seconds have passed."""
-        self.speed.x += self.accel_x
-        self.speed.y += self.accel_y
-        self.speed.x *= DECELERATION
-        self.speed.y *= DECELERATION
+        # the thrust and the deceleration are given per TICK_LENGTH seconds
+        ticks = delta_t / TICK_LENGTH
+        deceleration = DECELERATION ** ticks
+        self.vx += self.accel_x * ticks
+        self.vy += self.accel_y * ticks
+        self.vx *= deceleration
+        self.vy *= deceleration
 
         # powerups degrade over time until it reaches 0.
         if self.has_shield():        self._shield_timer       -= delta_t
@@ -299,78 +595,105 @@ class Ship(ObjectOnMap):
 
     def shoot_at(self, x, y):
         """Returns a list of bullet objects that were created by the Ship."""
-        x -= self.pos.x;
-        y -= self.pos.y;
+        x -= self.x;
+        y -= self.y;
 
         bullets = []
         for i in range(5):
             b = Bullet()
-            b.pos.copy(self.pos);
-            b.speed.x = x * 3
-            b.speed.y = y * 3
+            b.x = self.x
+            b.y = self.y
+            b.vx = x * 3
+            b.vy = y * 3
 
             # Help out the poor sods who click on their
             # own ship and get stuck with a non-moving
             # bullet. (2009-11-14)
             if abs(x) < 0.1 and abs(y) < 0.1:
-                b.speed.x *= 30
-                b.speed.y *= 30
+                b.vx *= 30
+                b.vy *= 30
 
             if not self.has_shotgun():
                 return [b] # just return the one bullet
 
-            b.speed.x += random.uniform(-0.15, 0.15)
-            b.speed.y += random.uniform(-0.15, 0.15)
+            b.vx += random.uniform(-0.15, 0.15)
+            b.vy += random.uniform(-0.15, 0.15)
 
             bullets.append(b)
         return bullets
 
-    def render(self, surface):
+    def render(self, surface, lag=0):
+        """Draws the ship on surface and returns the Rect that was drawn over."""
+        center = self.render_pos(lag)
         bbox = pygame.draw.circle(
             surface,
             SILVER,
-            scale_and_round(self.pos.x, self.pos.y),
+            center,
             int(round(self.radius * MAP_SIZE)))
         pygame.draw.circle(
             surface,
             BLACK,
-            scale_and_round(self.pos.x, self.pos.y),
+            center,
             int(round(self.radius * 0.5 * MAP_SIZE)),
             1)
         if self.has_shield():
             pygame.draw.rect(surface, SILVER, bbox, 1)
+        return bbox
 
 
 class Bullet(ObjectOnMap):
+    __slots__ = ('shield',)
+
     def __init__(self):
         super(Bullet, self).__init__(0.01) # all Bullet objects are the same size
         self.shield = False
 
-    def render(self, surface):
+    def sweeps_into(self, bubble, delta_t, bubble_delta_t):
+        """Returns True if this bullet would touch bubble at any moment while the bullet moves
+        at its speed for delta_t seconds and the bubble moves at its speed for bubble_delta_t
+        seconds. Unlike collides_with(), this catches a fast bullet passing through a bubble
+        in one update. The bullet is deleted when it goes off the map, so only the part of
+        its move on the map is checked. Wherever the bubble is, it is checked across the
+        edges of the map too, so a bubble that wraps around during the move is still hit."""
+        end = on_map_fraction(self.x, self.vx * delta_t, self.y, self.vy * delta_t)
+        return sweep_images_touch(wrapped_distance(self.x - bubble.x),
+                                  wrapped_distance(self.y - bubble.y),
+                                  self.vx * delta_t - bubble.vx * bubble_delta_t,
+                                  self.vy * delta_t - bubble.vy * bubble_delta_t,
+                                  self.radius + bubble.radius, end)
+
+    def render(self, surface, lag=0):
+        """Draws the bullet on surface and returns the Rect that was drawn over."""
         bbox = pygame.draw.circle(
             surface,
             RED,
-            scale_and_round(self.pos.x, self.pos.y),
+            self.render_pos(lag),
             int(round(self.radius * MAP_SIZE)))
         if self.shield:
             pygame.draw.rect(surface, RED, bbox, 1)
+        return bbox
 
 class Explosion(ObjectOnMap):
+    __slots__ = ()
+
     def __init__(self):
         super(Explosion, self).__init__(0) # explosions start at size 0
 
     def update(self, delta_t):
         self.radius += delta_t
 
-    def render(self, surface):
-        pygame.draw.circle(
+    def render(self, surface, lag=0):
+        """Draws the explosion on surface and returns the Rect that was drawn over."""
+        return pygame.draw.circle(
             surface,
             RED,
-            scale_and_round(self.pos.x, self.pos.y),
+            self.render_pos(lag),
             int(round(self.radius * MAP_SIZE)),
             1)
 
 class GameWorld:
+    broad_phase = SpatialGrid # how handle_collisions() finds the objects that might be colliding
+
     bubbles = []
     explosions = []
     powerups = []
@@ -386,6 +709,10 @@ class GameWorld:
     high_score = 0
     lives = 0
 
+    # totals kept for headless and batch games
+    bubbles_popped = 0
+    ships_lost = 0
+    powerups_collected = 0
 
     def init_level(self, level):
         self.level = level
@@ -397,11 +724,15 @@ class GameWorld:
         if self.ship == None:
             self.ship = Ship()
         self.ship.add_shield() # add shield at the start of a level
-        self.bullets = [];
 
         self.afterdeath_timer = 0
         self.afterfinish_timer = 0
 
+        self.reset_entities(level)
+
+    def reset_entities(self, level):
+        self.bullets = [];
+
         # clear out the explosions, and power ups from the last level.
         self.explosions = []
         self.powerups   = []
@@ -411,20 +742,8 @@ class GameWorld:
 
     def update(self, delta_t):
         self.handle_collisions(delta_t)
-
-        # expand the explosions and delete them once they get too big
-        for explosion in self.explosions:
-            explosion.update(delta_t)
-        for i in range(len(self.explosions) - 1, -1, -1):
-            if self.explosions[i].radius > MAX_EXPLOSION_SIZE:
-                self.explosions.pop(i)
-
-        # "age" the powerups on the map, and delete them if they get too old
-        for i in self.powerups:
-            i.age += delta_t
-        for i in range(len(self.powerups) - 1, -1, -1):
-            if self.powerups[i].age > MAX_POWERUP_AGE:
-                self.powerups.pop(i)
+        self.update_explosions(delta_t)
+        self.update_powerups(delta_t)
 
         # check if all the bubbles have been destroyed
         if not len(self.bubbles):
@@ -438,16 +757,9 @@ class GameWorld:
                 self.init_level(self.level)
                 return
         elif self.ship == None or not self.ship.has_freeze():
-            # update all the bubbles
-            for bubble in self.bubbles:
-                bubble.update(delta_t)
+            self.update_bubbles(delta_t)
 
-        # update the bullets
-        for i in range(len(self.bullets) - 1, -1, -1):
-            bullet_wrapped = self.bullets[i].update(delta_t)
-            if bullet_wrapped:
-                # delete the bullet if it has hit the edge of the map
-                del self.bullets[i]
+        self.update_bullets(delta_t)
 
         # update the ship
         if self.ship == None:
@@ -465,17 +777,65 @@ class GameWorld:
         else:
             self.ship.update(delta_t)
 
+    def update_explosions(self, delta_t):
+        # expand the explosions and delete them once they get too big
+        for explosion in self.explosions:
+            explosion.update(delta_t)
+        for i in range(len(self.explosions) - 1, -1, -1):
+            if self.explosions[i].radius > MAX_EXPLOSION_SIZE:
+                self.explosions.pop(i)
+
+    def update_powerups(self, delta_t):
+        # "age" the powerups on the map, and delete them if they get too old
+        for i in self.powerups:
+            i.age += delta_t
+        for i in range(len(self.powerups) - 1, -1, -1):
+            if self.powerups[i].age > MAX_POWERUP_AGE:
+                self.powerups.pop(i)
+
+    def update_bubbles(self, delta_t):
+        for bubble in self.bubbles:
+            bubble.update(delta_t)
+
+    def update_bullets(self, delta_t):
+        for i in range(len(self.bullets) - 1, -1, -1):
+            bullet_wrapped = self.bullets[i].update(delta_t)
+            if bullet_wrapped:
+                # delete the bullet if it has hit the edge of the map
+                del self.bullets[i]
+
+    def sweep_times(self, delta_t):
+        """Returns how many seconds the bullets and the bubbles will move for in this update, for
+        checking if they hit each other along the way, or 0, 0 if SWEPT_COLLISIONS is False."""
+        if not SWEPT_COLLISIONS:
+            return 0, 0
+        if self.ship != None and self.ship.has_freeze():
+            return delta_t, 0 # frozen bubbles don't move
+        return delta_t, delta_t
+
     def handle_collisions(self, delta_t):
+        bubble_reach = max(size for size, speed in Bubble.kinds.values())
+        ship_reach = bubble_reach
+        bullet_t, bubble_t = self.sweep_times(delta_t)
+        # a bubble's speed across or down is never more than the speed of its kind
+        bubble_reach += max(speed for size, speed in Bubble.kinds.values()) * bubble_t
+        bullets_near = self.broad_phase(self.bullets, bubble_reach, delta_t=bullet_t)
+        if self.ship != None:
+            ship_near = self.broad_phase([self.ship], ship_reach)
+
         for b in self.bubbles:
-            for i in range(len(self.bullets) - 1, -1, -1):
-                if self.bullets[i].collides_with(b):
+            # bullets are checked from the most recently fired one to the oldest one
+            for bullet in reversed(bullets_near.near(b)):
+                if bullet.sweeps_into(b, bullet_t, bubble_t):
                     self.bubbles.remove(b)
+                    bullets_near.remove(bullet)
                     if self.ship != None and not self.ship.has_super_bullets():
-                        del self.bullets[i] # delete the non-super bullet when it hits a bubble
+                        self.bullets.remove(bullet) # delete the non-super bullet when it hits a bubble
                     else:
                         # Push it along or it will just
                         # destroy the newly formed bubbles.
-                        self.bullets[i].update(delta_t * 5)
+                        bullet.update(delta_t * 5)
+                        bullets_near.add(bullet)
                     spawned_bubbles, spawned_powerups = b.spawn()
                     self.bubbles.extend(spawned_bubbles)
                     self.powerups.extend(spawned_powerups)
@@ -486,18 +846,31 @@ class GameWorld:
                     break
 
             # check if the bubble has hit the ship
-            if self.ship != None and b.collides_with(self.ship) and not self.ship.has_shield():
+            if self.ship != None and ship_near.near(b) and circle_touches(b.x, b.y, b.radius, self.ship) and not self.ship.has_shield():
                 self.spawn_explosion(self.ship)
                 self.ship = None
                 self.lives -= 1
+                self.ships_lost += 1
                 self.afterdeath_timer = 3;
                 break
 
         if self.ship != None:
-            for p in self.powerups[:]:
-                if p.collides_with(self.ship):
-                    self.apply_powerup(p)
-                    self.powerups.remove(p)
+            for p in circles_touching(self.ship.x, self.ship.y, self.ship.radius, self.powerups):
+                self.apply_powerup(p)
+                self.powerups.remove(p)
+
+    def press_at(self, x, y):
+        """Fires bullets at x, y (from 0.0 to 1.0) and thrusts the ship toward it, the same as
+        pressing the mouse button on the map."""
+        if (self.level > 0) and (self.ship != None):
+            if len(self.bullets) < 6:
+                self.bullets.extend(self.ship.shoot_at(x, y))
+            self.ship.thrust_at(x, y)
+
+    def release(self):
+        """Stops the ship's thrust, the same as releasing the mouse button."""
+        if (self.level > 0) and (self.ship != None):
+            self.ship.stop_thrust()
 
     def spawn_explosion(self, bubble):
         explosion = Explosion()
@@ -510,6 +883,7 @@ class GameWorld:
                  'medium': 2,
                  'small':  5}
         self.score += kinds[bubble.kind]
+        self.bubbles_popped += 1
 
         if self.score > self.high_score:
             self.high_score = self.score
@@ -521,6 +895,7 @@ class GameWorld:
                  'freeze':  self.ship.add_freeze,
                  'shotgun': self.ship.add_shotgun}
         kinds[powerup.kind]()
+        self.powerups_collected += 1
 
         self.score += self.level * 10
 
@@ -528,39 +903,571 @@ class GameWorld:
             self.high_score = self.score
 
 
+class EntityArrays(object):
+    """A list-like collection of ObjectOnMap objects of one class, stored as a structure of
+    NumPy arrays (one array per attribute) instead of as separate Python objects. Objects
+    can be added with append() and extend() like a list, and iterating over it creates
+    ordinary cls objects (such as Bubble) holding a copy of each object's attributes, so
+    that their render() methods still work."""
+
+    def __init__(self, cls, kinds=(None,), colors=(None,), capacity=64):
+        self.cls = cls
+        self.kinds = tuple(kinds)   # the "kind" array holds indexes into this tuple
+        self.colors = tuple(colors) # the "color" array holds indexes into this tuple
+        self.count = 0
+        self.x = numpy.zeros(capacity)
+        self.y = numpy.zeros(capacity)
+        self.vx = numpy.zeros(capacity)
+        self.vy = numpy.zeros(capacity)
+        self.radius = numpy.zeros(capacity)
+        self.age = numpy.zeros(capacity)
+        self.kind = numpy.zeros(capacity, dtype=int)
+        self.color = numpy.zeros(capacity, dtype=int)
+
+    fields = ('x', 'y', 'vx', 'vy', 'radius', 'age', 'kind', 'color')
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.to_object(i)
+
+    def to_object(self, i):
+        """Returns a new cls object with the attributes of object number i."""
+        obj = self.cls.__new__(self.cls)
+        obj.x = float(self.x[i])
+        obj.y = float(self.y[i])
+        obj.vx = float(self.vx[i])
+        obj.vy = float(self.vy[i])
+        obj.radius = float(self.radius[i])
+        # only the attributes the class has a slot for
+        if hasattr(self.cls, 'age'):
+            obj.age = float(self.age[i])
+        if hasattr(self.cls, 'kind'):
+            obj.kind = self.kinds[self.kind[i]]
+        if hasattr(self.cls, 'color'):
+            obj.color = self.colors[self.color[i]]
+        if hasattr(self.cls, 'shield'):
+            obj.shield = False
+        return obj
+
+    def add(self, x, y, vx=0.0, vy=0.0, radius=0.0, age=0.0, kind=0, color=0):
+        """Adds objects to the end of the arrays. The arguments can be NumPy arrays or numbers."""
+        values = numpy.broadcast_arrays(x, y, vx, vy, radius, age, kind, color)
+        num_added = values[0].size
+        if self.count + num_added > len(self.x):
+            self.grow(self.count + num_added)
+        for field, value in zip(self.fields, values):
+            getattr(self, field)[self.count:self.count + num_added] = value.ravel()
+        self.count += num_added
+
+    def append(self, obj):
+        self.add(obj.x, obj.y, obj.vx, obj.vy, obj.radius,
+                 getattr(obj, 'age', 0.0),
+                 self.kinds.index(getattr(obj, 'kind', None)),
+                 self.colors.index(getattr(obj, 'color', None)))
+
+    def extend(self, objects):
+        for obj in objects:
+            self.append(obj)
+
+    def grow(self, capacity):
+        capacity = max(capacity, 2 * len(self.x))
+        for field in self.fields:
+            old = getattr(self, field)
+            new = numpy.zeros(capacity, dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, field, new)
+
+    def keep(self, mask):
+        """Deletes every object whose entry in the boolean array mask is False, keeping the
+        order of the rest."""
+        num_kept = int(numpy.count_nonzero(mask))
+        if num_kept == self.count:
+            return
+        for field in self.fields:
+            array = getattr(self, field)
+            array[:num_kept] = array[:self.count][mask]
+        self.count = num_kept
+
+    def move(self, delta_t):
+        """Moves and wraps around every object like ObjectOnMap.update() does. Returns a boolean
+        array of which objects had gone off the map before they were wrapped around."""
+        x = self.x[:self.count]
+        y = self.y[:self.count]
+        x += self.vx[:self.count] * delta_t
+        y += self.vy[:self.count] * delta_t
+
+        wrapped = ~((0 < x) & (x < 1) & (0 < y) & (y < 1))
+        x[x < 0] += 1
+        y[y < 0] += 1
+        x[x > 1] -= 1
+        y[y > 1] -= 1
+        return wrapped
+
+    def touching(self, x, y, radius):
+        """Returns a boolean array of which objects overlap the circle at x, y, like circles_touching()."""
+        a = array_wrapped_distance(self.x[:self.count] - x)
+        b = array_wrapped_distance(self.y[:self.count] - y)
+        reach = self.radius[:self.count] + radius
+        return a * a + b * b < reach * reach
+
+
+class ArrayGameWorld(GameWorld):
+    """A GameWorld that keeps its bubbles, bullets, powerups, and explosions in EntityArrays
+    and updates them all at once with NumPy, so that it can simulate levels with tens of
+    thousands of bubbles. GameScreen and the main loop use it the same way as a GameWorld.
+
+    Unlike GameWorld, bubbles spawned by a hit aren't checked for collisions until the next
+    update, and the random numbers come from a NumPy RandomState seeded from the random
+    module, so the two worlds don't play out identical games from the same seed."""
+
+    bubble_kinds = ('big', 'medium', 'small') # each kind splits into the next kind in this tuple
+    bubble_scores = numpy.array([1, 2, 5]) if numpy else None # the same scores as mark_score()
+
+    def __init__(self):
+        if numpy is None:
+            raise RuntimeError('ArrayGameWorld needs NumPy to be installed')
+        self.bubble_sizes = numpy.array([Bubble.kinds[kind][0] for kind in self.bubble_kinds])
+        self.bubble_speeds = numpy.array([Bubble.kinds[kind][1] for kind in self.bubble_kinds])
+
+    def reset_entities(self, level):
+        self.random = numpy.random.RandomState(random.getrandbits(32))
+        self.bullets = EntityArrays(Bullet)
+        self.explosions = EntityArrays(Explosion)
+        self.powerups = EntityArrays(Powerup, Powerup.kinds)
+        self.bubbles = EntityArrays(Bubble, self.bubble_kinds, Bubble.colors, capacity=max(64, level * 4))
+        self.add_bubbles(self.random.random_sample(level), self.random.random_sample(level), numpy.zeros(level, dtype=int))
+
+    def add_bubbles(self, x, y, kind):
+        """Adds new bubbles of the given kind indexes at x, y, with random speeds and colors like Bubble()."""
+        speed = self.bubble_speeds[kind]
+        self.bubbles.add(x, y,
+                         self.random.uniform(-speed, speed),
+                         self.random.uniform(-speed, speed),
+                         self.bubble_sizes[kind],
+                         kind=kind,
+                         color=self.random.randint(0, len(Bubble.colors), len(kind)))
+
+    def update_explosions(self, delta_t):
+        explosions = self.explosions
+        explosions.radius[:explosions.count] += delta_t
+        explosions.keep(explosions.radius[:explosions.count] <= MAX_EXPLOSION_SIZE)
+
+    def update_powerups(self, delta_t):
+        powerups = self.powerups
+        powerups.age[:powerups.count] += delta_t
+        powerups.keep(powerups.age[:powerups.count] <= MAX_POWERUP_AGE)
+
+    def update_bubbles(self, delta_t):
+        self.bubbles.move(delta_t)
+
+    def update_bullets(self, delta_t):
+        wrapped = self.bullets.move(delta_t)
+        self.bullets.keep(~wrapped) # delete the bullets that have hit the edge of the map
+
+    def handle_collisions(self, delta_t):
+        bubbles = self.bubbles
+        bullets = self.bullets
+
+        if len(bubbles) and len(bullets):
+            # bubble i[k] is touching bullet j[k] if hits[k] is True
+            bullet_t, bubble_t = self.sweep_times(delta_t)
+            i, j = self.near_pairs(bullet_t, bubble_t)
+            a = array_wrapped_distance(bubbles.x[i] - bullets.x[j])
+            b = array_wrapped_distance(bubbles.y[i] - bullets.y[j])
+            reach = bubbles.radius[i] + bullets.radius[j]
+            if bullet_t:
+                hits = self.swept_hits(j, a, b, reach, bubbles.vx[i], bubbles.vy[i], bullet_t, bubble_t)
+            else:
+                hits = a * a + b * b < reach * reach
+            i = i[hits]
+            j = j[hits]
+
+            # like GameWorld, each bubble in order is hit by the most recently fired bullet touching it
+            if self.ship == None or self.ship.has_super_bullets():
+                destroyed, hitters = self.super_bullet_hits(i, j)
+                # Push it along or it will just
+                # destroy the newly formed bubbles.
+                pushes = numpy.bincount(hitters, minlength=bullets.count)
+                while pushes.any():
+                    pushed = numpy.flatnonzero(pushes) # once for each bubble the bullet hit
+                    bullets.x[pushed] = (bullets.x[pushed] + bullets.vx[pushed] * delta_t * 5) % 1
+                    bullets.y[pushed] = (bullets.y[pushed] + bullets.vy[pushed] * delta_t * 5) % 1
+                    pushes[pushed] -= 1
+            else:
+                destroyed, hitters = self.bullet_hits(i, j)
+                bullet_alive = numpy.ones(bullets.count, dtype=bool)
+                bullet_alive[hitters] = False # delete the non-super bullet when it hits a bubble
+                bullets.keep(bullet_alive)
+
+            if len(destroyed):
+                self.destroy_bubbles(destroyed)
+                if not len(bubbles):
+                    self.afterfinish_timer = 3
+
+        # check if any bubble has hit the ship
+        if self.ship != None and not self.ship.has_shield() and \
+                bubbles.touching(self.ship.pos.x, self.ship.pos.y, self.ship.radius).any():
+            self.spawn_explosion(self.ship)
+            self.ship = None
+            self.lives -= 1
+            self.ships_lost += 1
+            self.afterdeath_timer = 3;
+
+        if self.ship != None and len(self.powerups):
+            collected = self.powerups.touching(self.ship.pos.x, self.ship.pos.y, self.ship.radius)
+            for i in numpy.flatnonzero(collected):
+                self.apply_powerup(self.powerups.to_object(i))
+            self.powerups.keep(~collected)
+
+    def near_pairs(self, bullet_t, bubble_t):
+        """Returns the arrays of bubble indexes and bullet indexes of the pairs that are close
+        enough across the map to touch in this update, so that handle_collisions() only checks
+        those pairs. The bubbles are sorted by x, and each bullet gets the ones within the
+        largest bubble's radius plus the distance both of them can move across, and then the
+        same down. Reaches of half the map or more take in every bubble."""
+        bubbles = self.bubbles
+        bullets = self.bullets
+        by_x = numpy.argsort(bubbles.x[:bubbles.count], kind='stable')
+        sorted_x = bubbles.x[by_x]
+        sorted_y = bubbles.y[by_x]
+        # a bubble's speed across or down is never more than the speed of its kind
+        bubble_reach = self.bubble_sizes.max() + self.bubble_speeds.max() * bubble_t
+        reach_across = bubble_reach + bullets.radius[:bullets.count] + abs(bullets.vx[:bullets.count]) * bullet_t
+        reach_down = bubble_reach + bullets.radius[:bullets.count] + abs(bullets.vy[:bullets.count]) * bullet_t
+        low = bullets.x[:bullets.count] - reach_across
+        high = bullets.x[:bullets.count] + reach_across
+
+        bubble_indexes = []
+        bullet_indexes = []
+        for j in range(bullets.count):
+            if reach_across[j] >= 0.5:
+                stripe = [(0, bubbles.count)] # close enough on either side of the map
+            else:
+                # the part of the stripe that is past an edge of the map wraps around to the other side
+                stripe = [(numpy.searchsorted(sorted_x, max(low[j], 0)), numpy.searchsorted(sorted_x, min(high[j], 1)))]
+                if low[j] < 0:
+                    stripe.append((numpy.searchsorted(sorted_x, low[j] + 1), bubbles.count))
+                if high[j] > 1:
+                    stripe.append((0, numpy.searchsorted(sorted_x, high[j] - 1)))
+            for start, stop in stripe:
+                # and of the bubbles in the stripe, only the ones close enough down as well
+                near = abs(array_wrapped_distance(sorted_y[start:stop] - bullets.y[j])) < reach_down[j]
+                bubble_indexes.append(by_x[start:stop][near])
+                bullet_indexes.append(numpy.full(len(bubble_indexes[-1]), j, dtype=int))
+        return numpy.concatenate(bubble_indexes), numpy.concatenate(bullet_indexes)
+
+    def super_bullet_hits(self, i, j):
+        """Returns the arrays of the bubbles that are hit and the bullet that hits each one, in
+        the order of the bubbles, when bubble i[k] is touching bullet j[k] and the bullets are
+        super bullets, which aren't used up by a hit."""
+        if not len(i):
+            return i, j
+        order = numpy.argsort(i * self.bullets.count + j) # by bubble, then by bullet
+        i = i[order]
+        j = j[order]
+        last = numpy.append(i[1:] != i[:-1], True) # the most recently fired bullet of each bubble
+        return i[last], j[last]
+
+    def bullet_hits(self, i, j):
+        """Returns the arrays of the bubbles that are hit and the bullet that hits each one, in
+        the order of the bubbles, when bubble i[k] is touching bullet j[k] and each bullet is
+        used up by the first bubble it hits. That is at most one bubble per bullet, so this
+        goes from hit to hit instead of from bubble to bubble."""
+        if not len(i):
+            return i, j
+        order = numpy.argsort(j * self.bubbles.count + i) # by bullet, then by bubble
+        i = i[order]
+        j = j[order]
+        starts = numpy.searchsorted(j, numpy.arange(self.bullets.count + 1))
+        position = starts[:-1].copy() # where each bullet's next bubble is in i
+        ends = starts[1:]
+        used_up = self.bubbles.count # the next bubble of a bullet that has no more bubbles to hit
+        next_bubble = numpy.where(position < ends, i[numpy.minimum(position, len(i) - 1)], used_up)
+
+        destroyed = []
+        hitters = []
+        while True:
+            bubble = next_bubble.min()
+            if bubble == used_up:
+                break
+            touching = numpy.flatnonzero(next_bubble == bubble)
+            destroyed.append(bubble)
+            hitters.append(touching[-1])
+            next_bubble[touching[-1]] = used_up
+            # the other bullets touching this bubble move on to the next bubble they touch
+            missed = touching[:-1]
+            position[missed] += 1
+            next_bubble[missed] = numpy.where(position[missed] < ends[missed], i[numpy.minimum(position[missed], len(i) - 1)], used_up)
+        return numpy.array(destroyed, dtype=int), numpy.array(hitters, dtype=int)
+
+    def swept_hits(self, j, a, b, reach, vx, vy, bullet_t, bubble_t):
+        """Returns the hits array for handle_collisions() when the pairs of bubbles and bullets
+        from near_pairs() are checked along their moves like Bullet.sweeps_into() does. j is
+        the bullet index of each pair, a and b are the distances across and down from the
+        bullet to the bubble the short way around the map, and vx, vy are the bubble's speed."""
+        bullets = self.bullets
+        move_x = vx * bubble_t - bullets.vx[j] * bullet_t
+        move_y = vy * bubble_t - bullets.vy[j] * bullet_t
+
+        # like Bullet.sweeps_into(), only the part of each bullet's move on the map is checked
+        end = numpy.ones(bullets.count)
+        for position, speed in ((bullets.x, bullets.vx), (bullets.y, bullets.vy)):
+            move = speed[:bullets.count] * bullet_t
+            edge = numpy.where(move < 0, -position[:bullets.count], 1 - position[:bullets.count])
+            moving = move != 0
+            end[moving] = numpy.minimum(end[moving], edge[moving] / move[moving])
+        end = end[j]
+        hits = array_sweep_touches(a, b, move_x, move_y, reach, end=end)
+
+        # the few pairs whose moves come near a copy of the map on its other side are checked
+        # against the copies too, one at a time like Bullet.sweeps_into()
+        low_x = numpy.minimum(a, a + move_x)
+        high_x = numpy.maximum(a, a + move_x)
+        low_y = numpy.minimum(b, b + move_y)
+        high_y = numpy.maximum(b, b + move_y)
+        near_copies = (low_x <= reach - 1) | (high_x >= 1 - reach) | (low_y <= reach - 1) | (high_y >= 1 - reach)
+        for k in numpy.flatnonzero(near_copies & ~hits):
+            hits[k] = sweep_images_touch(a[k], b[k], move_x[k], move_y[k], reach[k], end[k])
+        return hits
+
+    def destroy_bubbles(self, destroyed):
+        """Deletes the bubbles at the indexes in destroyed and adds the bubbles, powerups,
+        explosions, and score that Bubble.spawn(), spawn_explosion(), and mark_score() would."""
+        bubbles = self.bubbles
+        x = bubbles.x[destroyed]
+        y = bubbles.y[destroyed]
+        kind = bubbles.kind[destroyed]
+
+        keep = numpy.ones(bubbles.count, dtype=bool)
+        keep[destroyed] = False
+        bubbles.keep(keep)
+
+        self.explosions.add(x, y)
+        self.score += int(self.bubble_scores[kind].sum())
+        self.bubbles_popped += len(destroyed)
+        if self.score > self.high_score:
+            self.high_score = self.score
+
+        # Medium and Big Bubbles create two new Bubble objects of the next smaller size.
+        splits = kind < len(self.bubble_kinds) - 1
+        self.add_bubbles(numpy.repeat(x[splits], 2), numpy.repeat(y[splits], 2), numpy.repeat(kind[splits] + 1, 2))
+
+        # Small Bubbles might create Powerups.
+        drops = ~splits
+        drops[drops] = self.random.random_sample(int(numpy.count_nonzero(drops))) < POWERUP_CHANCE
+        num_drops = int(numpy.count_nonzero(drops))
+        self.powerups.add(x[drops], y[drops], radius=Powerup.size,
+                          kind=self.random.randint(0, len(Powerup.kinds), num_drops))
+
+
+class NullProfiler(object):
+    """Stands in for a FrameProfiler when the game isn't being profiled, and does nothing."""
+
+    def start_frame(self): pass
+    def end_frame(self): pass
+    def begin(self, name): pass
+    def end(self): pass
+    def wrap(self, obj, *names): return obj
+    def summary_lines(self): return []
+    def close(self): pass
+
+class FrameProfiler(NullProfiler):
+    """Times the phases of every frame. The game calls start_frame() and end_frame() around
+    each frame, and begin() and end() around each phase, which can be nested. summary_lines()
+    describes the last "history" frames, and is worked out again every "refresh" frames so
+    that drawing it doesn't cost much. If output is a filename, close() writes the time of
+    every phase of every frame there: as a Chrome trace (for chrome://tracing or Perfetto)
+    if it ends in .json, or else as CSV with a row per frame and a column per phase."""
+
+    def __init__(self, history=120, refresh=15, output=None):
+        self.history = collections.deque(maxlen=history) # (seconds, {phase: seconds}) for the last frames
+        self.refresh = refresh
+        self.output = output
+        self.phases = collections.OrderedDict() # keys are phase names in the order they began, values are how deeply nested they are
+        self.stack = [] # (phase, start time) of the phases that have begun but not ended
+        self.frame = 0
+        self.frame_start = None
+        self.frame_phases = {}
+        self.rows = []  # (frame, start time, seconds, {phase: seconds}) for every frame, if there is an output file
+        self.spans = [] # (phase, start time, seconds) for every phase, if there is an output file
+        self.lines = []
+
+    def start_frame(self):
+        self.frame_start = timeit.default_timer()
+        self.frame_phases = {}
+
+    def end_frame(self):
+        if self.frame_start is None:
+            return
+        seconds = timeit.default_timer() - self.frame_start
+        self.history.append((seconds, self.frame_phases))
+        if self.output:
+            self.rows.append((self.frame, self.frame_start, seconds, self.frame_phases))
+        self.frame += 1
+        if self.frame % self.refresh == 0:
+            self.lines = self.summarize()
+
+    def begin(self, name):
+        if name not in self.phases:
+            self.phases[name] = len(self.stack)
+        self.stack.append((name, timeit.default_timer()))
+
+    def end(self):
+        name, start = self.stack.pop()
+        seconds = timeit.default_timer() - start
+        self.frame_phases[name] = self.frame_phases.get(name, 0.0) + seconds
+        if self.output:
+            self.spans.append((name, start, seconds))
+
+    def wrap(self, obj, *names):
+        """Replaces the methods of obj called names with ones that time every call as a phase,
+        and returns obj."""
+        for name in names:
+            setattr(obj, name, self.timed(name, getattr(obj, name)))
+        return obj
+
+    def timed(self, name, function):
+        def timed_function(*args, **kwargs):
+            self.begin(name)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.end()
+        return timed_function
+
+    def summarize(self):
+        """Returns lines of text with percentiles of the frame times and the mean time of each phase."""
+        if not self.history:
+            return []
+        frame_times = [seconds for seconds, phases in self.history]
+        lines = ['frame 50%% %.2f, 95%% %.2f, 99%% %.2f, max %.2f ms' % (
+            percentile(frame_times, 0.5) * 1000, percentile(frame_times, 0.95) * 1000,
+            percentile(frame_times, 0.99) * 1000, max(frame_times) * 1000)]
+        for name, depth in self.phases.items():
+            mean = sum(phases.get(name, 0.0) for seconds, phases in self.history) / len(self.history)
+            lines.append('%s%s %.2f ms' % ('  ' * depth, name, mean * 1000))
+        return lines
+
+    def summary_lines(self):
+        return self.lines
+
+    def close(self):
+        """Writes the output file, if there is one, and prints the summary of the last frames."""
+        print('\n'.join(self.summarize()))
+        if not self.output or not self.rows:
+            return
+        first = self.rows[0][1]
+        if self.output.endswith('.json'):
+            events = [{'name': 'frame %d' % frame, 'ph': 'X', 'pid': 0, 'tid': 0,
+                       'ts': (start - first) * 1e6, 'dur': seconds * 1e6} for frame, start, seconds, phases in self.rows]
+            events.extend({'name': name, 'ph': 'X', 'pid': 0, 'tid': 0,
+                           'ts': (start - first) * 1e6, 'dur': seconds * 1e6} for name, start, seconds in self.spans)
+            with open(self.output, 'w') as trace:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace)
+        else:
+            with open(self.output, 'w') as output:
+                writer = csv.writer(output)
+                writer.writerow(['frame', 'start_ms', 'frame_ms'] + [name + '_ms' for name in self.phases])
+                for frame, start, seconds, phases in self.rows:
+                    writer.writerow([frame, '%.3f' % ((start - first) * 1000), '%.3f' % (seconds * 1000)] +
+                                    ['%.3f' % (phases.get(name, 0.0) * 1000) for name in self.phases])
+        print('%d frames written to %s' % (len(self.rows), self.output))
+
+profiler = NullProfiler() # the FrameProfiler timing the game, set by --profile
+
+
+class TextCache(object):
+    """Remembers the Surface objects that Font.render() returns so that text which is drawn
+    every frame is only rendered once. When more than max_size Surfaces are remembered, the
+    least recently used one is forgotten."""
+
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.surfaces = collections.OrderedDict() # keys are (font, text, color) tuples
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, font, text, color):
+        key = (font, text, color)
+        surface = self.surfaces.pop(key, None)
+        if surface is None:
+            self.misses += 1
+            surface = font.render(text, False, color)
+            if len(self.surfaces) >= self.max_size:
+                self.surfaces.popitem(last=False) # forget the least recently used Surface
+        else:
+            self.hits += 1
+        self.surfaces[key] = surface # (re)inserting the key makes it the most recently used
+        return surface
+
+
 class GameScreen:
     def __init__(self, world, screen):
         self.world = world
 
         self.screen = screen
         self.bglayer = pygame.Surface((WINDOW_WIDTH, WINDOW_HEIGHT))
+        self.bglayer_level = None # the level the bglayer was last rendered for
+        self.text = TextCache()
+        self.frame_text_hits = 0 # how many text Surfaces the last frame got from the cache
+        self.frame_text_misses = 0 # how many text Surfaces the last frame had to render
+
+        self.drawn_rects = [] # the Rects drawn over on the screen in the last frame
+        self.frame_rects = [] # the Rects drawn over on the screen so far in this frame
+        self.frame_dirty_area = 0.0 # the fraction of the window updated in the last frame
 
         font_name = pygame.font.get_default_font()
         self.hud_font =    pygame.font.SysFont(
-            font_name, WINDOW_HEIGHT / 10)
+            font_name, WINDOW_HEIGHT // 10)
         self.msg_font = pygame.font.SysFont(
-            font_name, WINDOW_HEIGHT / 20)
+            font_name, WINDOW_HEIGHT // 20)
 
         self.game_paused = False
 
 
-    def render(self):
-        self.screen.blit(self.bglayer, (0, 0))
-        self.render_background(self.world.level)
+    def render(self, alpha=1.0):
+        """Draws the frame. alpha is how far the game time has got from the last world update
+        towards the next one, from 0.0 to 1.0, and the moving objects are drawn that much of
+        an update behind where they are."""
+        hits, misses = self.text.hits, self.text.misses
+
+        # the background only changes between the title screen and playing
+        full_update = not DIRTY_RECTS
+        if self.bglayer_level is None or (self.bglayer_level == 0) != (self.world.level == 0):
+            self.render_background(self.world.level)
+            self.bglayer_level = self.world.level
+            full_update = True
+
+        # erase everything drawn in the last frame
+        profiler.begin('erase')
+        if full_update:
+            self.screen.blit(self.bglayer, (0, 0))
+        else:
+            for rect in self.drawn_rects:
+                self.screen.blit(self.bglayer, rect, rect)
+        self.frame_rects = []
+        profiler.end()
 
+        profiler.begin('world')
         if self.world.level == 0:
             self.render_title_screen()
         else:
-            self.render_game_world()
+            self.render_game_world(alpha)
             if self.game_paused:
                 self.render_pause_text()
+        profiler.end()
 
-        text = self.hud_font.render(str(self.world.level), False, BLACK)
-        self.screen.blit(text, (MAP_WIDTH + 20, 48))
-        text = self.hud_font.render(str(self.world.lives), False, BLACK)
-        self.screen.blit(text, (MAP_WIDTH + 20, 48 * 3))
-        text = self.hud_font.render(str(self.world.score), False, BLACK)
-        self.screen.blit(text, (MAP_WIDTH + 20, 48 * 5))
+        profiler.begin('hud')
+
+        text = self.text.render(self.hud_font, str(self.world.level), BLACK)
+        self.blit(text, (MAP_WIDTH + 20, 48))
+        text = self.text.render(self.hud_font, str(self.world.lives), BLACK)
+        self.blit(text, (MAP_WIDTH + 20, 48 * 3))
+        text = self.text.render(self.hud_font, str(self.world.score), BLACK)
+        self.blit(text, (MAP_WIDTH + 20, 48 * 5))
 
         text_y = 48 * 6
         if self.world.ship:
@@ -570,15 +1477,45 @@ class GameScreen:
                               (self.world.ship.has_shotgun(), 'Shotgun ' + str(int(self.world.ship.has_shotgun()))))
             for seconds_left, text in powerup_status:
                 if seconds_left:
-                    text = self.msg_font.render(text, False, BLACK)
-                    self.screen.blit(text, (MAP_WIDTH + 20, text_y))
+                    text = self.text.render(self.msg_font, text, BLACK)
+                    self.blit(text, (MAP_WIDTH + 20, text_y))
                     text_y += 25
 
         if DISPLAY_FPS:
-            fps_text = self.msg_font.render(str(self.fps), False, GREEN)
-            self.screen.blit(fps_text, (0, 0))
-
-        pygame.display.flip()
+            fps_text = self.text.render(self.msg_font, '%d fps, %d/%d cached text' % (
+                self.fps, self.frame_text_hits, self.frame_text_hits + self.frame_text_misses), GREEN)
+            self.blit(fps_text, (0, 0))
+
+        text_y = 24 if DISPLAY_FPS else 0
+        for line in profiler.summary_lines():
+            text = self.text.render(self.msg_font, line, GREEN)
+            self.blit(text, (0, text_y))
+            text_y += text.get_height()
+        profiler.end()
+
+        self.frame_text_hits = self.text.hits - hits
+        self.frame_text_misses = self.text.misses - misses
+        profiler.begin('display')
+        self.update_display(full_update)
+        profiler.end()
+
+    def blit(self, source, dest):
+        """Blits source onto the screen and remembers the Rect it covered."""
+        self.frame_rects.append(self.screen.blit(source, dest))
+
+    def update_display(self, full_update):
+        """Updates the window with the parts of the screen that were drawn over in this frame or
+        the last one, or the whole window if full_update is True or too much of it changed."""
+        dirty_rects = self.drawn_rects + self.frame_rects
+        self.drawn_rects = self.frame_rects
+
+        dirty_area = sum(rect.width * rect.height for rect in dirty_rects) / float(WINDOW_WIDTH * WINDOW_HEIGHT)
+        if full_update or dirty_area > MAX_DIRTY_AREA:
+            self.frame_dirty_area = 1.0
+            pygame.display.flip()
+        else:
+            self.frame_dirty_area = dirty_area
+            pygame.display.update(dirty_rects)
 
     def render_background(self, level):
         self.bglayer.fill(BLACK)
@@ -586,110 +1523,903 @@ class GameScreen:
 
         msg = ["Level", "Lives", "Score"]
         for i in range(3):
-            text = self.hud_font.render(msg[i], False, BLACK)
+            text = self.text.render(self.hud_font, msg[i], BLACK)
             self.bglayer.blit(text, (MAP_WIDTH + 20, i * 96))
 
-        text = self.msg_font.render('[Q]uit', False, WHITE)
+        text = self.text.render(self.msg_font, '[Q]uit', WHITE)
         self.bglayer.blit(text, (MAP_WIDTH + 20, 424))
 
         if level == 0:
             msg = '[P]lay'
         else:
             msg = '[P]ause'
-        text = self.msg_font.render(msg, False, WHITE)
+        text = self.text.render(self.msg_font, msg, WHITE)
         self.bglayer.blit(text, (MAP_WIDTH + 20, 400))
 
     def render_title_screen(self):
-        text = self.hud_font.render("SQUARE", False, GREEN)
-        self.screen.blit(text, text.get_rect(midbottom = (MAP_HALF_WIDTH, MAP_HALF_HEIGHT)))
-        text = self.hud_font.render("SHOOTER", False, GREEN)
-        self.screen.blit(text, text.get_rect(midtop = (MAP_HALF_WIDTH, MAP_HALF_HEIGHT)))
+        text = self.text.render(self.hud_font, "SQUARE", GREEN)
+        self.blit(text, text.get_rect(midbottom = (MAP_HALF_WIDTH, MAP_HALF_HEIGHT)))
+        text = self.text.render(self.hud_font, "SHOOTER", GREEN)
+        self.blit(text, text.get_rect(midtop = (MAP_HALF_WIDTH, MAP_HALF_HEIGHT)))
 
-        text = self.msg_font.render("FCP", False, GREEN)
-        self.screen.blit(text, text.get_rect(midbottom = (MAP_HALF_WIDTH, MAP_QUARTER_HEIGHT)))
-        text = self.msg_font.render("presents", False, GREEN)
-        self.screen.blit(text, text.get_rect(midtop = (MAP_HALF_WIDTH, MAP_QUARTER_HEIGHT)))
+        text = self.text.render(self.msg_font, "FCP", GREEN)
+        self.blit(text, text.get_rect(midbottom = (MAP_HALF_WIDTH, MAP_QUARTER_HEIGHT)))
+        text = self.text.render(self.msg_font, "presents", GREEN)
+        self.blit(text, text.get_rect(midtop = (MAP_HALF_WIDTH, MAP_QUARTER_HEIGHT)))
 
         high_score = "High score: " + str(self.world.high_score)
-        text = self.msg_font.render(high_score, False, GREEN)
-        self.screen.blit(text, text.get_rect(midbottom = (MAP_HALF_WIDTH, MAP_THREE_QUARTER_HEIGHT)))
+        text = self.text.render(self.msg_font, high_score, GREEN)
+        self.blit(text, text.get_rect(midbottom = (MAP_HALF_WIDTH, MAP_THREE_QUARTER_HEIGHT)))
 
         max_level = "Max level: " + str(self.world.max_level)
-        text = self.msg_font.render(max_level, False, GREEN)
-        self.screen.blit(text, text.get_rect(midtop = (MAP_HALF_WIDTH, MAP_THREE_QUARTER_HEIGHT)))
+        text = self.text.render(self.msg_font, max_level, GREEN)
+        self.blit(text, text.get_rect(midtop = (MAP_HALF_WIDTH, MAP_THREE_QUARTER_HEIGHT)))
+
+    def render_game_world(self, alpha=1.0):
+        map_rect = pygame.Rect(0, 0, MAP_WIDTH, MAP_HEIGHT)
+        self.screen.set_clip(map_rect)
 
-    def render_game_world(self):
-        self.screen.set_clip((0, 0, MAP_WIDTH, MAP_HEIGHT))
+        # how many seconds behind the last update the moving objects are drawn
+        lag = (1.0 - alpha) * TICK_LENGTH
 
+        drawn = []
         if self.world.ship != None:
-            self.world.ship.render(self.screen)
+            drawn.append(self.world.ship.render(self.screen, lag))
         for bullet in self.world.bullets:
-            bullet.render(self.screen)
+            drawn.append(bullet.render(self.screen, lag))
 
+        # frozen bubbles keep their speed but do not move
+        if self.world.ship != None and self.world.ship.has_freeze():
+            bubble_lag = 0
+        else:
+            bubble_lag = lag
         for bubble in self.world.bubbles:
-            bubble.render(self.screen)
+            drawn.append(bubble.render(self.screen, bubble_lag))
 
         for explosion in self.world.explosions:
-            explosion.render(self.screen)
+            drawn.append(explosion.render(self.screen))
 
         for powerup in self.world.powerups:
-            powerup.render(self.screen)
+            drawn.append(powerup.render(self.screen))
 
         self.screen.set_clip(None)
 
+        # the shapes can stick out past the edge of the map, but only the map was drawn on. The
+        # Rects that pygame.draw returns can be a pixel short, so they are grown by a pixel.
+        for rect in drawn:
+            rect = rect.inflate(2, 2).clip(map_rect)
+            if rect.width and rect.height:
+                self.frame_rects.append(rect)
+
 
     def render_pause_text(self):
-        pause_text = self.msg_font.render("Game paused", False, GREEN)
-        self.screen.blit(
+        pause_text = self.text.render(self.msg_font, "Game paused", GREEN)
+        self.blit(
             pause_text,
             pause_text.get_rect(midbottom = (MAP_HALF_WIDTH, MAP_HEIGHT)))
 
-pygame.init()
-
-screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
-clock = pygame.time.Clock()
-world = GameWorld()
-renderer = GameScreen(world, screen)
-
-pygame.display.set_caption("Square Shooter Desktop Edition")
-pygame.event.set_blocked(pygame.MOUSEMOTION)
-
-while True:
-    delta_t = clock.tick(60)
-    if DISPLAY_FPS:
-        renderer.fps = int(round(clock.get_fps()))
+# the player's actions that change the world, as they are stored in a recording
+INPUT_START   = 1 # start a game from the title screen
+INPUT_QUIT    = 2 # go back to the title screen
+INPUT_PRESS   = 3 # press the mouse button at x, y
+INPUT_RELEASE = 4 # let go of the mouse button
+INPUT_END     = 5 # the last tick of the recording, followed by the RECORDING_RESULT
+
+RECORDING_MAGIC = b'SQSH'
+RECORDING_VERSION = 2 # version 1 had room for only 65535 stress bubbles and levels
+RECORDING_HEADER = struct.Struct('<4sBIIB') # magic, version, random seed, stress bubbles, array world
+RECORDING_INPUT = struct.Struct('<IBHH')    # tick, INPUT_ action, x, y (in pixels)
+RECORDING_RESULT = struct.Struct('<qIH')    # score, level (the stress bubbles in a stress test), lives when the recording ended
+
+def apply_input(world, action, x=0, y=0):
+    """Does what one of the INPUT_ actions does to world. x and y are the mouse position
+    in pixels, for INPUT_PRESS."""
+    if action == INPUT_START:
+        world.score = 0
+        world.lives = 1
+        world.init_level(1)
+    elif action == INPUT_QUIT:
+        world.level = 0
+    elif action == INPUT_PRESS:
+        world.press_at(x / float(MAP_WIDTH), y / float(MAP_HEIGHT))
+    elif action == INPUT_RELEASE:
+        world.release()
+
+def start_stress_level(world, stress_bubbles):
+    """Starts a level with stress_bubbles big bubbles and a ship that has the shotgun powerup."""
+    world.score = 0
+    world.lives = 1
+    world.init_level(stress_bubbles)
+    world.ship.add_shotgun(60 * 60)
+
+
+class InputRecorder(object):
+    """Writes the random seed of a game and the player's actions during it to a file, with
+    the number of world updates that came before each action, so that replay_recording()
+    can play exactly the same game again."""
+
+    def __init__(self, filename, seed, stress_bubbles=0, array_world=False):
+        self.file = open(filename, 'wb')
+        self.file.write(RECORDING_HEADER.pack(RECORDING_MAGIC, RECORDING_VERSION, seed, stress_bubbles, array_world))
+
+    def record(self, tick, action, x=0, y=0):
+        self.file.write(RECORDING_INPUT.pack(tick, action, x, y))
+
+    def close(self, tick, world):
+        """Ends the recording after tick world updates, with world's score, level, and lives
+        for checking the replay against."""
+        self.record(tick, INPUT_END)
+        self.file.write(RECORDING_RESULT.pack(world.score, world.level, world.lives))
+        self.file.close()
+
+def read_recording(filename):
+    """Returns the header dictionary, the list of (tick, action, x, y) inputs, and the result
+    dictionary (or None, if the game didn't quit properly) of a recording from InputRecorder."""
+    with open(filename, 'rb') as recording:
+        data = recording.read()
+    magic, version, seed, stress_bubbles, array_world = RECORDING_HEADER.unpack_from(data)
+    if magic != RECORDING_MAGIC:
+        raise ValueError('%s is not a Square Shooter recording' % filename)
+    if version != RECORDING_VERSION:
+        raise ValueError('%s is a version %d recording, this game only replays version %d' % (filename, version, RECORDING_VERSION))
+    header = {'seed': seed, 'stress_bubbles': stress_bubbles, 'array_world': bool(array_world)}
+
+    inputs = []
+    result = None
+    offset = RECORDING_HEADER.size
+    while offset + RECORDING_INPUT.size <= len(data):
+        tick, action, x, y = RECORDING_INPUT.unpack_from(data, offset)
+        offset += RECORDING_INPUT.size
+        if action == INPUT_END:
+            score, level, lives = RECORDING_RESULT.unpack_from(data, offset)
+            result = {'ticks': tick, 'score': score, 'level': level, 'lives': lives}
+            break
+        inputs.append((tick, action, x, y))
+    return header, inputs, result
+
+
+def main(stress_bubbles=0, array_world=False, record=None):
+    """Plays the game in a window. If stress_bubbles is not 0, the game starts right away on a
+    level with that many big bubbles and a ship that has the shotgun powerup. If array_world
+    is True, the game is simulated by an ArrayGameWorld instead of a GameWorld. If record is
+    a filename, the game's inputs are recorded there for replay_recording()."""
+    recorder = None
+    if record:
+        seed = random.getrandbits(32)
+        random.seed(seed)
+        recorder = InputRecorder(record, seed, stress_bubbles, array_world)
+    pygame.init()
+
+    screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
+    clock = pygame.time.Clock()
+    unsimulated_time = 0.0 # the seconds that have passed but have not been simulated yet
+    if array_world:
+        world = ArrayGameWorld()
+    else:
+        world = GameWorld()
+    renderer = GameScreen(world, screen)
+
+    pygame.display.set_caption("Square Shooter Desktop Edition")
+    pygame.event.set_blocked(pygame.MOUSEMOTION)
+
+    if stress_bubbles:
+        start_stress_level(world, stress_bubbles)
+    profiler.wrap(world, 'update', 'handle_collisions', 'update_bubbles', 'update_bullets')
+    profiler.wrap(renderer, 'render')
+    world_ticks = 0 # the number of world updates so far, which is when inputs are recorded
+
+    while True:
+        frame_time = clock.tick(60) * 0.001 # simulations need the time in seconds, dammit!
+        profiler.start_frame()
+        if DISPLAY_FPS:
+            renderer.fps = int(round(clock.get_fps()))
 
-    ev = pygame.event.poll()
-    if ev.type == pygame.QUIT:
-        break
-    elif ev.type == pygame.KEYUP:
-        if ev.key == pygame.K_ESCAPE:
+        profiler.begin('events')
+        ev = pygame.event.poll()
+        action = None
+        x = y = 0
+        if ev.type == pygame.QUIT:
             break
-        elif ev.key == pygame.K_q:
-            if world.level > 0:
-                world.level = 0
-            else:
+        elif ev.type == pygame.KEYUP:
+            if ev.key == pygame.K_ESCAPE:
                 break
-        elif ev.key == pygame.K_p:
-            if world.level == 0:
-                world.score = 0
-                world.lives = 1
-                world.init_level(1)
+            elif ev.key == pygame.K_q:
+                if world.level > 0:
+                    action = INPUT_QUIT
+                else:
+                    break
+            elif ev.key == pygame.K_p:
+                if world.level == 0:
+                    action = INPUT_START
+                else:
+                    renderer.game_paused = not renderer.game_paused
+        elif ev.type == pygame.MOUSEBUTTONDOWN:
+            # on mouse down, fire a bullet and start the thruster of the ship
+            if not renderer.game_paused:
+                action = INPUT_PRESS
+                x, y = ev.pos
+        elif ev.type == pygame.MOUSEBUTTONUP:
+            # on mouse up, stop accelerating the ship
+            action = INPUT_RELEASE
+        if action:
+            apply_input(world, action, x, y)
+            if recorder:
+                recorder.record(world_ticks, action, x, y)
+        profiler.end()
+
+        # The world is always updated TICK_LENGTH seconds at a time, so that a slow frame
+        # cannot make bullets jump past bubbles, and the same clicks at the same ticks play
+        # the same game on any computer. After a very slow frame, the time that would take
+        # more than MAX_TICKS_PER_FRAME updates to catch up with is dropped.
+        if world.level > 0 and not renderer.game_paused:
+            unsimulated_time += frame_time
+            ticks = 0
+            while unsimulated_time >= TICK_LENGTH and ticks < MAX_TICKS_PER_FRAME and world.level > 0:
+                world.update(TICK_LENGTH)
+                unsimulated_time -= TICK_LENGTH
+                ticks += 1
+                world_ticks += 1
+            if ticks == MAX_TICKS_PER_FRAME and unsimulated_time >= TICK_LENGTH:
+                unsimulated_time = 0.0 # too far behind, so drop the rest
+            renderer.render(unsimulated_time / TICK_LENGTH)
+        else:
+            unsimulated_time = 0.0
+            renderer.render()
+        profiler.end_frame()
+
+    if recorder:
+        recorder.close(world_ticks, world)
+    profiler.close()
+
+
+class RandomPlayer(object):
+    """A scripted player for headless games that clicks somewhere random on the map every
+    "interval" ticks and lets go of the mouse button on the next tick."""
+
+    def __init__(self, interval=20):
+        self.interval = interval
+
+    def play(self, world, tick):
+        if tick % self.interval == 0:
+            world.press_at(random.random(), random.random())
+        elif tick % self.interval == 1:
+            world.release()
+
+
+class AimingPlayer(RandomPlayer):
+    """A scripted player for headless games that clicks on the bubble closest to the ship
+    every "interval" ticks and lets go of the mouse button on the next tick."""
+
+    def play(self, world, tick):
+        if tick % self.interval == 0 and world.ship != None and len(world.bubbles):
+            ship = world.ship
+            target = min(world.bubbles, key=lambda b: (b.pos.x - ship.pos.x) ** 2 + (b.pos.y - ship.pos.y) ** 2)
+            world.press_at(target.pos.x, target.pos.y)
+        elif tick % self.interval == 1:
+            world.release()
+
+PLAYERS = {'random': RandomPlayer,
+           'aiming': AimingPlayer}
+
+
+def play_headless(player, world_class=GameWorld, delta_t=TICK_LENGTH, max_ticks=60 * 60 * 10):
+    """Plays one game without a window or a frame rate limit, with the player object choosing
+    the mouse clicks, until the game is over or max_ticks updates of delta_t seconds have been
+    simulated. Returns a dictionary of the results."""
+    world = world_class()
+    world.score = 0
+    world.lives = 1
+    world.init_level(1)
+
+    start = timeit.default_timer()
+    tick = 0
+    while world.level > 0 and tick < max_ticks:
+        player.play(world, tick)
+        world.update(delta_t)
+        tick += 1
+    elapsed = timeit.default_timer() - start
+
+    return {'ticks': tick,
+            'seconds': elapsed,
+            'ticks_per_second': tick / elapsed if elapsed else float('inf'),
+            'game_over': world.level == 0,
+            'score': world.score,
+            'max_level': world.max_level,
+            'ships_lost': world.ships_lost,
+            'bubbles_popped': world.bubbles_popped,
+            'powerups_collected': world.powerups_collected}
+
+
+def replay_recording(filename, render=False):
+    """Plays a game recorded by main() again without a frame rate limit, applying the recorded
+    inputs at the same world updates, and times every update. If render is True, every update
+    is also drawn with GameScreen in a hidden window. Returns a dictionary of the results,
+    with "matches" True if the game ended with the score, level, and lives of the recording."""
+    header, inputs, recorded = read_recording(filename)
+    random.seed(header['seed'])
+    world = ArrayGameWorld() if header['array_world'] else GameWorld()
+    if render:
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+        pygame.init()
+        renderer = GameScreen(world, pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT)))
+    if header['stress_bubbles']:
+        start_stress_level(world, header['stress_bubbles'])
+    profiler.wrap(world, 'update', 'handle_collisions', 'update_bubbles', 'update_bullets')
+    if render:
+        profiler.wrap(renderer, 'render')
+
+    last_tick = recorded['ticks'] if recorded else (inputs[-1][0] if inputs else 0)
+    tick_times = [] # the seconds each update (and render) took
+    tick = next_input = 0
+    while True:
+        while next_input < len(inputs) and inputs[next_input][0] == tick:
+            apply_input(world, *inputs[next_input][1:])
+            next_input += 1
+        if tick == last_tick or world.level == 0:
+            break # the recorded game only updated the world while it was playing
+        profiler.start_frame()
+        start = timeit.default_timer()
+        world.update(TICK_LENGTH)
+        if render:
+            renderer.render()
+        tick_times.append(timeit.default_timer() - start)
+        profiler.end_frame()
+        tick += 1
+
+    elapsed = sum(tick_times)
+    slowest = sorted(range(len(tick_times)), key=lambda i: -tick_times[i])[:5]
+    return {'ticks': tick,
+            'seconds': elapsed,
+            'ticks_per_second': tick / elapsed if elapsed else float('inf'),
+            'tick_times': tick_times,
+            'slowest_ticks': [(i, tick_times[i]) for i in slowest],
+            'score': world.score,
+            'level': world.level,
+            'lives': world.lives,
+            'recorded': recorded,
+            'matches': recorded is not None and (tick, world.score, world.level, world.lives) ==
+                       (recorded['ticks'], recorded['score'], recorded['level'], recorded['lives'])}
+
+def percentile(values, fraction):
+    """Returns the value that fraction (from 0.0 to 1.0) of the sorted values are at or below."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+# the module-level constants that apply_settings() can change
+TUNABLE_SETTINGS = ('DECELERATION', 'MAX_EXPLOSION_SIZE', 'MAX_POWERUP_AGE', 'POWERUP_CHANCE')
+
+def apply_settings(settings):
+    """Changes the game's difficulty settings. settings is a dictionary whose keys are names
+    from TUNABLE_SETTINGS, or "size.<kind>" or "speed.<kind>" to change Bubble.kinds."""
+    global DECELERATION, MAX_EXPLOSION_SIZE, MAX_POWERUP_AGE, POWERUP_CHANCE
+    for name, value in settings.items():
+        if name.split('.')[0] in ('size', 'speed') and name.split('.')[-1] in Bubble.kinds:
+            field, kind = name.split('.')
+            size, speed = Bubble.kinds[kind]
+            if field == 'size':
+                Bubble.kinds[kind] = (value, speed)
             else:
-                renderer.game_paused = not renderer.game_paused
-    elif ev.type == pygame.MOUSEBUTTONDOWN:
-        # on mouse down, fire a bullet and start the thruster of the ship
-        if (world.level > 0) and (world.ship != None) and (not renderer.game_paused):
-            x, y = ev.pos
-            if len(world.bullets) < 6:
-                world.bullets.extend(world.ship.shoot_at(x / float(MAP_WIDTH), y / float(MAP_HEIGHT)))
-            world.ship.thrust_at(x / float(MAP_WIDTH), y / float(MAP_HEIGHT))
-    elif ev.type == pygame.MOUSEBUTTONUP:
-        # on mouse up, stop accelerating the ship
-        if (world.level > 0) and (world.ship != None):
-            world.ship.stop_thrust()
-
-    # Simulations need the time in seconds, dammit!
-    if world.level > 0 and not renderer.game_paused:
-        world.update(delta_t * 0.001)
-    renderer.render()
+                Bubble.kinds[kind] = (size, value)
+        elif name in TUNABLE_SETTINGS:
+            globals()[name] = value
+        else:
+            raise ValueError('Unknown setting: ' + name)
+
+
+def play_batch_game(job):
+    """Plays one headless game for run_batch() in a worker process."""
+    seed, player_name, array_world, delta_t, max_ticks, settings = job
+    apply_settings(settings)
+    random.seed(seed)
+    world_class = ArrayGameWorld if array_world else GameWorld
+    result = play_headless(PLAYERS[player_name](), world_class, delta_t, max_ticks)
+    result['seed'] = seed
+    return result
+
+def run_batch(num_games, player_name='aiming', array_world=False, delta_t=TICK_LENGTH,
+              max_ticks=60 * 60 * 10, settings=None, first_seed=0, processes=None):
+    """Plays num_games headless games, seeded first_seed, first_seed + 1, and so on, spread across
+    a pool of processes (one per CPU by default). Returns a list of play_headless() results."""
+    jobs = [(first_seed + i, player_name, array_world, delta_t, max_ticks, settings or {}) for i in range(num_games)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(play_batch_game, jobs, chunksize=max(1, num_games // (4 * (processes or multiprocessing.cpu_count()))))
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+BATCH_COLUMNS = ('score', 'max_level', 'ships_lost', 'bubbles_popped', 'powerups_collected', 'ticks', 'ticks_per_second')
+
+def print_batch_summary(results):
+    print('%-20s %12s %12s %12s %12s' % ('(%d games)' % len(results), 'mean', 'min', 'median', 'max'))
+    for column in BATCH_COLUMNS:
+        values = sorted(result[column] for result in results)
+        print('%-20s %12.1f %12.1f %12.1f %12.1f' % (
+            column, sum(values) / float(len(values)), values[0], values[len(values) // 2], values[-1]))
+    print('%-20s %12d' % ('games over', sum(1 for result in results if result['game_over'])))
+
+
+def benchmark_collisions(bubble_counts=(100, 1000, 5000), num_bullets=50, num_frames=60):
+    """Prints the pair tests and time per frame of GameWorld.update() with the SpatialGrid broad
+    phase compared to testing all pairs, on worlds with many bubbles and a ship spraying
+    shotgun bullets. The pair tests are every sweeps_into(), collides_with() and
+    circle_touches() call, and every object circles_touching() is given, so the ship's tests
+    against the bubbles and powerups are counted as well as the bullets' tests."""
+    global circle_touches, circles_touching
+    pair_tests = [0]
+    collides_with = ObjectOnMap.collides_with
+    sweeps_into = Bullet.sweeps_into
+    kernel = circle_touches, circles_touching
+    def counting_collides_with(self, other):
+        pair_tests[0] += 1
+        return collides_with(self, other)
+    def counting_sweeps_into(self, bubble, delta_t, bubble_delta_t):
+        pair_tests[0] += 1
+        return sweeps_into(self, bubble, delta_t, bubble_delta_t)
+    def counting_circle_touches(x, y, radius, obj):
+        pair_tests[0] += 1
+        return kernel[0](x, y, radius, obj)
+    def counting_circles_touching(x, y, radius, objects):
+        pair_tests[0] += len(objects)
+        return kernel[1](x, y, radius, objects)
+    ObjectOnMap.collides_with = counting_collides_with
+    Bullet.sweeps_into = counting_sweeps_into
+    circle_touches, circles_touching = counting_circle_touches, counting_circles_touching
+
+    try:
+        for num_bubbles in bubble_counts:
+            for broad_phase in (AllPairs, SpatialGrid):
+                random.seed(num_bubbles) # every broad phase plays out the same game
+                world = GameWorld()
+                world.broad_phase = broad_phase
+                world.lives = 1
+                world.init_level(num_bubbles)
+                world.ship.add_shotgun(num_frames)
+                world.ship.add_shield(num_frames) # keep the ship alive for the whole benchmark
+
+                pair_tests[0] = 0
+                start = timeit.default_timer()
+                for frame in range(num_frames):
+                    while len(world.bullets) < num_bullets:
+                        world.bullets.extend(world.ship.shoot_at(random.random(), random.random()))
+                    world.update(TICK_LENGTH)
+                elapsed = timeit.default_timer() - start
+                print('%5d bubbles %-11s %9.1f pair tests/frame %8.2f ms/frame' % (
+                    num_bubbles, broad_phase.__name__, pair_tests[0] / float(num_frames), elapsed / num_frames * 1000))
+    finally:
+        ObjectOnMap.collides_with = collides_with
+        Bullet.sweeps_into = sweeps_into
+        circle_touches, circles_touching = kernel
+
+def benchmark_array_world(bubble_counts=(1000, 10000, 50000), num_bullets=50, num_frames=30):
+    """Prints the time per frame of GameWorld.update() for a GameWorld and an ArrayGameWorld
+    on levels with many bubbles and a ship spraying shotgun bullets."""
+    for num_bubbles in bubble_counts:
+        for world_class in (GameWorld, ArrayGameWorld):
+            random.seed(num_bubbles)
+            world = world_class()
+            world.lives = 1
+            world.init_level(num_bubbles)
+            world.ship.add_shotgun(num_frames)
+            world.ship.add_shield(num_frames) # keep the ship alive for the whole benchmark
+
+            start = timeit.default_timer()
+            for frame in range(num_frames):
+                while len(world.bullets) < num_bullets:
+                    world.bullets.extend(world.ship.shoot_at(random.random(), random.random()))
+                world.update(TICK_LENGTH)
+            elapsed = timeit.default_timer() - start
+            print('%6d bubbles %-14s %8.2f ms/frame, %6d bubbles left, score %d' % (
+                num_bubbles, world_class.__name__, elapsed / num_frames * 1000, len(world.bubbles), world.score))
+
+def benchmark_render(bubble_counts=(1, 5, 20), num_frames=600):
+    """Prints the time per frame of GameScreen.render(), how much of its text came from the
+    TextCache, and how much of the window it updated, while an AimingPlayer plays levels
+    with bubble_counts big bubbles."""
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    pygame.init()
+    screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
+    for num_bubbles in bubble_counts:
+        random.seed(num_bubbles)
+        world = GameWorld()
+        world.lives = 1
+        world.init_level(num_bubbles)
+        renderer = GameScreen(world, screen)
+        player = AimingPlayer()
+
+        render_time = dirty_area = 0
+        for frame in range(num_frames):
+            player.play(world, frame)
+            world.update(TICK_LENGTH)
+            start = timeit.default_timer()
+            renderer.render()
+            render_time += timeit.default_timer() - start
+            dirty_area += renderer.frame_dirty_area
+        print('%3d bubbles %7.3f ms/frame, %.2f text hits/frame, %.2f text misses/frame, %5.1f%% of the window updated/frame' % (
+            num_bubbles, render_time / num_frames * 1000, renderer.text.hits / float(num_frames),
+            renderer.text.misses / float(num_frames), dirty_area / num_frames * 100))
+
+def benchmark_kernel(num_objects=1000, num_queries=1000):
+    """Prints the time per pair test to find which of num_objects bubbles each of num_queries
+    ships touches, with the square root and no wrapping like collides_with() used to, with
+    circle_touches() and collides_with() (which calls it) one pair at a time, and with
+    circles_touching() testing each ship against every bubble at once, and how many touching
+    pairs each one found. The square root misses the pairs touching across the edges of the map."""
+    def sqrt_collides_with(self, other):
+        # this is what collides_with() did before the collision kernel
+        a = self.x - other.x
+        b = self.y - other.y
+        distance = math.sqrt(a * a + b * b)
+        return distance < (self.radius + other.radius)
+
+    random.seed(num_objects)
+    bubbles = [Bubble(random.choice(sorted(Bubble.kinds))) for i in range(num_objects)]
+    ships = []
+    for i in range(num_queries):
+        ship = Ship()
+        ship.x = random.random()
+        ship.y = random.random()
+        ships.append(ship)
+
+    for label, find in (('square root', lambda ship: [b for b in bubbles if sqrt_collides_with(ship, b)]),
+                        ('circle_touches()', lambda ship: [b for b in bubbles if circle_touches(ship.x, ship.y, ship.radius, b)]),
+                        ('collides_with()', lambda ship: [b for b in bubbles if ship.collides_with(b)]),
+                        ('circles_touching()', lambda ship: circles_touching(ship.x, ship.y, ship.radius, bubbles))):
+        hits = 0
+        start = timeit.default_timer()
+        for ship in ships:
+            hits += len(find(ship))
+        elapsed = timeit.default_timer() - start
+        print('%-18s %7.1f ns/pair test, %6d touching pairs' % (label, elapsed / (num_objects * num_queries) * 1e9, hits))
+
+def benchmark_memory(num_bubbles=100000, num_frames=10):
+    """Prints the memory and the objects tracked by the garbage collector for each bubble of a
+    stress level with num_bubbles big bubbles, how long a full garbage collection takes with
+    them all alive, and the time per frame to move them."""
+    world_classes = [GameWorld]
+    if numpy is not None:
+        world_classes.append(ArrayGameWorld)
+    for world_class in world_classes:
+        random.seed(num_bubbles)
+        gc.collect()
+        tracked = len(gc.get_objects())
+        tracemalloc.start()
+        world = world_class()
+        start_stress_level(world, num_bubbles)
+        allocated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        tracked = len(gc.get_objects()) - tracked
+
+        start = timeit.default_timer()
+        gc.collect()
+        collect_time = timeit.default_timer() - start
+        start = timeit.default_timer()
+        for frame in range(num_frames):
+            world.update_bubbles(TICK_LENGTH)
+        update_time = (timeit.default_timer() - start) / num_frames
+        print('%d bubbles %-14s %6.1f bytes/bubble, %5.2f GC-tracked objects/bubble, gc.collect() %7.2f ms, update_bubbles() %7.2f ms/frame' % (
+            num_bubbles, world_class.__name__, allocated / float(num_bubbles), tracked / float(num_bubbles),
+            collect_time * 1000, update_time * 1000))
+        del world
+
+def shoot_once(world_class, seed, delta_t, seconds):
+    """Starts a level with one big bubble and has a shielded, unmoving ship fire one bullet
+    near where the bubble is headed. Then simulates the level in updates of delta_t seconds
+    for the given number of seconds, and returns the number of seconds until the bullet hit
+    the bubble, or None if it missed."""
+    random.seed(seed)
+    world = world_class()
+    world.lives = 1
+    world.init_level(1)
+    world.ship.add_shield(seconds)
+    bubble = next(iter(world.bubbles))
+    lead = random.random()
+    world.press_at(bubble.pos.x + bubble.speed.x * lead + random.uniform(-0.3, 0.3),
+                   bubble.pos.y + bubble.speed.y * lead + random.uniform(-0.3, 0.3))
+    world.release()
+
+    for tick in range(int(round(seconds / delta_t))):
+        world.update(delta_t)
+        if world.bubbles_popped:
+            return (tick + 1) * delta_t
+    return None
+
+def check_hit_parity(num_shots=1000, fine_t=TICK_LENGTH, coarse_t=0.1, seconds=3):
+    """Fires num_shots bullets with shoot_once() at updates of fine_t and coarse_t seconds, with
+    and without SWEPT_COLLISIONS, and prints how many hit at each and how many hit at one but
+    not the other. Returns True if, with SWEPT_COLLISIONS, every shot that hit at fine_t
+    hit at coarse_t too, and the other way around."""
+    global SWEPT_COLLISIONS
+    swept_collisions = SWEPT_COLLISIONS
+    world_classes = [GameWorld]
+    if numpy is not None:
+        world_classes.append(ArrayGameWorld)
+
+    passed = True
+    for world_class in world_classes:
+        for swept in (False, True):
+            SWEPT_COLLISIONS = swept
+            fine_hits = coarse_hits = mismatches = 0
+            for shot in range(num_shots):
+                fine = shoot_once(world_class, shot, fine_t, seconds)
+                coarse = shoot_once(world_class, shot, coarse_t, seconds)
+                fine_hits += fine is not None
+                coarse_hits += coarse is not None
+                mismatches += (fine is None) != (coarse is None)
+            print('%-14s %-8s %4d hits at %4.1f Hz, %4d hits at %4.1f Hz, %4d shots differ' % (
+                world_class.__name__, 'swept' if swept else 'unswept', fine_hits, 1 / fine_t,
+                coarse_hits, 1 / coarse_t, mismatches))
+            if swept and mismatches:
+                passed = False
+    SWEPT_COLLISIONS = swept_collisions
+    return passed
+
+CHECKS = {'hit-parity': check_hit_parity}
+
+
+def suite_collides_with(num_objects=1000, num_pairs=100000):
+    """Returns the seconds per collides_with() call, over num_pairs pairs of bubbles of every
+    kind scattered across the map."""
+    random.seed(1)
+    bubbles = [Bubble(random.choice(sorted(Bubble.kinds))) for i in range(num_objects)]
+    pairs = [(random.choice(bubbles), random.choice(bubbles)) for i in range(num_pairs)]
+    start = timeit.default_timer()
+    for a, b in pairs:
+        a.collides_with(b)
+    return (timeit.default_timer() - start) / num_pairs
+
+def suite_circles_touching(num_objects=1000, num_queries=1000):
+    """Returns the seconds per circles_touching() call, each testing a ship against
+    num_objects bubbles of every kind scattered across the map."""
+    random.seed(1)
+    bubbles = [Bubble(random.choice(sorted(Bubble.kinds))) for i in range(num_objects)]
+    queries = [(random.random(), random.random()) for i in range(num_queries)]
+    start = timeit.default_timer()
+    for x, y in queries:
+        circles_touching(x, y, 0.04, bubbles)
+    return (timeit.default_timer() - start) / num_queries
+
+def suite_handle_collisions(num_bubbles, num_bullets=50, num_frames=30):
+    """Returns the seconds per GameWorld.handle_collisions() call on a level with num_bubbles
+    big bubbles and num_bullets bullets scattered over the map. The same bubbles and bullets
+    are put back before every call, so each call checks the same objects and pops the same
+    bubbles, and the time only changes with num_bubbles."""
+    random.seed(num_bubbles)
+    world = GameWorld()
+    world.lives = 1
+    world.init_level(num_bubbles) # the ship starts with a shield, so it is never destroyed
+    bubbles = list(world.bubbles)
+    bullets = []
+    for i in range(num_bullets):
+        bullet = Bullet()
+        bullet.x, bullet.y = random.random(), random.random()
+        bullet.vx, bullet.vy = random.uniform(-3, 3), random.uniform(-3, 3)
+        bullets.append(bullet)
+    elapsed = 0
+    for frame in range(num_frames):
+        world.bubbles = list(bubbles)
+        world.bullets = list(bullets)
+        world.explosions = []
+        world.powerups = []
+        start = timeit.default_timer()
+        world.handle_collisions(TICK_LENGTH)
+        elapsed += timeit.default_timer() - start
+    return elapsed / num_frames
+
+def suite_array_world(num_bubbles=50000, num_bullets=50, num_frames=10):
+    """Returns the seconds per ArrayGameWorld.update() call on a level with num_bubbles big
+    bubbles and a ship spraying shotgun bullets, the same as --benchmark array-world. This
+    is the number of bubbles the array world is for, where it has to beat a GameWorld."""
+    random.seed(num_bubbles)
+    world = ArrayGameWorld()
+    world.lives = 1
+    world.init_level(num_bubbles)
+    world.ship.add_shotgun(num_frames)
+    world.ship.add_shield(num_frames)
+    elapsed = 0
+    for frame in range(num_frames):
+        while len(world.bullets) < num_bullets:
+            world.bullets.extend(world.ship.shoot_at(random.random(), random.random()))
+        start = timeit.default_timer()
+        world.update(TICK_LENGTH)
+        elapsed += timeit.default_timer() - start
+    return elapsed / num_frames
+
+def suite_render(num_bubbles=20, num_frames=300):
+    """Returns the seconds per GameScreen.render() call, while an AimingPlayer plays a level
+    with num_bubbles big bubbles."""
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    pygame.init()
+    screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
+    random.seed(num_bubbles)
+    world = GameWorld()
+    world.lives = 1
+    world.init_level(num_bubbles)
+    renderer = GameScreen(world, screen)
+    player = AimingPlayer()
+    elapsed = 0
+    for frame in range(num_frames):
+        player.play(world, frame)
+        world.update(TICK_LENGTH)
+        start = timeit.default_timer()
+        renderer.render()
+        elapsed += timeit.default_timer() - start
+    return elapsed / num_frames
+
+# the benchmarks run by --suite: (name, unit, function returning the seconds per unit)
+SUITE = [('collides_with',                      'call',  suite_collides_with),
+         ('circles_touching, 1000 bubbles',     'call',  suite_circles_touching),
+         ('handle_collisions, 100 bubbles',     'call',  lambda: suite_handle_collisions(100)),
+         ('handle_collisions, 1000 bubbles',    'call',  lambda: suite_handle_collisions(1000)),
+         ('handle_collisions, 5000 bubbles',    'call',  lambda: suite_handle_collisions(5000)),
+         ('GameScreen.render, 20 bubbles',      'frame', suite_render)]
+if numpy is not None:
+    SUITE.append(('ArrayGameWorld.update, 50000 bubbles', 'frame', suite_array_world))
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baselines.json')
+
+def time_best(function, repeats):
+    """Returns the fewest seconds function() returned in repeats calls. The garbage collector
+    is kept from running in the middle of them, the same as timeit does."""
+    best = None
+    for repeat in range(repeats):
+        gc.collect()
+        gc.disable()
+        try:
+            seconds = function()
+        finally:
+            gc.enable()
+        if best is None or seconds < best:
+            best = seconds
+    return best
+
+def format_seconds(seconds):
+    if seconds < 0.001:
+        return '%.3f us' % (seconds * 1e6)
+    return '%.3f ms' % (seconds * 1000)
+
+def suite_environment():
+    """Returns what the suite's times depend on besides the code, stored with the baselines."""
+    return {'python': platform.python_version(),
+            'pygame': pygame.version.ver,
+            'numpy': numpy.__version__ if numpy is not None else None,
+            'machine': platform.machine(),
+            'system': platform.system()}
+
+def run_suite(baseline_file=BASELINES, threshold=0.3, save=False, repeats=5):
+    """Runs every benchmark in SUITE repeats times and keeps its best time, the one least
+    disturbed by whatever else the computer was doing. Prints the times next to the baselines
+    stored in baseline_file, and returns the names of the benchmarks that were more than
+    threshold (a fraction, 0.3 is 30%) slower than their baseline. With save, the times
+    are written to baseline_file as the new baselines instead."""
+    baselines = {}
+    if os.path.exists(baseline_file) and not save:
+        with open(baseline_file) as stored:
+            baselines = json.load(stored)
+        if baselines.get('environment') != suite_environment():
+            print('(the baselines were saved with %s, times may not compare)' % ', '.join(
+                '%s %s' % (name, value) for name, value in sorted(baselines.get('environment', {}).items())))
+
+    times = collections.OrderedDict()
+    regressions = []
+    print('%-36s %16s %16s %8s' % ('benchmark', 'baseline', 'now', 'change'))
+    for name, unit, function in SUITE:
+        times[name] = time_best(function, repeats)
+        baseline = baselines.get('times', {}).get(name)
+        if baseline is None:
+            print('%-36s %16s %16s' % (name, '-', format_seconds(times[name]) + '/' + unit))
+            continue
+        change = times[name] / baseline - 1
+        if change > threshold:
+            regressions.append(name)
+        print('%-36s %16s %16s %+7.1f%%%s' % (name, format_seconds(baseline) + '/' + unit,
+            format_seconds(times[name]) + '/' + unit, change * 100, '  REGRESSION' if change > threshold else ''))
+
+    if save:
+        with open(baseline_file, 'w') as stored:
+            json.dump({'environment': suite_environment(), 'times': times}, stored, indent=2)
+            stored.write('\n')
+        print('baselines saved to %s' % baseline_file)
+    elif regressions:
+        print('%d of %d benchmarks more than %d%% slower than their baselines' % (len(regressions), len(SUITE), threshold * 100))
+    return regressions
+
+BENCHMARKS = {'collisions': benchmark_collisions,
+              'render': benchmark_render,
+              'array-world': benchmark_array_world,
+              'memory': benchmark_memory,
+              'kernel': benchmark_kernel}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Square Shooter')
+    parser.add_argument('--stress', type=int, default=0, metavar='BUBBLES',
+                        help='start playing a level with this many big bubbles and the shotgun powerup')
+    parser.add_argument('--record', metavar='FILE', help='record the inputs of the game to FILE, for --replay')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='play a game recorded with --record again without a window as fast as possible and print how long its updates took')
+    parser.add_argument('--render', action='store_true', help='also draw every update of --replay in a hidden window')
+    parser.add_argument('--profile', action='store_true',
+                        help='time each part of every frame and show the times on the screen, and print them at the end')
+    parser.add_argument('--profile-output', metavar='FILE',
+                        help='with --profile, write the times of every frame to FILE, as a Chrome trace if it ends in .json or else as CSV')
+    parser.add_argument('--array-world', action='store_true',
+                        help='simulate the game with NumPy arrays, for levels with very many bubbles')
+    parser.add_argument('--benchmark', choices=sorted(BENCHMARKS), help='run a benchmark instead of playing')
+    parser.add_argument('--suite', action='store_true',
+                        help='run every benchmark, compare them to the stored baselines and exit with status 1 if one got slower')
+    parser.add_argument('--save-baselines', action='store_true', help='with --suite, store the times as the new baselines')
+    parser.add_argument('--baselines', default=BASELINES, metavar='FILE', help='the baselines file for --suite')
+    parser.add_argument('--threshold', type=float, default=0.3,
+                        help='how much slower than its baseline a --suite benchmark can get, as a fraction (default: 0.3)')
+    parser.add_argument('--check', choices=sorted(CHECKS), help='run a check instead of playing, and exit with status 1 if it fails')
+    parser.add_argument('--headless', type=int, default=0, metavar='GAMES',
+                        help='play this many games without a window as fast as possible and print the results')
+    parser.add_argument('--player', choices=sorted(PLAYERS), default='aiming', help='the scripted player for headless games')
+    parser.add_argument('--ticks', type=int, default=60 * 60 * 10, help='the most updates a headless game can last')
+    parser.add_argument('--delta-t', type=float, default=TICK_LENGTH, help='the seconds simulated by each update of a headless game')
+    parser.add_argument('--seed', type=int, help='the random seed for headless games')
+    parser.add_argument('--batch', type=int, default=0, metavar='GAMES',
+                        help='play this many seeded headless games across all CPUs and print a summary table')
+    parser.add_argument('--processes', type=int, help='the number of processes for --batch (default: one per CPU)')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='change a difficulty setting for --batch: one of %s, or size.<kind> or speed.<kind> for a bubble kind' % ', '.join(TUNABLE_SETTINGS))
+    args = parser.parse_args()
+
+    if args.profile or args.profile_output:
+        profiler = FrameProfiler(output=args.profile_output)
+
+    if args.benchmark:
+        BENCHMARKS[args.benchmark]()
+    elif args.suite:
+        if run_suite(args.baselines, args.threshold, args.save_baselines):
+            sys.exit(1)
+    elif args.replay:
+        result = replay_recording(args.replay, args.render)
+        print('replayed %d ticks in %.2f seconds (%.0f ticks/sec), score %d, level %d, lives %d' % (
+            result['ticks'], result['seconds'], result['ticks_per_second'], result['score'], result['level'], result['lives']))
+        if result['ticks']:
+            tick_times = result['tick_times']
+            print('tick times: median %.3f ms, 99th percentile %.3f ms, max %.3f ms' % (
+                percentile(tick_times, 0.5) * 1000, percentile(tick_times, 0.99) * 1000, max(tick_times) * 1000))
+            print('slowest ticks: ' + ', '.join('%d (%.3f ms)' % (tick, seconds * 1000) for tick, seconds in result['slowest_ticks']))
+        profiler.close()
+        recorded = result['recorded']
+        if recorded is None:
+            print('the recording has no ending, the game did not quit normally')
+        elif not result['matches']:
+            print('the replay does not match the recording, which ended after %d ticks with score %d, level %d, lives %d' % (
+                recorded['ticks'], recorded['score'], recorded['level'], recorded['lives']))
+            sys.exit(1)
+    elif args.check:
+        if not CHECKS[args.check]():
+            print('%s check failed' % args.check)
+            sys.exit(1)
+    elif args.batch:
+        settings = {}
+        for setting in args.set:
+            name, value = setting.split('=')
+            settings[name] = float(value)
+        start = timeit.default_timer()
+        results = run_batch(args.batch, args.player, args.array_world, args.delta_t, args.ticks,
+                            settings, args.seed or 0, args.processes)
+        elapsed = timeit.default_timer() - start
+        print_batch_summary(results)
+        print('%d games in %.2f seconds, %.1f games/sec' % (len(results), elapsed, len(results) / elapsed))
+    elif args.headless:
+        if args.seed is not None:
+            random.seed(args.seed)
+        world_class = ArrayGameWorld if args.array_world else GameWorld
+        total_ticks = total_seconds = 0
+        for game in range(args.headless):
+            result = play_headless(PLAYERS[args.player](), world_class, args.delta_t, args.ticks)
+            total_ticks += result['ticks']
+            total_seconds += result['seconds']
+            print('game %d: %d ticks (%.0f ticks/sec), score %d, max level %d%s' % (
+                game + 1, result['ticks'], result['ticks_per_second'], result['score'], result['max_level'],
+                '' if result['game_over'] else ', not over'))
+        print('%d ticks in %.2f seconds, %.0f ticks/sec' % (total_ticks, total_seconds, total_ticks / total_seconds))
+    else:
+        main(args.stress, args.array_world, args.record)